@@ -0,0 +1,249 @@
+'''
+Import time of the modules loaded when OASYS registers the WISEr widgets and menu: each module is
+imported in a fresh interpreter (python -X importtime), after the modules that OASYS has already
+loaded at that point (Qt, Orange, OASYS), so that only the cost of the add-on is measured. The
+heaviest imports and the calculation libraries loaded at registration time (to be deferred to the
+creation of the widgets) are reported
+
+    python benchmarks/bench_import_time.py [-o results.json] [--repeat 5] [--check]
+    python benchmarks/bench_import_time.py -o new.json --compare old.json [--threshold 1.2]
+
+--check exits with 1 if a module loads one of the deferred libraries
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+import numpy
+
+ROOT_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+RESULTS_FORMAT = 1
+
+VERSIONED_PACKAGES = ["OASYS1-WISEr", "oasys1", "LibWiser", "WofryWiser", "wofry", "syned", "srxraylib", "matplotlib", "numpy"]
+
+# already loaded by OASYS when the add-on is registered: not timed
+PRELOADED_MODULES = ["numpy", "pkg_resources", # entry points of the add-ons, namespace packages
+                     "PyQt5.QtCore", "PyQt5.QtGui", "PyQt5.QtWidgets",
+                     "orangewidget.gui", "orangewidget.settings", "orangewidget.widget",
+                     "oasys.widgets.widget", "oasys.widgets.gui", "oasys.widgets.congruence", "oasys.menus.menu"]
+
+REGISTERED_MODULES = ["orangecontrib.OasysWiser.widgets.gui.ow_wise_widget",
+                      "orangecontrib.OasysWiser.widgets.gui.ow_optical_element",
+                      "orangecontrib.OasysWiser.widgets.optical_elements.ow_detector",
+                      "orangecontrib.OasysWiser.widgets.tools.dabam_height_profile",
+                      "orangecontrib.OasysWiser.widgets.tools.height_profile_simulator",
+                      "orangecontrib.OasysWiser.menu.ow_wise_tools_menu"]
+
+# imported by the widgets when they are created or compute
+DEFERRED_MODULES = ["LibWiser", "WofryWiser", "wofry", "matplotlib", "pylab", "srxraylib", "Shadow", "scipy", "h5py"]
+
+TARGET_MARKER = "--- bench_import_time: target ---"
+
+IMPORT_SCRIPT = '''
+import sys, json, time
+
+for preloaded_module in {preloaded_modules!r}:
+    try:
+        __import__(preloaded_module)
+    except ImportError:
+        pass
+
+sys.stderr.write({marker!r} + "\\n")
+sys.stderr.flush()
+
+modules_before = set(sys.modules.keys())
+
+t0 = time.perf_counter()
+__import__({module!r})
+elapsed = time.perf_counter() - t0
+
+print(json.dumps({{"time" : elapsed, "loaded" : sorted(set(sys.modules.keys()) - modules_before)}}))
+'''
+
+###############################################################
+#
+# BENCHMARK
+#
+###############################################################
+
+def parse_import_time(stderr):
+    '''
+    Entries (self [s], cumulative [s], module) of -X importtime, after the target marker
+    '''
+    entries = []
+    is_target = False
+
+    for line in stderr.splitlines():
+        if line.strip() == TARGET_MARKER:
+            is_target = True
+        elif is_target and line.startswith("import time:") and not "imported package" in line:
+            self_time, cumulative_time, module = line[len("import time:"):].split("|", 2)
+
+            entries.append((int(self_time)*1e-6, int(cumulative_time)*1e-6, module.strip()))
+
+    return entries
+
+def import_module(module, preloaded_modules=PRELOADED_MODULES):
+    '''
+    Imports module in a new interpreter: returns wall time, import time entries and the modules loaded
+    '''
+    script = IMPORT_SCRIPT.format(preloaded_modules=preloaded_modules, marker=TARGET_MARKER, module=module)
+
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = ROOT_DIRECTORY + os.pathsep + environment.get("PYTHONPATH", "")
+    environment.pop("PYTHONDONTWRITEBYTECODE", None) # bytecode compilation is not part of the startup time
+
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", script], capture_output=True, text=True, env=environment)
+
+    if process.returncode != 0:
+        raise Exception("Import of " + module + " failed:\n" + process.stderr.strip().splitlines()[-1])
+
+    output = json.loads(process.stdout.strip().splitlines()[-1])
+
+    return output["time"], parse_import_time(process.stderr), output["loaded"]
+
+def get_deferred_modules_loaded(loaded_modules):
+    return sorted(set([module.split(".")[0] for module in loaded_modules]) & set(DEFERRED_MODULES))
+
+def get_top_imports(entries, n_top):
+    '''
+    Heaviest packages (cumulative time), the add-on modules excluded
+    '''
+    top_level_entries = [entry for entry in entries if not entry[2].startswith("orangecontrib") and not "." in entry[2]]
+
+    return [{"module" : module, "cumulative" : cumulative_time, "self" : self_time}
+            for self_time, cumulative_time, module in sorted(top_level_entries, key=lambda entry: -entry[1])[:n_top]]
+
+def bench_import(module, repeat, n_top):
+    import_module(module) # bytecode compiled, file system cache warm
+
+    times = []
+    for _ in range(repeat):
+        elapsed, entries, loaded_modules = import_module(module)
+        times.append(elapsed)
+
+    return {"benchmark" : "import",
+            "case" : module,
+            "times" : times,
+            "best" : min(times),
+            "median" : float(numpy.median(times)),
+            "n_modules_loaded" : len(loaded_modules),
+            "deferred_modules_loaded" : get_deferred_modules_loaded(loaded_modules),
+            "top_imports" : get_top_imports(entries, n_top)}
+
+###############################################################
+#
+# RESULTS
+#
+###############################################################
+
+def get_environment():
+    from importlib import metadata
+
+    versions = {}
+    for package in VERSIONED_PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+
+    return {"python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "processor" : platform.processor(),
+            "cpu_count" : os.cpu_count(),
+            "versions" : versions}
+
+def get_record_key(record):
+    return (record["benchmark"], record["case"])
+
+def compare(results, baseline, threshold):
+    '''
+    Prints the ratio of the best times to the baseline ones: returns the number of modules slower than threshold
+    '''
+    baseline_records = {get_record_key(record) : record for record in baseline["results"]}
+
+    print("\n%-64s %12s %12s %8s" % ("module", "baseline [s]", "current [s]", "ratio"))
+
+    n_regressions = 0
+    for record in results["results"]:
+        baseline_record = baseline_records.get(get_record_key(record), None)
+
+        if not baseline_record is None:
+            ratio = record["best"]/baseline_record["best"]
+            is_regression = ratio > threshold
+            if is_regression: n_regressions += 1
+
+            print("%-64s %12.4f %12.4f %8.2f%s" % (record["case"], baseline_record["best"], record["best"], ratio, " SLOWER" if is_regression else ""))
+
+    return n_regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default="wiser-import-time.json", help="JSON results file")
+    parser.add_argument("--modules", nargs="+", default=REGISTERED_MODULES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="number of heaviest imports reported per module")
+    parser.add_argument("--check", action="store_true", help="fail if a module loads one of the deferred libraries")
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run")
+    parser.add_argument("--threshold", type=float, default=1.2, help="ratio to the previous best time reported as slower")
+    arguments = parser.parse_args(argv)
+
+    records = []
+    n_failures = 0
+
+    print("%-64s %10s %8s  %s" % ("module", "best [s]", "modules", "deferred libraries loaded"))
+
+    for module in arguments.modules:
+        try:
+            record = bench_import(module, arguments.repeat, arguments.top)
+        except Exception as exception:
+            print("%-64s %s" % (module, str(exception)))
+            n_failures += 1
+            continue
+
+        records.append(record)
+
+        print("%-64s %10.4f %8d  %s" % (module, record["best"], record["n_modules_loaded"], ", ".join(record["deferred_modules_loaded"]) or "-"))
+        for top_import in record["top_imports"]:
+            print("    %-60s %10.4f" % (top_import["module"], top_import["cumulative"]))
+
+    results = {"format" : RESULTS_FORMAT,
+               "created" : time.strftime("%Y-%m-%d %H:%M:%S"),
+               "environment" : get_environment(),
+               "repeat" : arguments.repeat,
+               "preloaded_modules" : PRELOADED_MODULES,
+               "results" : records}
+
+    with open(arguments.output, "w") as file: json.dump(results, file, indent=1)
+
+    print("\nResults saved on " + arguments.output)
+
+    exit_code = 1 if n_failures > 0 else 0
+
+    if arguments.check:
+        eager_modules = [record["case"] for record in records if len(record["deferred_modules_loaded"]) > 0]
+
+        if len(eager_modules) > 0:
+            print("Deferred libraries loaded at registration time by: " + ", ".join(eager_modules))
+
+            exit_code = 1
+
+    if not arguments.compare is None:
+        with open(arguments.compare, "r") as file: baseline = json.load(file)
+
+        n_regressions = compare(results, baseline, arguments.threshold)
+
+        if n_regressions > 0:
+            print(str(n_regressions) + " module(s) slower than " + str(arguments.threshold) + " times the baseline")
+
+            exit_code = 1
+
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+'''
+Slope errors of a height profile: per-sample loop (as formerly in the height profile widgets)
+vs. orangecontrib.OasysWiser.util.wise_profile.slopes
+
+    python benchmarks/bench_profile_statistics.py [--sizes 10000 100000 1000000] [--repeat 3]
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from orangecontrib.OasysWiser.util.wise_profile import slopes, psd, autocovariance
+
+def slopes_loop(xx, yy):
+    ny = yy.size
+    slope = numpy.zeros(ny)
+    for i in range(ny-1):
+        step = xx[i+1] - xx[i]
+        slope[i] = numpy.arctan((yy[i+1] - yy[i]) / step)
+    slope[ny-1] = slope[ny-2]
+
+    return slope
+
+def best_time(function, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - t0)
+
+    return min(times), result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3)
+    arguments = parser.parse_args(argv)
+
+    print("%10s %12s %12s %10s %12s %12s" % ("samples", "loop [s]", "numpy [s]", "speedup", "psd [s]", "acf [s]"))
+
+    for n_samples in arguments.sizes:
+        xx = numpy.arange(n_samples)*1e-6
+        yy = numpy.cumsum(numpy.random.default_rng(n_samples).normal(size=n_samples))*1e-12
+
+        time_loop, slope_loop = best_time(slopes_loop, xx, yy, repeat=1 if n_samples > 100000 else arguments.repeat)
+        time_numpy, slope_numpy = best_time(slopes, xx, yy, repeat=arguments.repeat)
+        time_psd, _ = best_time(psd, xx, yy, repeat=arguments.repeat)
+        time_acf, _ = best_time(autocovariance, xx, yy, repeat=arguments.repeat)
+
+        if not numpy.array_equal(slope_loop, slope_numpy): raise AssertionError("Slopes differ for " + str(n_samples) + " samples")
+
+        print("%10d %12.5f %12.5f %10.1f %12.5f %12.5f" % (n_samples, time_loop, time_numpy, time_loop/time_numpy, time_psd, time_acf))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+'''
+Reference WISEr beamlines, built with the element builders of the widgets (wise_batch) and computed
+without Qt: propagation, best focus sweep and figure error loading, timed across sample counts and
+n_pools. Results are saved as JSON, to be compared between versions of LibWiser/WofryWiser
+
+    python benchmarks/bench_reference_beamlines.py [-o results.json] [--sizes 2000 7000 20000] [--n-pools 1 4]
+    python benchmarks/bench_reference_beamlines.py -o new.json --compare old.json [--threshold 1.1]
+
+Reference beamlines (SI units):
+
+    plane_mirror:         Gaussian source -> plane mirror
+    kb_pair:              Gaussian source -> elliptic mirror -> elliptic mirror -> detector (the 1D
+                          propagation sees the two mirrors in sequence: a timing reference, not an
+                          optical design)
+    elliptic_figure_error: Gaussian source -> elliptic mirror with figure error -> detector
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+
+import numpy
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from LibWiser import Optics
+from LibWiser.Foundation import PositioningDirectives
+
+from orangecontrib.OasysWiser.util.wise_batch import BatchElement, build_beamline, propagate
+from orangecontrib.OasysWiser.util.wise_figure_error import FigureErrorProfile, WiserProfileCache, load_figure_error, save_figure_error
+from orangecontrib.OasysWiser.util.wise_focus import compute_focus_sweep
+
+RESULTS_FORMAT = 1
+
+VERSIONED_PACKAGES = ["OASYS1-WISEr", "LibWiser", "WofryWiser", "wofry", "numpy", "h5py"]
+
+###############################################################
+#
+# REFERENCE BEAMLINES
+#
+###############################################################
+
+DETECTOR_SIZE = 50e-6
+FIGURE_ERROR_RMS = 1e-9
+
+def get_source():
+    return BatchElement("OWGaussianSource1d", {"source_lambda" : 10, # nm
+                                               "source_waist" : 125e-6,
+                                               "XYCentre_checked" : 1})
+
+def get_elliptic_mirror(name, f1, f2, n_samples, figure_error_profile=None, **positioning):
+    settings = {"oe_name" : name,
+                "f1" : f1,
+                "f2" : f2,
+                "alpha" : 2.5,
+                "length" : 0.4,
+                "calculation_type" : 1,
+                "number_of_points" : n_samples,
+                "ReferTo" : PositioningDirectives.ReferTo.Source,
+                "What" : PositioningDirectives.What.UpstreamFocus,
+                "Where" : PositioningDirectives.Where.Centre}
+    settings.update(positioning)
+
+    if not figure_error_profile is None: settings["use_figure_error"] = 1
+
+    return BatchElement("OWEllipticMirror", settings, figure_error_profile=figure_error_profile)
+
+def get_detector(n_samples):
+    return BatchElement("OWDetector", {"oe_name" : "Detector",
+                                       "alpha" : 90.0,
+                                       "length" : DETECTOR_SIZE,
+                                       "calculation_type" : 1,
+                                       "number_of_points" : n_samples,
+                                       "ReferTo" : PositioningDirectives.ReferTo.UpstreamElement,
+                                       "What" : PositioningDirectives.What.Centre,
+                                       "Where" : PositioningDirectives.Where.DownstreamFocus,
+                                       "Distance_checked" : 1,
+                                       "Distance" : 0.0})
+
+def get_figure_error_profile(n_samples, length, seed=0):
+    heights = numpy.cumsum(numpy.random.default_rng(seed).normal(size=n_samples))
+    heights -= numpy.polyval(numpy.polyfit(numpy.arange(n_samples), heights, 1), numpy.arange(n_samples))
+
+    return FigureErrorProfile(heights*FIGURE_ERROR_RMS/numpy.std(heights), step=length/n_samples, provenance={"creator" : "bench_reference_beamlines", "seed" : seed})
+
+def plane_mirror(n_samples):
+    return [get_source(),
+            BatchElement("OWPlaneMirror", {"oe_name" : "Plane Mirror",
+                                           "alpha" : 2.0,
+                                           "length" : 0.4,
+                                           "calculation_type" : 1,
+                                           "number_of_points" : n_samples,
+                                           "ReferTo" : PositioningDirectives.ReferTo.UpstreamElement,
+                                           "Distance_checked" : 1,
+                                           "Distance" : 98.0})]
+
+def kb_pair(n_samples):
+    return [get_source(),
+            get_elliptic_mirror("KB Vertical", 98.0, 1.2, n_samples),
+            get_elliptic_mirror("KB Horizontal", 98.6, 0.6, n_samples,
+                                ReferTo=PositioningDirectives.ReferTo.UpstreamElement,
+                                What=PositioningDirectives.What.Centre,
+                                Where=PositioningDirectives.Where.Centre,
+                                Distance_checked=1,
+                                Distance=0.6),
+            get_detector(n_samples)]
+
+def elliptic_figure_error(n_samples):
+    return [get_source(),
+            get_elliptic_mirror("Elliptic Mirror", 98.0, 1.2, n_samples, figure_error_profile=get_figure_error_profile(n_samples, 0.4)),
+            get_detector(n_samples)]
+
+REFERENCE_BEAMLINES = {"plane_mirror" : plane_mirror,
+                       "kb_pair" : kb_pair,
+                       "elliptic_figure_error" : elliptic_figure_error}
+
+FOCUSSING_BEAMLINES = ["kb_pair", "elliptic_figure_error"]
+
+###############################################################
+#
+# BENCHMARKS
+#
+###############################################################
+
+def measure(function, repeat, setup=None):
+    '''
+    Times of repeat calls of function(*setup()): setup is not timed. Returns times and the last result
+    '''
+    times = []
+    result = None
+    for _ in range(repeat):
+        args = setup() if not setup is None else ()
+
+        t0 = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - t0)
+
+    return times, result
+
+def make_record(benchmark, case, n_samples, n_pools, times, **extra):
+    record = {"benchmark" : benchmark,
+              "case" : case,
+              "n_samples" : int(n_samples),
+              "n_pools" : int(n_pools),
+              "times" : times,
+              "best" : min(times),
+              "median" : float(numpy.median(times))}
+    record.update(extra)
+
+    return record
+
+def bench_propagation(beamline, n_samples, n_pools, repeat):
+    batch_elements = REFERENCE_BEAMLINES[beamline](n_samples)
+
+    times, wiser_data = measure(lambda wiser_data: propagate(wiser_data, n_pools=n_pools), repeat,
+                                setup=lambda: (build_beamline(batch_elements),))
+
+    computation_data = wiser_data.wise_beamline.get_wise_propagation_element(-1).ComputationData
+
+    return make_record("propagation", beamline, n_samples, n_pools, times, n_samples_used=int(computation_data.NSamples))
+
+def bench_best_focus(beamline, n_samples, n_pools, n_defocus, repeat):
+    wiser_data = propagate(build_beamline(REFERENCE_BEAMLINES[beamline](n_samples)), n_pools=n_pools)
+
+    focussing_element = wiser_data.wise_beamline.get_wise_propagation_element(-2) # upstream of the detector
+    defocus_list = numpy.linspace(-5e-3, 5e-3, n_defocus)
+
+    times, result = measure(lambda: compute_focus_sweep(focussing_element, defocus_list, DETECTOR_SIZE, n_pools=n_pools), repeat)
+
+    return make_record("best_focus", beamline, n_samples, n_pools, times, n_defocus=int(n_defocus), best_hew=float(numpy.nanmin(result.hews)))
+
+def bench_figure_error_loading(n_samples, repeat, directory):
+    profile = get_figure_error_profile(n_samples, 0.4)
+
+    text_file = os.path.join(directory, "figure_error_" + str(n_samples) + ".dat")
+    numpy.savetxt(text_file, profile.heights)
+
+    records = []
+
+    times, _ = measure(lambda: load_figure_error(text_file, step=profile.step), repeat)
+    records.append(make_record("figure_error_loading", "text", n_samples, 1, times))
+
+    try:
+        binary_file = os.path.join(directory, "figure_error_" + str(n_samples) + ".h5")
+        save_figure_error(binary_file, profile.heights, profile.step)
+
+        times, _ = measure(lambda: numpy.array(load_figure_error(binary_file).heights), repeat) # memory map read in full
+        records.append(make_record("figure_error_loading", "binary", n_samples, 1, times))
+    except ImportError:
+        print("h5py not available: binary figure error files skipped")
+
+    profile_cache = WiserProfileCache()
+    profile_cache.load(text_file, step=profile.step)
+
+    times, _ = measure(lambda: profile_cache.load(text_file, step=profile.step), repeat)
+    records.append(make_record("figure_error_loading", "cache_hit", n_samples, 1, times))
+
+    mirror = Optics.MirrorElliptic(f1=98.0, f2=1.2, L=0.4, Alpha=numpy.deg2rad(2.5))
+
+    times, _ = measure(lambda: mirror.FigureErrorLoad(h=profile.heights, Step=profile.step, AmplitudeScaling=1.0), repeat)
+    records.append(make_record("figure_error_loading", "figure_error_load", n_samples, 1, times))
+
+    return records
+
+###############################################################
+#
+# RESULTS
+#
+###############################################################
+
+def get_environment():
+    from importlib import metadata
+
+    versions = {}
+    for package in VERSIONED_PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+
+    return {"python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "processor" : platform.processor(),
+            "cpu_count" : os.cpu_count(),
+            "versions" : versions}
+
+def get_record_key(record):
+    return (record["benchmark"], record["case"], record["n_samples"], record["n_pools"])
+
+def compare(results, baseline, threshold):
+    '''
+    Prints the ratio of the best times to the baseline ones: returns the number of cases slower than threshold
+    '''
+    baseline_records = {get_record_key(record) : record for record in baseline["results"]}
+
+    print("\n%-22s %-22s %10s %8s %12s %12s %8s" % ("benchmark", "case", "samples", "pools", "baseline [s]", "current [s]", "ratio"))
+
+    n_regressions = 0
+    for record in results["results"]:
+        baseline_record = baseline_records.get(get_record_key(record), None)
+
+        if not baseline_record is None:
+            ratio = record["best"]/baseline_record["best"]
+            is_regression = ratio > threshold
+            if is_regression: n_regressions += 1
+
+            print("%-22s %-22s %10d %8d %12.5f %12.5f %8.2f%s" % (record["benchmark"], record["case"], record["n_samples"], record["n_pools"],
+                                                                  baseline_record["best"], record["best"], ratio, " SLOWER" if is_regression else ""))
+
+    return n_regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default="wiser-benchmark.json", help="JSON results file")
+    parser.add_argument("--beamlines", nargs="+", default=list(REFERENCE_BEAMLINES.keys()), choices=list(REFERENCE_BEAMLINES.keys()))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 7000, 20000], help="number of samples of each element")
+    parser.add_argument("--n-pools", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--n-defocus", type=int, default=11, help="number of planes of the best focus sweep")
+    parser.add_argument("--profile-sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="number of samples of the figure error files")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip", nargs="+", default=[], choices=["propagation", "best_focus", "figure_error_loading"])
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run")
+    parser.add_argument("--threshold", type=float, default=1.1, help="ratio to the previous best time reported as slower")
+    arguments = parser.parse_args(argv)
+
+    records = []
+
+    def add(record):
+        records.append(record)
+        print("%-22s %-22s %10d %8d %12.5f" % (record["benchmark"], record["case"], record["n_samples"], record["n_pools"], record["best"]))
+
+    print("%-22s %-22s %10s %8s %12s" % ("benchmark", "case", "samples", "pools", "best [s]"))
+
+    for beamline in arguments.beamlines:
+        for n_samples in arguments.sizes:
+            for n_pools in arguments.n_pools:
+                if not "propagation" in arguments.skip:
+                    add(bench_propagation(beamline, n_samples, n_pools, arguments.repeat))
+                if not "best_focus" in arguments.skip and beamline in FOCUSSING_BEAMLINES:
+                    add(bench_best_focus(beamline, n_samples, n_pools, arguments.n_defocus, arguments.repeat))
+
+    if not "figure_error_loading" in arguments.skip:
+        with tempfile.TemporaryDirectory() as directory:
+            for n_samples in arguments.profile_sizes:
+                for record in bench_figure_error_loading(n_samples, arguments.repeat, directory): add(record)
+
+    results = {"format" : RESULTS_FORMAT,
+               "created" : time.strftime("%Y-%m-%d %H:%M:%S"),
+               "environment" : get_environment(),
+               "repeat" : arguments.repeat,
+               "results" : records}
+
+    with open(arguments.output, "w") as file: json.dump(results, file, indent=1)
+
+    print("\nResults saved on " + arguments.output)
+
+    if not arguments.compare is None:
+        with open(arguments.compare, "r") as file: baseline = json.load(file)
+
+        n_regressions = compare(results, baseline, arguments.threshold)
+
+        if n_regressions > 0:
+            print(str(n_regressions) + " case(s) slower than " + str(arguments.threshold) + " times the baseline")
+
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,12 +5,18 @@ from PyQt5.QtGui import QPalette, QColor
 from orangecanvas.scheme.link import SchemeLink
 from oasys.menus.menu import OMenu
 
-from wofry.propagator.propagator import PropagationManager, PropagationMode
-from WofryWiser.propagator.propagator1D.wise_propagator import WISE_APPLICATION
-
 from orangecontrib.OasysWiser.util.wise_util import showWarningMessage, showCriticalMessage
+from orangecontrib.OasysWiser.widgets.gui.ow_wise_widget import initialize_propagator_1D, is_whole_beamline_mode
 from orangecontrib.OasysWiser.widgets.optical_elements.ow_detector import OWDetector
 
+def set_propagation_mode(propagation_mode_name):
+    from wofry.propagator.propagator import PropagationManager, PropagationMode
+    from WofryWiser.propagator.propagator1D.wise_propagator import WISE_APPLICATION
+
+    initialize_propagator_1D()
+
+    PropagationManager.Instance().set_propagation_mode(WISE_APPLICATION, getattr(PropagationMode, propagation_mode_name))
+
 class WiseToolsMenu(OMenu):
 
     def __init__(self):
@@ -22,11 +28,11 @@ class WiseToolsMenu(OMenu):
         self.addSubMenu("Whole beamline at Detector")
         self.closeContainer()
 
-        PropagationManager.Instance().set_propagation_mode(WISE_APPLICATION, PropagationMode.STEP_BY_STEP)
+        # the propagators start in Element by Element mode, when the first WISEr widget is created (initialize_propagator_1D)
 
     def executeAction_1(self, action):
         try:
-            PropagationManager.Instance().set_propagation_mode(WISE_APPLICATION, PropagationMode.STEP_BY_STEP)
+            set_propagation_mode("STEP_BY_STEP")
             showWarningMessage("Propagation Mode: Element by Element")
 
             self.set_wise_live_propagation_mode()
@@ -35,7 +41,7 @@ class WiseToolsMenu(OMenu):
 
     def executeAction_2(self, action):
         try:
-            PropagationManager.Instance().set_propagation_mode(WISE_APPLICATION, PropagationMode.WHOLE_BEAMLINE)
+            set_propagation_mode("WHOLE_BEAMLINE")
             showWarningMessage("Propagation Mode: Whole beamline at Detector")
 
             self.set_wise_live_propagation_mode()
@@ -49,7 +55,7 @@ class WiseToolsMenu(OMenu):
 
             if hasattr(widget, "wise_live_propagation_mode"):
                 widget.set_wise_live_propagation_mode()
-                if not isinstance(widget, OWDetector) and (PropagationManager.Instance().get_propagation_mode(WISE_APPLICATION) == PropagationMode.WHOLE_BEAMLINE):
+                if not isinstance(widget, OWDetector) and is_whole_beamline_mode():
                     widget.view_type = 0
                     widget.set_ViewType()
 
@@ -0,0 +1,449 @@
+'''
+Headless WISEr: builds the beamline of a chain of WISEr widgets from their settings (or from a saved
+.ows scheme) and propagates it without PyQt.
+
+From the command line:
+
+    wiser-batch scheme.ows -o result.h5 [--n-pools 4] [--set "Elliptic Mirror.f2=1.21"]
+    wiser-batch beamline.json -o result.h5
+
+A .json beamline is a list of {"widget" : <widget class name>, "settings" : {<setting> : <value>}}
+'''
+import os
+import ast
+import sys
+import json
+import base64
+import pickle
+import argparse
+import xml.etree.ElementTree as ElementTree
+
+import numpy
+
+from orangecontrib.OasysWiser.util import wise_positioning
+from orangecontrib.OasysWiser.util.wise_objects import WiserData
+from orangecontrib.OasysWiser.util.wise_cache import fingerprint
+from orangecontrib.OasysWiser.util.wise_figure_error import WiserProfileCache
+from orangecontrib.OasysWiser.util.wise_sampling import DEFAULT_PHASE_TOLERANCE
+
+###############################################################
+#
+# WIDGET SETTINGS -> LIBWISER ELEMENTS
+#
+# LibWiser and WofryWiser are imported by the builders: this
+# module is imported when the widgets are registered
+#
+###############################################################
+
+POSITIONING_DEFAULTS = {"ReferTo" : wise_positioning.ReferTo.AbsoluteReference,
+                        "What" : wise_positioning.What.Centre,
+                        "Where" : wise_positioning.Where.Centre,
+                        "Distance" : 0.0,
+                        "XCentre" : 0.0,
+                        "YCentre" : 0.0,
+                        "Distance_checked" : 0,
+                        "XYCentre_checked" : 0}
+
+OPTICAL_ELEMENT_DEFAULTS = dict(POSITIONING_DEFAULTS, **{"oe_name" : "Optical Element",
+                                                         "alpha" : 2.0,
+                                                         "length" : 400.0,
+                                                         "ignore" : False,
+                                                         "use_small_displacements" : 0,
+                                                         "rotation" : 0.0,
+                                                         "transverse" : 0.0,
+                                                         "longitudinal" : 0.0,
+                                                         "use_figure_error" : 0,
+                                                         "figure_error_file" : "figure_error.dat",
+                                                         "figure_error_step" : 0.002,
+                                                         "figure_error_amplitude_scaling" : 1.0,
+                                                         "figure_error_um_conversion" : 1.0,
+                                                         "calculation_type" : 0,
+                                                         "number_of_points" : 7000,
+                                                         "phase_tolerance" : DEFAULT_PHASE_TOLERANCE})
+
+SOURCE_DEFAULTS = dict(POSITIONING_DEFAULTS, **{"source_name" : "Gaussian Source",
+                                                "source_lambda" : 10,
+                                                "source_waist" : 125e-3})
+
+def get_positioning_directives(settings, workspace_units_to_m=1.0):
+    from LibWiser.Foundation import PositioningDirectives
+
+    return PositioningDirectives(PlaceWhat=settings["What"],
+                                 PlaceWhere=settings["Where"],
+                                 ReferTo=settings["ReferTo"],
+                                 XYCentre=None if settings["XYCentre_checked"] == 0 else [settings["XCentre"]*workspace_units_to_m, settings["YCentre"]*workspace_units_to_m],
+                                 Distance=None if settings["Distance_checked"] == 0 else settings["Distance"]*workspace_units_to_m)
+
+def configure_optical_element(native_optical_element, settings, workspace_units_to_m=1.0, figure_error_profile=None):
+    '''
+    Computation settings of the optical element, as set by OWOpticalElement. The figure error
+    profile, if given, replaces the figure error file
+    '''
+    native_optical_element.CoreOptics.ComputationSettings.Ignore = (settings["ignore"] == 1)
+
+    if settings["use_small_displacements"] == 1:
+        native_optical_element.CoreOptics.ComputationSettings.UseSmallDisplacements = True # serve per traslare/ruotare l'EO
+        native_optical_element.CoreOptics.SmallDisplacements.Rotation = numpy.deg2rad(settings["rotation"])
+        native_optical_element.CoreOptics.SmallDisplacements.Trans = settings["transverse"]*workspace_units_to_m # Transverse displacement (rispetto al raggio uscente, magari faremo scegliere)
+        native_optical_element.CoreOptics.SmallDisplacements.Long = settings["longitudinal"]*workspace_units_to_m # Longitudinal displacement (idem)
+    else:
+        native_optical_element.CoreOptics.ComputationSettings.UseSmallDisplacements = False
+        native_optical_element.CoreOptics.SmallDisplacements.Rotation = 0.0
+        native_optical_element.CoreOptics.SmallDisplacements.Trans = 0.0
+        native_optical_element.CoreOptics.SmallDisplacements.Long = 0.0
+
+    if settings["use_figure_error"] == 1:
+        native_optical_element.CoreOptics.ComputationSettings.UseFigureError = True
+
+        if figure_error_profile is None:
+            # the file is parsed once, as long as it does not change
+            figure_error = WiserProfileCache.Instance().load(settings["figure_error_file"],
+                                                             step=settings["figure_error_step"] * workspace_units_to_m, # passo del file (text files only)
+                                                             height_units_to_m=settings["figure_error_um_conversion"],
+                                                             amplitude_scaling=settings["figure_error_amplitude_scaling"])
+            amplitude_scaling = 1.0
+        else:
+            figure_error = figure_error_profile
+            amplitude_scaling = settings["figure_error_amplitude_scaling"] * figure_error.amplitude_scaling
+
+        native_optical_element.CoreOptics.FigureErrorLoad(h = figure_error.heights,
+                                                          Step = figure_error.step,
+                                                          AmplitudeScaling = amplitude_scaling # fattore di scala
+                                                          )
+    else:
+        native_optical_element.CoreOptics.ComputationSettings.UseFigureError = False
+
+    native_optical_element.CoreOptics.ComputationSettings.UseRoughness = False # roughness not yet supported
+
+    if settings["calculation_type"] == 1:
+        # l'utente decide di impostare a mano il campionamento
+        native_optical_element.ComputationSettings.UseCustomSampling = True
+        native_optical_element.ComputationSettings.NSamples = settings["number_of_points"]
+    else:
+        native_optical_element.ComputationSettings.UseCustomSampling = False # sampling budget is set when the beamline is complete
+
+def build_gaussian_source(settings, workspace_units_to_m=1.0):
+    from LibWiser import Optics
+    from WofryWiser.beamline.beamline_elements import WiserOpticalElement
+
+    positioning_directives = get_positioning_directives(settings, workspace_units_to_m)
+    positioning_directives.WhichAngle = Optics.TypeOfAngle.SelfFrameOfReference
+    positioning_directives.Angle = 0.0
+
+    return WiserOpticalElement(name=settings["source_name"],
+                               boundary_shape=None,
+                               native_CoreOptics=Optics.SourceGaussian(settings["source_lambda"]*1e-9, settings["source_waist"]*workspace_units_to_m),
+                               native_PositioningDirectives=positioning_directives,
+                               isSource=True)
+
+def build_plane_mirror(settings, workspace_units_to_m=1.0):
+    from LibWiser import Optics
+
+    return Optics.MirrorPlane(L=settings["length"]*workspace_units_to_m,
+                              AngleGrazing = numpy.deg2rad(settings["alpha"]))
+
+def build_elliptic_mirror(settings, workspace_units_to_m=1.0):
+    from LibWiser import Optics
+
+    return Optics.MirrorElliptic(f1=settings["f1"]*workspace_units_to_m,
+                                 f2=settings["f2"]*workspace_units_to_m,
+                                 L=settings["length"]*workspace_units_to_m,
+                                 Alpha = numpy.deg2rad(settings["alpha"]))
+
+def build_detector(settings, workspace_units_to_m=1.0):
+    from LibWiser import Optics
+
+    return Optics.Detector(L=settings["length"]*workspace_units_to_m,
+                           AngleGrazing = numpy.deg2rad(settings["alpha"]))
+
+# widget class name -> (defaults, builder of the optical element, builder is for the LibWiser optics only)
+ELEMENT_BUILDERS = {"OWGaussianSource1d" : (SOURCE_DEFAULTS, build_gaussian_source, False),
+                    "OWPlaneMirror" : (OPTICAL_ELEMENT_DEFAULTS, build_plane_mirror, True),
+                    "OWEllipticMirror" : (dict(OPTICAL_ELEMENT_DEFAULTS, f1=98.0, f2=1.2), build_elliptic_mirror, True),
+                    "OWDetector" : (OPTICAL_ELEMENT_DEFAULTS, build_detector, True)}
+
+class BatchElement(object):
+
+    def __init__(self, widget, settings=None, title=None, figure_error_profile=None):
+        if not widget in ELEMENT_BUILDERS: raise ValueError("Widget not supported in batch mode: " + str(widget))
+
+        self.widget = widget
+        self.settings = dict(ELEMENT_BUILDERS[widget][0], **({} if settings is None else settings))
+        self.title = widget if title is None else title
+        self.figure_error_profile = figure_error_profile
+
+    def get_name(self):
+        return self.settings.get("oe_name", self.settings.get("source_name", self.title))
+
+    def build(self, workspace_units_to_m=1.0):
+        _, builder, is_core_optics = ELEMENT_BUILDERS[self.widget]
+
+        if not is_core_optics: return builder(self.settings, workspace_units_to_m)
+
+        from WofryWiser.beamline.beamline_elements import WiserOpticalElement
+
+        optical_element = WiserOpticalElement(name=self.settings["oe_name"],
+                                              boundary_shape=None,
+                                              native_CoreOptics=builder(self.settings, workspace_units_to_m),
+                                              native_PositioningDirectives=get_positioning_directives(self.settings, workspace_units_to_m))
+
+        configure_optical_element(optical_element.native_optical_element, self.settings, workspace_units_to_m, self.figure_error_profile)
+
+        return optical_element
+
+class DeferredElement(object):
+    '''
+    Optical element of an intermediate widget in Whole Beamline mode: the settings are kept and the
+    element is built only when the beamline is propagated (build_deferred_elements)
+    '''
+    def __init__(self, batch_element, workspace_units_to_m=1.0):
+        self.batch_element = batch_element
+        self.workspace_units_to_m = workspace_units_to_m
+
+    def get_name(self):
+        return self.batch_element.get_name()
+
+    def build(self):
+        return self.batch_element.build(self.workspace_units_to_m)
+
+def build_deferred_elements(wiser_data, optical_element=None):
+    '''
+    Writable duplicate of wiser_data with its deferred elements built and appended to the beamline
+    (fields not computed), followed by optical_element if given: the element keys are the ones given
+    when they were deferred
+    '''
+    from WofryWiser.propagator.propagator1D.wise_propagator import WisePropagationElements
+    from WofryWiser.beamline.beamline_elements import WiserBeamlineElement
+
+    built_data = wiser_data.duplicate(writable=True)
+    deferred_elements = built_data.deferred_elements
+    built_data.deferred_elements = []
+
+    if built_data.wise_beamline is None: built_data.wise_beamline = WisePropagationElements()
+
+    n_built = built_data.get_elements_number()
+
+    for deferred_element in deferred_elements:
+        built_data.wise_beamline.add_beamline_element(WiserBeamlineElement(optical_element=deferred_element.build()))
+
+    if not optical_element is None: built_data.wise_beamline.add_beamline_element(WiserBeamlineElement(optical_element=optical_element))
+
+    apply_sampling_budgets(built_data, [deferred_element.batch_element.settings for deferred_element in deferred_elements], n_built)
+
+    return built_data
+
+def build_beamline(batch_elements, workspace_units_to_m=1.0):
+    from WofryWiser.propagator.propagator1D.wise_propagator import WisePropagationElements
+    from WofryWiser.beamline.beamline_elements import WiserBeamlineElement
+
+    wiser_data = WiserData(wise_beamline=WisePropagationElements(), wise_wavefront=None)
+
+    for batch_element in batch_elements:
+        optical_element = batch_element.build(workspace_units_to_m)
+
+        wiser_data.wise_beamline.add_beamline_element(WiserBeamlineElement(optical_element=optical_element))
+        wiser_data.add_element_key(fingerprint(wiser_data.element_keys[-1] if len(wiser_data.element_keys) > 0 else None,
+                                               batch_element.widget, sorted(batch_element.settings.items()), workspace_units_to_m))
+
+    apply_sampling_budgets(wiser_data, [batch_element.settings for batch_element in batch_elements])
+
+    return wiser_data
+
+def apply_sampling_budgets(wiser_data, settings_list, first_index=0):
+    '''
+    Sampling budget of the elements from first_index, with settings in settings_list, once the
+    downstream elements are in the beamline (the sampling of an element depends on its next child)
+    '''
+    for index, settings in enumerate(settings_list):
+        if settings.get("calculation_type", 0) == 2: apply_sampling_budget(wiser_data, settings["phase_tolerance"], first_index + index)
+
+def apply_sampling_budget(wiser_data, phase_tolerance, index=-1):
+    from orangecontrib.OasysWiser.util.wise_sampling import is_sampling_inherited, get_budget_samples
+
+    wise_propagation_elements = wiser_data.wise_beamline.get_wise_propagation_elements()
+    wise_propagation_elements.RefreshPositions()
+
+    native_optical_element = wiser_data.wise_beamline.get_wise_propagation_element(index)
+
+    if is_sampling_inherited(native_optical_element):
+        print("Sampling Budget not applied to " + native_optical_element.Name + ": LibWiser keeps the Number of Points of the numeric field upstream")
+    else:
+        n_samples = get_budget_samples(native_optical_element, wise_propagation_elements.Lambda, phase_tolerance)
+
+        if n_samples is None:
+            print("Sampling Budget needs the element downstream of " + native_optical_element.Name + ": Automatic Number of Points used")
+        else:
+            native_optical_element.ComputationSettings.UseCustomSampling = True
+            native_optical_element.ComputationSettings.NSamples = n_samples
+
+def propagate(wiser_data, n_pools=1):
+    '''
+    Full propagation of the beamline, from the source to the last element
+    '''
+    from WofryWiser.propagator.wavefront1D.wise_wavefront import WiseWavefront
+
+    wise_propagation_elements = wiser_data.wise_beamline.get_wise_propagation_elements()
+    wise_propagation_elements.ComputationSettings.NPools = n_pools
+    wise_propagation_elements.RefreshPositions()
+    wise_propagation_elements.ComputeFields(Verbose=False)
+
+    wiser_data.wise_wavefront = WiseWavefront(wise_computation_results=wiser_data.wise_beamline.get_wise_propagation_element(-1).ComputationData)
+
+    return wiser_data
+
+###############################################################
+#
+# RESULTS
+#
+###############################################################
+
+def save_results(file_name, wiser_data, compressed=False):
+    import h5py
+
+    options = {"compression" : "gzip", "compression_opts" : 4, "shuffle" : True} if compressed else {}
+
+    with h5py.File(file_name, "w") as file:
+        file.attrs["creator"] = "OASYS-WISEr Batch"
+
+        for index in range(wiser_data.get_elements_number()):
+            native_optical_element = wiser_data.wise_beamline.get_wise_propagation_element(index)
+            computation_data = native_optical_element.ComputationData
+
+            group = file.create_group("elements/" + str(index).zfill(3))
+            group.attrs["name"] = str(native_optical_element.Name)
+
+            if not computation_data is None and not computation_data.Field is None:
+                group.attrs["n_samples"] = int(computation_data.NSamples)
+
+                for dataset_name in ["S", "X", "Y", "Field"]:
+                    data = getattr(computation_data, dataset_name, None)
+                    if not data is None: group.create_dataset(dataset_name, data=numpy.asarray(data), **options)
+
+###############################################################
+#
+# SAVED SCHEMES
+#
+###############################################################
+
+WORKSPACE_UNITS_TO_M = {0 : 1.0, 1 : 0.01, 2 : 0.001} # OASYS workspace units: m, cm, mm
+
+def load_ows_scheme(file_name):
+    '''
+    Returns the WISEr widgets chained through their WiserData links in the .ows scheme,
+    as BatchElement list from the source, and the workspace units to m factor
+    '''
+    root = ElementTree.parse(file_name).getroot()
+
+    workspace_units_to_m = WORKSPACE_UNITS_TO_M.get(int(root.get("workspace_units", 0)), 1.0)
+
+    nodes = {}
+    for node in root.iter("node"):
+        widget = node.get("qualified_name", "").split(".")[-1]
+        if widget in ELEMENT_BUILDERS: nodes[node.get("id")] = (widget, node.get("title", widget))
+
+    properties = {}
+    for node_properties in root.iter("properties"):
+        if node_properties.get("node_id") in nodes:
+            properties[node_properties.get("node_id")] = _read_properties(node_properties)
+
+    downstream = {}
+    upstream = set()
+    for link in root.iter("link"):
+        source, sink = link.get("source_node_id"), link.get("sink_node_id")
+        if source in nodes and sink in nodes and link.get("sink_channel") == "Input" and link.get("enabled", "true") == "true":
+            downstream.setdefault(source, []).append(sink)
+            upstream.add(sink)
+
+    sources = [node_id for node_id in nodes if not node_id in upstream and node_id in downstream]
+    if len(sources) != 1: raise ValueError("The scheme must contain one chain of WISEr widgets, found " + str(len(sources)))
+
+    batch_elements = []
+    node_id = sources[0]
+    while not node_id is None:
+        widget, title = nodes[node_id]
+        batch_elements.append(BatchElement(widget, properties.get(node_id, {}), title))
+
+        sinks = downstream.get(node_id, [])
+        if len(sinks) > 1: print("Branching at " + title + ": only the first branch is computed")
+        node_id = sinks[0] if len(sinks) > 0 else None
+
+    return batch_elements, workspace_units_to_m
+
+def _read_properties(node_properties):
+    data = node_properties.text.strip() if not node_properties.text is None else ""
+
+    if node_properties.get("format") == "pickle":
+        settings = pickle.loads(base64.b64decode(data))
+    elif node_properties.get("format") == "literal":
+        settings = ast.literal_eval(data)
+    else:
+        raise ValueError("Unknown format of the widget settings: " + str(node_properties.get("format")))
+
+    return {key : value for key, value in settings.items() if not key.startswith("__") and not key == "savedWidgetGeometry"}
+
+def load_json_beamline(file_name):
+    with open(file_name, "r") as file: description = json.load(file)
+
+    if isinstance(description, dict):
+        elements, workspace_units_to_m = description["elements"], description.get("workspace_units_to_m", 1.0)
+    else:
+        elements, workspace_units_to_m = description, 1.0
+
+    return [BatchElement(element["widget"], element.get("settings", {}), element.get("title", None)) for element in elements], workspace_units_to_m
+
+def load_beamline_description(file_name):
+    if file_name.endswith(".json"): return load_json_beamline(file_name)
+    else: return load_ows_scheme(file_name)
+
+def set_setting(batch_elements, assignment):
+    '''
+    assignment: "<element>.<setting>=<value>", with element being the title, the name or the index of the element
+    '''
+    target, value = assignment.split("=", 1)
+    element_id, setting = target.rsplit(".", 1)
+
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass # string
+
+    for index, batch_element in enumerate(batch_elements):
+        if element_id in (batch_element.title, batch_element.get_name(), str(index)):
+            if not setting in batch_element.settings: raise ValueError("Unknown setting " + setting + " for " + element_id)
+            batch_element.settings[setting] = value
+
+            return
+
+    raise ValueError("Element not found: " + element_id)
+
+###############################################################
+#
+# COMMAND LINE
+#
+###############################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Propagates a WISEr beamline without OASYS")
+    parser.add_argument("beamline", help="saved OASYS scheme (.ows) or beamline description (.json)")
+    parser.add_argument("-o", "--output", default=None, help="output HDF5 file (default: <beamline>.h5)")
+    parser.add_argument("--n-pools", type=int, default=1, help="number of parallel processes for each propagation")
+    parser.add_argument("--set", action="append", default=[], metavar="ELEMENT.SETTING=VALUE", help="changes a setting of an element (repeatable)")
+    parser.add_argument("--compress", action="store_true", help="gzip compression of the output datasets")
+
+    arguments = parser.parse_args(argv)
+
+    batch_elements, workspace_units_to_m = load_beamline_description(arguments.beamline)
+
+    for assignment in arguments.set: set_setting(batch_elements, assignment)
+
+    wiser_data = propagate(build_beamline(batch_elements, workspace_units_to_m), n_pools=arguments.n_pools)
+
+    output = arguments.output if not arguments.output is None else os.path.splitext(arguments.beamline)[0] + ".h5"
+    save_results(output, wiser_data, compressed=arguments.compress)
+
+    print("Beamline " + " -> ".join([batch_element.get_name() for batch_element in batch_elements]) + " propagated, results saved on " + output)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
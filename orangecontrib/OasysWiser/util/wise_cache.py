@@ -0,0 +1,379 @@
+import os
+import hmac
+import enum
+import stat
+import pickle
+import types
+import secrets
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy
+
+###############################################################
+#
+# CONTENT FINGERPRINTS
+#
+###############################################################
+
+# attributes changing at every computation without changing its content
+VOLATILE_ATTRIBUTES = ("ComputationTime", "_TotalComputationTimeMinutes")
+
+def fingerprint(*objects):
+    hasher = hashlib.sha1()
+    memo = {}
+    for obj in objects: _update_fingerprint(hasher, obj, memo)
+
+    return hasher.hexdigest()
+
+def _update_fingerprint(hasher, obj, memo):
+    if obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        hasher.update((type(obj).__name__ + ":" + repr(obj) + ";").encode("utf-8"))
+    elif isinstance(obj, bytes):
+        hasher.update(b"bytes:" + obj + b";")
+    elif isinstance(obj, numpy.ndarray):
+        hasher.update(("ndarray:" + obj.dtype.str + str(obj.shape) + ";").encode("utf-8"))
+        if obj.dtype.hasobject:
+            for item in obj.flat: _update_fingerprint(hasher, item, memo)
+        else:
+            hasher.update(numpy.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, numpy.generic):
+        _update_fingerprint(hasher, obj.item(), memo)
+    elif isinstance(obj, enum.Enum):
+        hasher.update(("enum:" + type(obj).__qualname__ + "." + obj.name + ";").encode("utf-8"))
+    elif isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType, types.MethodType)):
+        hasher.update(("type:" + getattr(obj, "__module__", "") + "." + getattr(obj, "__qualname__", repr(obj)) + ";").encode("utf-8"))
+    elif id(obj) in memo:
+        hasher.update(("ref:" + str(memo[id(obj)][0]) + ";").encode("utf-8")) # cycles (e.g. Parent/Children links)
+    else:
+        memo[id(obj)] = (len(memo), obj) # keeps obj alive, so that its id is not reused
+
+        if isinstance(obj, (list, tuple)):
+            hasher.update((type(obj).__name__ + "[" + str(len(obj)) + "];").encode("utf-8"))
+            for item in obj: _update_fingerprint(hasher, item, memo)
+        elif isinstance(obj, (set, frozenset)):
+            hasher.update(("set[" + str(len(obj)) + "];").encode("utf-8"))
+            for item in sorted(obj, key=repr): _update_fingerprint(hasher, item, memo)
+        elif isinstance(obj, dict):
+            hasher.update(("dict[" + str(len(obj)) + "];").encode("utf-8"))
+            for key in sorted(obj.keys(), key=repr):
+                if key in VOLATILE_ATTRIBUTES: continue
+                _update_fingerprint(hasher, key, memo)
+                _update_fingerprint(hasher, obj[key], memo)
+        else:
+            hasher.update(("object:" + type(obj).__module__ + "." + type(obj).__qualname__ + ";").encode("utf-8"))
+
+            if hasattr(obj, "__dict__"):
+                _update_fingerprint(hasher, vars(obj), memo)
+            elif hasattr(obj, "__slots__"):
+                _update_fingerprint(hasher, {slot: getattr(obj, slot, None) for slot in obj.__slots__}, memo)
+            else:
+                hasher.update((repr(obj) + ";").encode("utf-8"))
+
+def collect_arrays(obj):
+    arrays = {}
+    _collect_arrays(obj, arrays, set())
+
+    return arrays
+
+def estimate_nbytes(obj):
+    return sum([array.nbytes for array in collect_arrays(obj).values()])
+
+def _collect_arrays(obj, arrays, visited):
+    if isinstance(obj, numpy.ndarray):
+        arrays[id(obj)] = obj
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, type, numpy.generic)):
+        pass
+    elif id(obj) not in visited:
+        visited.add(id(obj))
+
+        if isinstance(obj, (list, tuple, set, frozenset)):
+            for item in obj: _collect_arrays(item, arrays, visited)
+        elif isinstance(obj, dict):
+            for item in obj.values(): _collect_arrays(item, arrays, visited)
+        elif hasattr(obj, "__dict__"):
+            _collect_arrays(vars(obj), arrays, visited)
+
+###############################################################
+#
+# LRU CACHE WITH MEMORY BUDGET
+#
+###############################################################
+
+MB_TO_BYTES = 1024*1024
+
+class WiserLRUCache(object):
+
+    DEFAULT_MEMORY_BUDGET = 1024 # MB
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        super().__init__()
+
+        self._entries = OrderedDict()
+        self._memory_used = 0
+        self._memory_budget = int(memory_budget*MB_TO_BYTES)
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+                return self._entries[key][0]
+            else:
+                self.misses += 1
+
+                return default
+
+    def put(self, key, value, nbytes=None):
+        if nbytes is None: nbytes = estimate_nbytes(value)
+
+        with self._lock:
+            self.remove(key)
+
+            if nbytes <= self._memory_budget:
+                self._entries[key] = (value, nbytes)
+                self._memory_used += nbytes
+
+                self._evict()
+
+    def remove(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._memory_used -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_used = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get_memory_used(self):
+        return self._memory_used/MB_TO_BYTES
+
+    def get_memory_budget(self):
+        return self._memory_budget/MB_TO_BYTES
+
+    def set_memory_budget(self, memory_budget):
+        with self._lock:
+            self._memory_budget = int(memory_budget*MB_TO_BYTES)
+
+            self._evict()
+
+    def _evict(self):
+        while self._memory_used > self._memory_budget and len(self._entries) > 0:
+            self._memory_used -= self._entries.popitem(last=False)[1][1]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+class WiserResultCache(WiserLRUCache):
+
+    __instance = None
+
+    @classmethod
+    def Instance(cls):
+        if cls.__instance is None: cls.__instance = WiserResultCache()
+
+        return cls.__instance
+
+###############################################################
+#
+# PERSISTENT CACHE: one pickle file per entry, evicted by last
+# access time when the size cap is exceeded.
+#
+# Unpickling runs code: entries are signed with a key private to
+# the user (HMAC-SHA256) and checked before being unpickled, and
+# directories writable by other users are not used
+#
+###############################################################
+
+class WiserDiskCache(object):
+
+    DEFAULT_SIZE_CAP = 2048 # MB
+    DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".oasys", "wiser_cache")
+    DEFAULT_KEY_FILE = os.path.join(os.path.expanduser("~"), ".oasys", "wiser_cache.key")
+    FILE_EXTENSION = ".wcache"
+    SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+    __instance = None
+
+    @classmethod
+    def Instance(cls):
+        if cls.__instance is None: cls.__instance = WiserDiskCache()
+
+        return cls.__instance
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, size_cap=DEFAULT_SIZE_CAP, key_file=DEFAULT_KEY_FILE):
+        super().__init__()
+
+        self._directory = directory
+        self._size_cap = int(size_cap*MB_TO_BYTES)
+        self._key_file = key_file
+        self._key = None
+        self._lock = threading.RLock()
+
+    def get_directory(self):
+        return self._directory
+
+    def set_directory(self, directory):
+        self._directory = self.DEFAULT_DIRECTORY if directory is None or directory.strip() == "" else directory
+
+    def get_size_cap(self):
+        return self._size_cap/MB_TO_BYTES
+
+    def set_size_cap(self, size_cap):
+        with self._lock:
+            self._size_cap = int(size_cap*MB_TO_BYTES)
+
+            self._evict()
+
+    @classmethod
+    def is_private_directory(cls, directory):
+        '''
+        True if directory (or, if it does not exist yet, its first existing parent) belongs to the
+        user and cannot be written by other users
+        '''
+        directory = os.path.abspath(directory)
+        while not os.path.exists(directory) and os.path.dirname(directory) != directory: directory = os.path.dirname(directory)
+
+        if not hasattr(os, "getuid"): return True # Windows: access is controlled by ACLs, not by the mode bits
+
+        directory_stat = os.stat(directory)
+
+        return directory_stat.st_uid == os.getuid() and not directory_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    def get(self, key, default=None):
+        path = self._get_path(key)
+
+        with self._lock:
+            if not self._check_directory(): return default
+
+            try:
+                with open(path, "rb") as file: data = file.read()
+
+                signature, payload = data[:self.SIGNATURE_SIZE], data[self.SIGNATURE_SIZE:]
+
+                if not hmac.compare_digest(signature, self._sign(payload)): raise ValueError("invalid signature")
+
+                value = pickle.loads(payload) # only entries written by this user
+
+                os.utime(path) # last access, for LRU eviction
+
+                return value
+            except FileNotFoundError:
+                return default
+            except Exception as exception:
+                print("Corrupted cache entry " + path + " removed: " + str(exception))
+
+                self._remove_file(path)
+
+                return default
+
+    def put(self, key, value):
+        path = self._get_path(key)
+
+        with self._lock:
+            if not self._check_directory(): return
+
+            os.makedirs(self._directory, mode=0o700, exist_ok=True)
+
+            temporary_path = path + "." + str(os.getpid()) + ".tmp"
+            try:
+                payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+                with open(temporary_path, "wb") as file:
+                    file.write(self._sign(payload))
+                    file.write(payload)
+
+                os.replace(temporary_path, path) # atomic: other OASYS sessions never read partial entries
+            except Exception as exception:
+                print("Result cannot be stored in cache: " + str(exception))
+
+                self._remove_file(temporary_path)
+            else:
+                self._evict()
+
+    def remove(self, key):
+        with self._lock:
+            self._remove_file(self._get_path(key))
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in self._list_entries(): self._remove_file(path)
+
+    def get_size_used(self):
+        return sum([size for _, size, _ in self._list_entries()])/MB_TO_BYTES
+
+    def __contains__(self, key):
+        return os.path.exists(self._get_path(key))
+
+    def _check_directory(self):
+        if self.is_private_directory(self._directory): return True
+
+        print("Disk cache not used: " + self._directory + " can be written by other users")
+
+        return False
+
+    def _sign(self, payload):
+        return hmac.new(self._get_key(), payload, hashlib.sha256).digest()
+
+    def _get_key(self):
+        if self._key is None:
+            try:
+                with open(self._key_file, "rb") as file: self._key = file.read()
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(self._key_file), mode=0o700, exist_ok=True)
+
+                key = secrets.token_bytes(32)
+                try:
+                    with os.fdopen(os.open(self._key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as file: file.write(key)
+                    self._key = key
+                except FileExistsError: # created meanwhile by another OASYS session
+                    with open(self._key_file, "rb") as file: self._key = file.read()
+
+        return self._key
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, str(key) + self.FILE_EXTENSION)
+
+    def _list_entries(self):
+        entries = []
+
+        if os.path.isdir(self._directory):
+            for file_name in os.listdir(self._directory):
+                if file_name.endswith(self.FILE_EXTENSION):
+                    path = os.path.join(self._directory, file_name)
+                    try:
+                        stat = os.stat(path)
+                        entries.append((path, stat.st_size, stat.st_mtime))
+                    except FileNotFoundError:
+                        pass
+
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._list_entries(), key=lambda entry: entry[2])
+        size_used = sum([size for _, size, _ in entries])
+
+        for path, size, _ in entries:
+            if size_used <= self._size_cap: break
+
+            self._remove_file(path)
+            size_used -= size
+
+    @classmethod
+    def _remove_file(cls, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
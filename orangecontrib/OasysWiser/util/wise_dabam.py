@@ -0,0 +1,382 @@
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+from orangecontrib.OasysWiser.util.wise_profile import autocovariance
+from orangecontrib.OasysWiser.util.wise_task import report_progress, check_cancelled
+
+###############################################################
+#
+# LOCAL DABAM STORE: copy of the DABAM files (dabam-NNN.txt
+# metadata, dabam-NNN.dat data) in a directory, with an index
+# (dabam-index.json) of the quantities used by the search, so
+# that no access to the remote DABAM repository is needed.
+# The statistics of each profile (PSD, CSD, power law fit, ACF)
+# can be precomputed in dabam-NNN-statistics.npz
+#
+###############################################################
+
+INDEX_FILE_NAME = "dabam-index.json"
+INDEX_VERSION = 2 # 2: statistics_version in the records
+STATISTICS_FILE_NAME = "dabam-%03d-statistics.npz"
+STATISTICS_VERSION = 2 # 2: correlation length at 1/e, as in DABAM
+
+INDEX_COLUMNS = ["length", "hgt_err", "slp_err", "correlation_length", "psd_beta"]
+STATISTICS_COLUMNS = ["correlation_length", "psd_beta"]
+
+SURFACE_SHAPES = {1 : "Plane", 2 : "Cylindrical", 3 : "Elliptical", 4 : "Toroidal", 5 : "Spherical"}
+
+DABAM_FILE_NAME = re.compile(r"^dabam-(\d+)\.txt$")
+
+def get_surface_shape(surface):
+    # as dabam.dabam_summary_dictionary_from_json_indexation
+    if surface is None: return None
+    elif isinstance(surface, str): return surface.capitalize()
+    else: return SURFACE_SHAPES.get(int(surface), "Unknown")
+
+def find_dabam_entries(directory):
+    entries = []
+
+    for file_name in os.listdir(directory):
+        match = DABAM_FILE_NAME.match(file_name)
+
+        if not match is None and os.path.exists(os.path.join(directory, file_name[:-4] + ".dat")): entries.append(int(match.group(1)))
+
+    return sorted(entries)
+
+def load_dabam_profile(directory, entry):
+    '''
+    dabam.dabam instance with the profile of entry loaded from the local files in directory
+    '''
+    from srxraylib.metrology import dabam
+
+    server = dabam.dabam()
+    server.set_input_silent(True)
+    server.set_server(directory)
+    server.load(entry)
+
+    return server
+
+class DabamProfile(object):
+    '''
+    Profile and statistics of a DABAM entry, with the attributes and methods of dabam.dabam used by the
+    DABAM widget, plus the autocovariance of the heights (acf_lags, acf, correlation_length)
+    '''
+    ARRAYS = ["y", "zHeights", "zSlopes", "zHeightsUndetrended", "zSlopesUndetrended", "f", "psdHeights", "psdSlopes", "csdHeights", "csdSlopes", "acf_lags", "acf"]
+
+    def __init__(self, entry, metadata=None, info="", powerlaw=None, correlation_length=numpy.nan, **arrays):
+        self.entry = entry
+        self.metadata = {} if metadata is None else metadata
+        self.info = info
+        self.powerlaw = {} if powerlaw is None else powerlaw
+        self.correlation_length = correlation_length
+
+        for name in self.ARRAYS: setattr(self, name, arrays.get(name, None))
+
+    @classmethod
+    def from_dabam(cls, server, entry=None):
+        acf_lags, acf, correlation_length = autocovariance(server.y, server.zHeights)
+
+        return DabamProfile(entry=server.get_input_value("entryNumber") if entry is None else entry,
+                            metadata=server.metadata,
+                            info=server.info_profiles(),
+                            powerlaw={key : (value.item() if isinstance(value, numpy.generic) else value) for key, value in server.powerlaw.items()},
+                            correlation_length=float(correlation_length),
+                            acf_lags=acf_lags,
+                            acf=acf,
+                            **{name : getattr(server, name) for name in cls.ARRAYS[:-2]})
+
+    @classmethod
+    def load(cls, file_name):
+        with numpy.load(file_name, allow_pickle=False) as data:
+            attributes = json.loads(str(data["attributes"]))
+
+            if attributes.get("version") != STATISTICS_VERSION: raise ValueError("Unsupported version of " + file_name)
+
+            return DabamProfile(entry=attributes["entry"],
+                                metadata=attributes["metadata"],
+                                info=attributes["info"],
+                                powerlaw=attributes["powerlaw"],
+                                correlation_length=attributes["correlation_length"],
+                                **{name : data[name] for name in cls.ARRAYS if name in data})
+
+    def save(self, file_name):
+        attributes = {"version" : STATISTICS_VERSION,
+                      "entry" : self.entry,
+                      "metadata" : self.metadata,
+                      "info" : self.info,
+                      "powerlaw" : self.powerlaw,
+                      "correlation_length" : self.correlation_length}
+
+        temporary_file_name = file_name + "." + str(os.getpid()) + ".tmp.npz"
+        numpy.savez(temporary_file_name, attributes=json.dumps(attributes), **{name : getattr(self, name) for name in self.ARRAYS if not getattr(self, name) is None})
+        os.replace(temporary_file_name, file_name)
+
+    def get_psd_beta(self):
+        return -self.powerlaw["hgt_pendent"]
+
+    def info_profiles(self):
+        return self.info
+
+    def stdev_profile_heights(self):
+        return self.zHeights.std(ddof=1)
+
+    def stdev_profile_slopes(self):
+        return self.zSlopes.std(ddof=1)
+
+    def csd_heights(self):
+        # as dabam.dabam.csd_heights
+        return numpy.sqrt(self.csdHeights) / numpy.sqrt(self.csdHeights[-1])
+
+def get_index_record(entry, server):
+    # the fields of dabam.dabam_summary_dictionary (the "user" values are optional in the metadata)
+    return {"entry" : int(entry),
+            "surface" : get_surface_shape(server.metadata.get("SURFACE_SHAPE")),
+            "length" : float(server.y[-1] - server.y[0]),
+            "slp_err" : float(server.zSlopes.std(ddof=1)),
+            "slp_err_user" : server.metadata.get("CALC_SLOPE_RMS"),
+            "hgt_err" : float(server.zHeights.std(ddof=1)),
+            "hgt_err_user" : server.metadata.get("CALC_HEIGHT_RMS")}
+
+def get_statistics_record(dabam_profile):
+    return {"correlation_length" : dabam_profile.correlation_length,
+            "psd_beta" : dabam_profile.get_psd_beta(),
+            "statistics_version" : STATISTICS_VERSION}
+
+def _precompute_statistics(directory, entries):
+    records = {}
+
+    for entry in entries:
+        try:
+            dabam_profile = DabamProfile.from_dabam(load_dabam_profile(directory, entry), entry)
+            dabam_profile.save(os.path.join(directory, STATISTICS_FILE_NAME % entry))
+
+            records[entry] = get_statistics_record(dabam_profile)
+        except Exception as exception:
+            print("Statistics of DABAM entry " + str(entry) + " not computed: " + str(exception))
+
+    return records
+
+class DabamStore(object):
+
+    DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".oasys", "wiser_dabam")
+
+    def __init__(self, directory=None):
+        self.directory = self.DEFAULT_DIRECTORY if directory is None or directory.strip() == "" else directory
+
+        self._records = None
+        self._columns = None
+        self._index_mtime = None
+
+    def get_index_path(self):
+        return os.path.join(self.directory, INDEX_FILE_NAME)
+
+    def exists(self):
+        return os.path.exists(self.get_index_path())
+
+    def import_directory(self, source_directory, entries=None):
+        '''
+        One-time import of the DABAM files in source_directory (all, or the given entries): the files are
+        copied in the store and the index is updated. Returns the number of entries imported
+        '''
+        if not os.path.isdir(source_directory): raise FileNotFoundError("Directory not found: " + source_directory)
+
+        entries = find_dabam_entries(source_directory) if entries is None else sorted(entries)
+        if len(entries) == 0: raise ValueError("No DABAM files (dabam-NNN.txt/dabam-NNN.dat) found in " + source_directory)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        records = {record["entry"] : record for record in self.get_records()}
+        n_imported = 0
+
+        for index, entry in enumerate(entries):
+            check_cancelled()
+            report_progress(100*index/len(entries), "Importing DABAM entry " + str(entry))
+
+            if not os.path.samefile(source_directory, self.directory):
+                for extension in [".txt", ".dat"]:
+                    shutil.copy2(os.path.join(source_directory, "dabam-%03d" % entry + extension), self.directory)
+
+            try:
+                records[entry] = get_index_record(entry, load_dabam_profile(self.directory, entry))
+                n_imported += 1
+            except Exception as exception:
+                print("DABAM entry " + str(entry) + " not imported: " + str(exception))
+
+        self._write_index([records[entry] for entry in sorted(records.keys())])
+
+        report_progress(100, "DABAM import completed")
+
+        return n_imported
+
+    def _write_index(self, records):
+        temporary_path = self.get_index_path() + "." + str(os.getpid()) + ".tmp"
+
+        with open(temporary_path, "w") as file: json.dump({"version" : INDEX_VERSION, "entries" : records}, file, indent=1)
+
+        os.replace(temporary_path, self.get_index_path()) # atomic: the index is never read partially written
+
+    def get_records(self):
+        if not self.exists(): return []
+
+        index_mtime = os.stat(self.get_index_path()).st_mtime_ns
+
+        if self._records is None or index_mtime != self._index_mtime:
+            with open(self.get_index_path(), "r") as file: index = json.load(file)
+
+            self._records = index["entries"]
+            for record in self._records: # statistics of a previous version: not searchable until recomputed
+                if record.get("statistics_version") != STATISTICS_VERSION:
+                    for key in STATISTICS_COLUMNS: record[key] = None
+            self._columns = {key : numpy.array([numpy.nan if record.get(key) is None else record[key] for record in self._records], dtype=float)
+                             for key in INDEX_COLUMNS}
+            self._columns["surface"] = numpy.array([str(record["surface"]).capitalize() for record in self._records])
+            self._index_mtime = index_mtime
+
+        return self._records
+
+    def search(self, surface=None, slp_err_from=None, slp_err_to=None, length_from=None, length_to=None, hgt_err_from=None, hgt_err_to=None,
+               correlation_length_from=None, correlation_length_to=None, psd_beta_from=None, psd_beta_to=None):
+        '''
+        Records of the index (dictionaries as dabam.dabam_summary_dictionary: SI units) within the given ranges.
+        Ranges on correlation length and PSD beta exclude the entries without precomputed statistics
+        '''
+        if not self.exists(): raise FileNotFoundError("No local DABAM store in " + self.directory + ": import the DABAM files first")
+
+        records = self.get_records()
+
+        selected = numpy.ones(len(records), dtype=bool)
+
+        if not surface is None: selected &= self._columns["surface"] == surface.capitalize()
+
+        for key, value_from, value_to in [("slp_err", slp_err_from, slp_err_to),
+                                          ("length", length_from, length_to),
+                                          ("hgt_err", hgt_err_from, hgt_err_to),
+                                          ("correlation_length", correlation_length_from, correlation_length_to),
+                                          ("psd_beta", psd_beta_from, psd_beta_to)]:
+            if not value_from is None: selected &= self._columns[key] >= value_from
+            if not value_to is None: selected &= self._columns[key] <= value_to
+
+        return [records[index] for index in numpy.flatnonzero(selected)]
+
+    def get_statistics_path(self, entry):
+        return os.path.join(self.directory, STATISTICS_FILE_NAME % entry)
+
+    def has_statistics(self, entry):
+        statistics_path = self.get_statistics_path(entry)
+
+        if not os.path.exists(statistics_path): return False
+
+        statistics_mtime = os.stat(statistics_path).st_mtime_ns
+
+        return all([os.stat(os.path.join(self.directory, "dabam-%03d" % entry + extension)).st_mtime_ns <= statistics_mtime for extension in [".txt", ".dat"]])
+
+    def load_profile(self, entry):
+        '''
+        DabamProfile of the entry: precomputed statistics are read, otherwise computed and stored
+        '''
+        if not os.path.exists(os.path.join(self.directory, "dabam-%03d.dat" % entry)):
+            raise FileNotFoundError("DABAM entry " + str(entry) + " not in the local store " + self.directory)
+
+        if self.has_statistics(entry):
+            try:
+                return DabamProfile.load(self.get_statistics_path(entry))
+            except Exception as exception:
+                print("Statistics of DABAM entry " + str(entry) + " recomputed: " + str(exception))
+
+        dabam_profile = DabamProfile.from_dabam(load_dabam_profile(self.directory, entry), entry)
+
+        try:
+            dabam_profile.save(self.get_statistics_path(entry))
+        except Exception as exception:
+            print("Statistics of DABAM entry " + str(entry) + " not stored: " + str(exception))
+
+        return dabam_profile
+
+    def precompute_statistics(self, entries=None, force=False, n_pools=1):
+        '''
+        Computes and stores the statistics of the entries of the store (all, or the given ones; with force=False
+        only the missing or outdated ones) and adds correlation length and PSD beta to the index. With n_pools > 1
+        the entries are shared among n_pools processes. Returns the number of entries computed
+        '''
+        if not self.exists(): raise FileNotFoundError("No local DABAM store in " + self.directory + ": import the DABAM files first")
+
+        records = {record["entry"] : record for record in self.get_records()}
+
+        if entries is None: entries = sorted(records.keys())
+        entries = [entry for entry in entries if entry in records and (force or not self.has_statistics(entry) or records[entry].get("statistics_version") != STATISTICS_VERSION)]
+
+        n_entries = len(entries)
+        n_done = 0
+        computed = []
+
+        def collect(statistics_records):
+            for entry, statistics_record in statistics_records.items(): records[entry].update(statistics_record)
+            computed.extend(statistics_records.keys())
+
+        if n_pools <= 1 or n_entries <= 1:
+            for entry in entries:
+                check_cancelled()
+                report_progress(100*n_done/max(n_entries, 1), "Statistics of DABAM entry " + str(entry))
+
+                collect(_precompute_statistics(self.directory, [entry]))
+                n_done += 1
+        else:
+            chunks = numpy.array_split(numpy.array(entries), min(n_entries, 4*n_pools))
+
+            executor = ProcessPoolExecutor(max_workers=n_pools)
+            futures = {}
+            try:
+                futures = {executor.submit(_precompute_statistics, self.directory, [int(entry) for entry in chunk]): chunk for chunk in chunks}
+
+                for future in as_completed(futures):
+                    check_cancelled()
+
+                    collect(future.result())
+                    n_done += len(futures[future])
+
+                    report_progress(100*n_done/n_entries, "DABAM statistics (" + str(n_done) + "/" + str(n_entries) + ")")
+            finally:
+                for future in futures: future.cancel()
+                executor.shutdown(wait=False)
+
+        self._write_index([records[entry] for entry in sorted(records.keys())])
+
+        report_progress(100, "DABAM statistics completed")
+
+        return len(computed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Imports DABAM files in the local DABAM store of WISEr")
+    parser.add_argument("source", nargs="?", default=None, help="directory with the DABAM files (dabam-NNN.txt, dabam-NNN.dat)")
+    parser.add_argument("--store", default=None, help="directory of the local store (default: " + DabamStore.DEFAULT_DIRECTORY + ")")
+    parser.add_argument("--statistics", action="store_true", help="precomputes the statistics (PSD, CSD, power law, ACF) of the profiles")
+    parser.add_argument("--force", action="store_true", help="recomputes all the statistics")
+    parser.add_argument("--n-pools", type=int, default=1, help="number of parallel processes computing the statistics")
+
+    arguments = parser.parse_args(argv)
+
+    if arguments.source is None and not arguments.statistics: parser.error("nothing to do: give a source directory and/or --statistics")
+
+    store = DabamStore(arguments.store)
+
+    if not arguments.source is None:
+        n_entries = store.import_directory(arguments.source)
+
+        print(str(n_entries) + " DABAM entries imported in " + store.directory)
+
+    if arguments.statistics:
+        n_entries = store.precompute_statistics(force=arguments.force, n_pools=arguments.n_pools)
+
+        print("Statistics of " + str(n_entries) + " DABAM entries computed in " + store.directory)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
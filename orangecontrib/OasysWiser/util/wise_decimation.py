@@ -0,0 +1,106 @@
+import numpy
+
+###############################################################
+#
+# CURVE DECIMATION FOR PLOTTING: min/max per bin, so that peaks
+# and fringes of the field survive the reduction to screen
+# resolution (a line plot cannot show more than ~2 points per
+# pixel column)
+#
+###############################################################
+
+def decimate_min_max(x, y, n_bins):
+    '''
+    Splits the samples in n_bins bins of equal count and keeps the minimum and the maximum of y of each
+    bin, in the original order (first and last sample always kept). Curves up to 2*n_bins samples are
+    returned unchanged
+    '''
+    x = numpy.asarray(x)
+    y = numpy.asarray(y)
+    n_samples = len(y)
+
+    if n_bins < 1 or n_samples <= 2*n_bins: return x, y
+
+    bin_size = n_samples // n_bins
+    n_binned = bin_size*n_bins
+
+    bins = y[:n_binned].reshape(n_bins, bin_size)
+    offsets = numpy.arange(n_bins)*bin_size
+
+    indices = numpy.concatenate(([0],
+                                 offsets + numpy.argmin(bins, axis=1),
+                                 offsets + numpy.argmax(bins, axis=1),
+                                 n_binned + _extrema_indices(y[n_binned:]),
+                                 [n_samples - 1]))
+    indices = numpy.unique(indices) # sorted: the original order is kept
+
+    return x[indices], y[indices]
+
+def _extrema_indices(y):
+    return numpy.array([numpy.argmin(y), numpy.argmax(y)], dtype=int) if len(y) > 0 else numpy.array([], dtype=int)
+
+def is_monotonic(x):
+    differences = numpy.diff(x)
+
+    return bool(numpy.all(differences >= 0) or numpy.all(differences <= 0))
+
+def get_visible_slice(x, x_min, x_max, margin=1):
+    '''
+    Samples of the monotonic x within [x_min, x_max], plus margin samples on each side (to draw the
+    segments crossing the borders)
+    '''
+    n_samples = len(x)
+
+    if x[0] <= x[-1]:
+        start = numpy.searchsorted(x, x_min, side="left")
+        stop = numpy.searchsorted(x, x_max, side="right")
+    else:
+        start = n_samples - numpy.searchsorted(x[::-1], x_max, side="right")
+        stop = n_samples - numpy.searchsorted(x[::-1], x_min, side="left")
+
+    return max(int(start) - margin, 0), min(int(stop) + margin, n_samples)
+
+class DecimatedCurve(object):
+    '''
+    Full resolution curve with level of detail: the visible range is decimated to n_bins, the rest (kept
+    to preserve the data bounds for the zoom reset) to a fraction of them
+    '''
+    OUTSIDE_BINS_FRACTION = 0.1
+
+    def __init__(self, x, y):
+        self.x = numpy.asarray(x)
+        self.y = numpy.asarray(y)
+        self.level_of_detail = len(self.x) > 1 and is_monotonic(self.x)
+        self.last_view = None
+
+    def __len__(self):
+        return len(self.y)
+
+    def needs_decimation(self, n_bins):
+        return len(self.y) > 2*n_bins
+
+    def get_points(self, n_bins, x_min=None, x_max=None):
+        '''
+        Points to be drawn for the range [x_min, x_max] (None: whole curve), or None if they are the
+        same of the previous call
+        '''
+        if x_min is None or x_max is None or not self.level_of_detail:
+            start, stop = 0, len(self.y)
+        else:
+            start, stop = get_visible_slice(self.x, min(x_min, x_max), max(x_min, x_max))
+            stop = max(stop, start + 1)
+
+        view = (start, stop, n_bins)
+
+        if view == self.last_view: return None
+        self.last_view = view
+
+        if start == 0 and stop == len(self.y): return decimate_min_max(self.x, self.y, n_bins)
+
+        n_outside_bins = max(int(n_bins*self.OUTSIDE_BINS_FRACTION), 1)
+
+        parts = [decimate_min_max(self.x[:start], self.y[:start], n_outside_bins),
+                 decimate_min_max(self.x[start:stop], self.y[start:stop], n_bins),
+                 decimate_min_max(self.x[stop:], self.y[stop:], n_outside_bins)]
+
+        return numpy.concatenate([part[0] for part in parts]), numpy.concatenate([part[1] for part in parts])
@@ -0,0 +1,184 @@
+import copy
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+from orangecontrib.OasysWiser.util.wise_focus import normalize_intensity, half_energy_width
+from orangecontrib.OasysWiser.util.wise_task import report_progress, report_partial_result, check_cancelled
+from orangecontrib.OasysWiser.util.wise_profiling import profiled_worker
+
+###############################################################
+#
+# MONTE-CARLO FIGURE ERROR ENSEMBLE: N seeded realizations of the
+# height profile of a mirror, propagated down to the detector.
+# The fields upstream of the mirror are computed once and shared
+#
+###############################################################
+
+class ProfileEnsemble(object):
+    '''
+    Parameters of srxraylib.metrology.profiles_simulation.simulate_profile_1D (SI units): member i is the
+    profile generated with random_seed = seed + i
+    '''
+
+    def __init__(self, n_members, seed, step, mirror_length, error_type, profile_type, rms,
+                 correlation_length=1.0, power_law_exponent_beta=1.5, amplitude_scaling=1.0):
+        self.n_members = n_members
+        self.seed = seed
+        self.step = step
+        self.mirror_length = mirror_length
+        self.error_type = error_type
+        self.profile_type = profile_type
+        self.rms = rms
+        self.correlation_length = correlation_length
+        self.power_law_exponent_beta = power_law_exponent_beta
+        self.amplitude_scaling = amplitude_scaling
+
+    def get_seeds(self):
+        return self.seed + numpy.arange(self.n_members)
+
+    def scaled(self, amplitude_scaling):
+        ensemble = copy.copy(self)
+        ensemble.amplitude_scaling = amplitude_scaling
+
+        return ensemble
+
+    def generate(self, member):
+        from srxraylib.metrology import profiles_simulation
+
+        _, heights = profiles_simulation.simulate_profile_1D(step=self.step,
+                                                             mirror_length=self.mirror_length,
+                                                             random_seed=int(self.seed + member),
+                                                             error_type=self.error_type,
+                                                             profile_type=self.profile_type,
+                                                             rms=self.rms,
+                                                             correlation_length=self.correlation_length,
+                                                             power_law_exponent_beta=self.power_law_exponent_beta)
+
+        return heights*self.amplitude_scaling
+
+class EnsembleResult(object):
+
+    def __init__(self, seeds, electric_fields, positions, hews, indices=None):
+        self.seeds = numpy.asarray(seeds)
+        self.electric_fields = electric_fields
+        self.positions = positions
+        self.hews = numpy.asarray(hews, dtype=float)
+        self.indices = numpy.arange(len(self.hews)) if indices is None else numpy.asarray(indices)
+
+    def get_hew_statistics(self, percentiles=(5, 50, 95)):
+        hews = self.hews[numpy.isfinite(self.hews)]
+
+        return numpy.mean(hews), numpy.std(hews), numpy.percentile(hews, percentiles)
+
+    def get_intensity_bands(self, percentiles=(5, 50, 95)):
+        '''
+        Positions on the detector, mean intensity and intensity percentiles over the members
+        (intensities interpolated on the positions of the first member, if the sampling differs)
+        '''
+        members = [index for index in range(len(self.hews)) if not self.electric_fields[index] is None]
+        positions = self.positions[members[0]]
+
+        intensities = numpy.array([numpy.abs(self.electric_fields[index])**2 if len(self.positions[index]) == len(positions) and numpy.allclose(self.positions[index], positions) else
+                                   numpy.interp(positions, self.positions[index], numpy.abs(self.electric_fields[index])**2) for index in members])
+
+        return positions, numpy.mean(intensities, axis=0), numpy.percentile(intensities, percentiles, axis=0)
+
+    def save(self, file_name):
+        numpy.savetxt(file_name, numpy.column_stack((self.seeds, self.hews)), header="Seed HEW[m]")
+
+def get_ensemble_start_index(figure_error_ensembles):
+    if len(figure_error_ensembles) == 0: raise ValueError("No figure error ensemble defined along the beamline")
+
+    return min(figure_error_ensembles.keys())
+
+def _compute_member(wiser_data, figure_error_ensembles, member):
+    from orangecontrib.OasysWiser.util.wise_propagation import compute_fields_from
+
+    wiser_data = wiser_data.duplicate(writable=True)
+
+    n_elements = wiser_data.get_elements_number()
+    native_optical_elements = [wiser_data.wise_beamline.get_wise_propagation_element(index) for index in range(n_elements)]
+
+    for index, ensemble in figure_error_ensembles.items():
+        core_optics = native_optical_elements[index].CoreOptics
+        core_optics.ComputationSettings.UseFigureError = True
+        core_optics.FigureErrorLoad(h=ensemble.generate(member), Step=ensemble.step)
+
+    compute_fields_from(wiser_data.wise_beamline.get_wise_propagation_elements(), native_optical_elements, get_ensemble_start_index(figure_error_ensembles))
+
+    electric_field = numpy.copy(native_optical_elements[-1].ComputationData.Field)
+    positions = numpy.copy(native_optical_elements[-1].ComputationData.S)
+
+    return electric_field, positions, half_energy_width(normalize_intensity(electric_field), numpy.mean(numpy.abs(numpy.diff(positions))))
+
+@profiled_worker
+def _compute_member_chunk(wiser_data_dump, figure_error_ensembles, members):
+    wiser_data = pickle.loads(wiser_data_dump)
+
+    return [_compute_member(wiser_data, figure_error_ensembles, member) for member in members]
+
+def compute_ensemble(wiser_data, figure_error_ensembles, n_pools=1):
+    '''
+    Propagates every member of the figure error ensembles ({element index : ProfileEnsemble}, all with
+    the same number of members) down to the last element of the beamline of wiser_data, restarting from
+    the first element with an ensemble: the upstream fields must have been computed. With n_pools > 1
+    members are shared among n_pools processes, each generating its profiles. Every completed group
+    of members is reported as partial EnsembleResult
+    '''
+    start_index = get_ensemble_start_index(figure_error_ensembles)
+    n_members = min([ensemble.n_members for ensemble in figure_error_ensembles.values()])
+    seeds = figure_error_ensembles[start_index].get_seeds()[:n_members]
+
+    upstream_optical_element = wiser_data.wise_beamline.get_wise_propagation_element(start_index - 1) if start_index > 0 else None
+
+    if upstream_optical_element is None or (not upstream_optical_element.IsSource and upstream_optical_element.ComputationData.Field is None):
+        raise ValueError("No field computed upstream of the figure error ensemble: run computation first")
+
+    electric_fields = [None]*n_members
+    positions = [None]*n_members
+    hews = numpy.full(n_members, numpy.nan)
+
+    def collect(indices, chunk_results):
+        for index, (electric_field, position, hew) in zip(indices, chunk_results):
+            electric_fields[index] = electric_field
+            positions[index] = position
+            hews[index] = hew
+
+        n_done = n_members - len([field for field in electric_fields if field is None])
+
+        report_progress(100*n_done/n_members, "Figure Error Ensemble (" + str(n_done) + "/" + str(n_members) + ")")
+        report_partial_result(EnsembleResult(seeds[indices],
+                                             [electric_fields[index] for index in indices],
+                                             [positions[index] for index in indices],
+                                             hews[indices],
+                                             indices=indices))
+
+    wiser_data_dump = None
+    if n_pools > 1 and n_members > 1:
+        try:
+            wiser_data_dump = pickle.dumps(wiser_data, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as exception:
+            print("Ensemble cannot be distributed among processes (" + str(exception) + "): running sequentially")
+
+    if wiser_data_dump is None:
+        for member in range(n_members):
+            check_cancelled()
+            collect([member], [_compute_member(wiser_data, figure_error_ensembles, member)])
+    else:
+        chunks = numpy.array_split(numpy.arange(n_members), min(n_members, 4*n_pools))
+
+        executor = ProcessPoolExecutor(max_workers=n_pools)
+        futures = {}
+        try:
+            futures = {executor.submit(_compute_member_chunk, wiser_data_dump, figure_error_ensembles, chunk): chunk for chunk in chunks}
+
+            for future in as_completed(futures):
+                check_cancelled()
+                collect(futures[future], future.result())
+        finally:
+            for future in futures: future.cancel()
+            executor.shutdown(wait=False)
+
+    return EnsembleResult(seeds, electric_fields, positions, hews)
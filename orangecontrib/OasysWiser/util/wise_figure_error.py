@@ -0,0 +1,121 @@
+import os
+import json
+import time
+
+import numpy
+
+from orangecontrib.OasysWiser.util.wise_hdf5 import read_dataset
+from orangecontrib.OasysWiser.util.wise_cache import WiserLRUCache
+
+###############################################################
+#
+# FIGURE ERROR PROFILES
+#
+# Binary format (HDF5, .h5/.hdf5): dataset "heights" [m], stored
+# contiguous and uncompressed to be memory-mapped, with attributes
+# step [m], amplitude_scaling and provenance (JSON).
+# Text files (.dat, .txt: one height per row, user units) are read
+# as before, with step and units given by the user.
+#
+###############################################################
+
+BINARY_EXTENSIONS = (".h5", ".hdf5")
+FILE_EXTENSION_FILTER = "Data Files (*.dat *.txt *.h5 *.hdf5)"
+
+class FigureErrorProfile(object):
+
+    def __init__(self, heights, step, amplitude_scaling=1.0, provenance=None):
+        self.heights = heights # may be a read-only memory map: scaled by LibWiser (FigureErrorLoad) which makes its own copy
+        self.step = step
+        self.amplitude_scaling = amplitude_scaling
+        self.provenance = {} if provenance is None else provenance
+
+    def get_length(self):
+        return len(self.heights)*self.step
+
+def is_binary_figure_error_file(file_name):
+    return file_name.lower().endswith(BINARY_EXTENSIONS)
+
+def save_figure_error(file_name, heights, step, amplitude_scaling=1.0, provenance=None):
+    '''
+    heights and step in [m]: provenance is a JSON-serializable dictionary (creator, parameters, source of the data)
+    '''
+    import h5py
+
+    if provenance is None: provenance = {}
+
+    with h5py.File(file_name, "w") as file:
+        file.attrs["creator"] = "OASYS-WISEr"
+        file.attrs["step"] = float(step)
+        file.attrs["amplitude_scaling"] = float(amplitude_scaling)
+        file.attrs["units"] = "m"
+        file.attrs["created"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        file.attrs["provenance"] = json.dumps(provenance)
+
+        file.create_dataset("heights", data=numpy.ascontiguousarray(heights, dtype=float))
+
+def load_figure_error(file_name, step=None, height_units_to_m=1.0):
+    '''
+    Binary files carry their step and scaling, text files need the step [m] and the conversion
+    factor of the heights to [m]
+    '''
+    if not os.path.exists(file_name): raise FileNotFoundError("Figure error file not found: " + file_name)
+
+    if is_binary_figure_error_file(file_name):
+        import h5py
+
+        with h5py.File(file_name, "r") as file:
+            heights = read_dataset(file_name, file["heights"])
+
+            return FigureErrorProfile(heights,
+                                      step=float(file.attrs["step"]),
+                                      amplitude_scaling=float(file.attrs.get("amplitude_scaling", 1.0)),
+                                      provenance=json.loads(file.attrs.get("provenance", "{}")))
+    else:
+        if step is None: raise ValueError("The step of a text figure error file must be specified")
+
+        return FigureErrorProfile(numpy.loadtxt(file_name), step=step, amplitude_scaling=height_units_to_m, provenance={"file" : os.path.abspath(file_name)})
+
+###############################################################
+#
+# PROFILE CACHE: parsed and scaled profiles, shared by all the
+# optical elements of the process (e.g. mirrors measured with
+# the same metrology file), with memory budget
+#
+###############################################################
+
+class WiserProfileCache(WiserLRUCache):
+
+    DEFAULT_MEMORY_BUDGET = 256 # MB
+
+    __instance = None
+
+    @classmethod
+    def Instance(cls):
+        if cls.__instance is None: cls.__instance = WiserProfileCache()
+
+        return cls.__instance
+
+    def load(self, file_name, step=None, height_units_to_m=1.0, amplitude_scaling=1.0):
+        '''
+        As load_figure_error, with the heights multiplied by amplitude_scaling (absolute value, as in
+        CoreOptics.FigureErrorLoad): the returned profile is read-only and has amplitude_scaling = 1
+        '''
+        if not os.path.exists(file_name): raise FileNotFoundError("Figure error file not found: " + file_name)
+
+        stat = os.stat(file_name)
+        key = (os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size, step, height_units_to_m, abs(amplitude_scaling))
+
+        figure_error = self.get(key)
+
+        if figure_error is None:
+            figure_error = load_figure_error(file_name, step, height_units_to_m)
+
+            heights = figure_error.heights*(abs(amplitude_scaling)*figure_error.amplitude_scaling)
+            heights.setflags(write=False)
+
+            figure_error = FigureErrorProfile(heights, figure_error.step, provenance=figure_error.provenance)
+
+            self.put(key, figure_error, heights.nbytes)
+
+        return figure_error
@@ -0,0 +1,322 @@
+import copy
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+from orangecontrib.OasysWiser.util.wise_cache import collect_arrays
+from orangecontrib.OasysWiser.util.wise_hdf5 import read_dataset
+from orangecontrib.OasysWiser.util.wise_task import report_progress, report_partial_result, check_cancelled
+from orangecontrib.OasysWiser.util.wise_profiling import profiled_worker
+
+###############################################################
+#
+# DEFOCUS SWEEP ENGINE: the field on the focussing element is
+# computed once and shared by all the detector planes
+#
+###############################################################
+
+class FocusSweepResult(object):
+
+    def __init__(self, defocus_list, electric_fields, positions, hews, indices=None):
+        self.defocus_list = numpy.asarray(defocus_list)
+        self.electric_fields = electric_fields
+        self.positions = positions
+        self.hews = numpy.asarray(hews, dtype=float)
+        self.indices = numpy.arange(len(self.hews)) if indices is None else numpy.asarray(indices)
+
+    def get_normalized_intensities(self):
+        return [normalize_intensity(electric_field) for electric_field in self.electric_fields]
+
+    def get_best_focus_index(self):
+        hews = numpy.round(self.hews*1e6, 11) # problems with double precision numbers: inconsistent comparisons
+        index_min_list = numpy.flatnonzero(hews == numpy.nanmin(hews))
+
+        # choosing the central value, when hew reach a pletau: central in defocus, the planes of an adaptive search are not evenly spaced
+        defocus_min_list = self.defocus_list[index_min_list].astype(float)
+        distances = numpy.abs(defocus_min_list - 0.5*(defocus_min_list[0] + defocus_min_list[-1]))
+        index_central_list = numpy.flatnonzero(numpy.isclose(distances, distances.min(), rtol=0.0, atol=1e-9*numpy.ptp(defocus_min_list)))
+
+        return int(index_min_list[index_central_list[-1]]) # the downstream one of two equidistant planes, as the middle index of an even plateau
+
+def normalize_intensity(electric_field):
+    intensity = numpy.abs(electric_field)**2
+    norm = intensity.max() if len(intensity) > 0 else 0.0
+
+    return intensity/(1.0 if norm == 0.0 else norm)
+
+def half_energy_width(intensity, step):
+    '''
+    Same as LibWiser.Rayman.HalfEnergyWidth_1d(intensity, Step=step, UseCentreOfMass=False),
+    with the energy of all the windows around the maximum computed at once from the cumulative sum
+    '''
+    intensity = numpy.asarray(intensity, dtype=float)
+    n_samples = len(intensity)
+    i_centre = int(intensity.argmax())
+
+    cumulative_energy = numpy.concatenate(([0.0], numpy.cumsum(intensity)))
+
+    radii = numpy.arange(1, i_centre + n_samples + 1)
+    starts = i_centre - radii
+    starts = numpy.where(starts < 0, numpy.maximum(starts + n_samples, 0), starts) # python slicing of X[iCentre - iR : iCentre + iR]
+    ends = numpy.minimum(i_centre + radii, n_samples)
+    energies = numpy.where(ends > starts, cumulative_energy[ends] - cumulative_energy[numpy.minimum(starts, ends)], 0.0)
+
+    radius = radii[numpy.argmax(energies >= 0.5*cumulative_energy[-1])] + 1
+
+    return 2*radius*step
+
+def detach_optical_element(native_optical_element):
+    '''
+    Copy of the optical element without the links to its beamline: the upstream elements are not copied
+    and the arrays (field, figure errors) are shared with the original
+    '''
+    memo = collect_arrays(native_optical_element)
+    memo[id(native_optical_element.Parent)] = None
+    memo[id(native_optical_element.Children)] = []
+    memo[id(getattr(native_optical_element, "_ParentContainer", None))] = None
+
+    return copy.deepcopy(native_optical_element, memo)
+
+def _build_sweep_beamline(focussing_element, detector_size, n_pools):
+    from LibWiser import Foundation, Optics
+    from LibWiser.Foundation import PositioningDirectives
+
+    # as in LibWiser.Foundation.FocusSweep: the focussing element becomes the source of a two-elements beamline
+    focussing_element._IsSource = True
+    focussing_element.PositioningDirectives.ReferTo = PositioningDirectives.ReferTo.Locked
+    focussing_element.CoreOptics.Orientation = Optics.OPTICS_ORIENTATION.ANY
+
+    n_samples = focussing_element.ComputationData.NSamples
+    if n_samples is None:
+        raise Exception("No field computed on the focussing element " + str(focussing_element.Name) + ": run computation first")
+
+    focussing_element.ComputationSettings.NSamples = n_samples
+    focussing_element.ComputationSettings.UseCustomSampling = True
+
+    detector = Foundation.OpticalElement(Optics.Detector(L=detector_size, AngleGrazing=numpy.deg2rad(90)),
+                                         PositioningDirectives=PositioningDirectives(ReferTo=PositioningDirectives.ReferTo.UpstreamElement,
+                                                                                     PlaceWhat=PositioningDirectives.What.Centre,
+                                                                                     PlaceWhere=PositioningDirectives.Where.DownstreamFocus,
+                                                                                     Distance=0),
+                                         Name="detector")
+    detector.ComputationSettings.NSamples = n_samples
+    detector.ComputationSettings.UseCustomSampling = True
+
+    beamline = Foundation.BeamlineElements()
+    beamline.Append(focussing_element)
+    beamline.Append(detector)
+    beamline.ComputationSettings.NPools = n_pools
+
+    return beamline, detector
+
+def _compute_defocus(beamline, detector, defocus):
+    detector.PositioningDirectives.Distance = defocus
+    beamline.RefreshPositions()
+    beamline.ComputeFields(Verbose=False)
+
+    electric_field = numpy.copy(detector.ComputationData.Field)
+    positions = numpy.copy(detector.ComputationData.S)
+
+    hew = half_energy_width(normalize_intensity(electric_field), numpy.mean(numpy.diff(positions)))
+
+    return electric_field, positions, hew
+
+@profiled_worker
+def _compute_defocus_chunk(focussing_element_dump, defocus_chunk, detector_size):
+    beamline, detector = _build_sweep_beamline(pickle.loads(focussing_element_dump), detector_size, n_pools=1)
+
+    return [_compute_defocus(beamline, detector, defocus) for defocus in defocus_chunk]
+
+def _sweep(focussing_element, defocus_list, detector_size, n_pools, collect):
+    focussing_element = detach_optical_element(focussing_element)
+
+    focussing_element_dump = None
+    if n_pools > 1 and len(defocus_list) > 1:
+        try:
+            focussing_element_dump = pickle.dumps(focussing_element, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as exception:
+            print("Defocus sweep cannot be distributed among processes (" + str(exception) + "): running sequentially")
+
+    if focussing_element_dump is None:
+        beamline, detector = _build_sweep_beamline(focussing_element, detector_size, n_pools) # the pool is used by every single propagation
+
+        for index, defocus in enumerate(defocus_list):
+            check_cancelled()
+            collect([index], [_compute_defocus(beamline, detector, defocus)])
+    else:
+        chunks = numpy.array_split(numpy.arange(len(defocus_list)), min(len(defocus_list), 4*n_pools)) # small chunks: frequent updates and cancellation
+
+        executor = ProcessPoolExecutor(max_workers=n_pools)
+        futures = {}
+        try:
+            futures = {executor.submit(_compute_defocus_chunk, focussing_element_dump, defocus_list[chunk], detector_size): chunk for chunk in chunks}
+
+            for future in as_completed(futures):
+                check_cancelled()
+                collect(futures[future], future.result())
+        finally:
+            for future in futures: future.cancel() # pending chunks: shutdown(cancel_futures=True) needs Python >= 3.9
+            executor.shutdown(wait=False)
+
+def compute_focus_sweep(focussing_element, defocus_list, detector_size, n_pools=1):
+    '''
+    Computes the field on a detector placed at each distance of defocus_list from the nominal focus
+    of focussing_element. With n_pools > 1 the defocus planes are shared among n_pools processes.
+    Every completed group of planes is reported as partial FocusSweepResult, cancellation is checked in between
+    '''
+    defocus_list = numpy.asarray(defocus_list, dtype=float)
+    n_defocus = len(defocus_list)
+
+    electric_fields = [None]*n_defocus
+    positions = [None]*n_defocus
+    hews = numpy.full(n_defocus, numpy.nan)
+
+    def collect(indices, chunk_results):
+        for index, (electric_field, position, hew) in zip(indices, chunk_results):
+            electric_fields[index] = electric_field
+            positions[index] = position
+            hews[index] = hew
+
+        n_done = n_defocus - len([field for field in electric_fields if field is None])
+
+        report_progress(100*n_done/n_defocus, "Defocus Sweep (" + str(n_done) + "/" + str(n_defocus) + ")")
+        report_partial_result(FocusSweepResult(defocus_list[indices],
+                                               [electric_fields[index] for index in indices],
+                                               [positions[index] for index in indices],
+                                               hews[indices],
+                                               indices=indices))
+
+    _sweep(focussing_element, defocus_list, detector_size, n_pools, collect)
+
+    return FocusSweepResult(defocus_list, electric_fields, positions, hews)
+
+###############################################################
+#
+# ADAPTIVE SEARCH: coarse grid bracketing the HEW minimum, then
+# golden-section refinement inside the bracket
+#
+###############################################################
+
+GOLDEN_RATIO = (numpy.sqrt(5.0) - 1.0)/2
+
+def search_best_focus(focussing_element, defocus_start, defocus_stop, detector_size, n_coarse_points=11, tolerance=1e-3, n_pools=1):
+    '''
+    Searches the HEW minimum between defocus_start and defocus_stop: the coarse grid of n_coarse_points
+    planes is computed as in compute_focus_sweep, then the bracket around its minimum is reduced by
+    golden section down to tolerance. Returns a FocusSweepResult with all the computed planes,
+    sorted by defocus, and every computed plane is reported as partial FocusSweepResult
+    '''
+    coarse_defocus_list = numpy.linspace(defocus_start, defocus_stop, n_coarse_points)
+    bracket_width = 2*(defocus_stop - defocus_start)/(n_coarse_points - 1)
+    n_refinements = max(0, int(numpy.ceil(numpy.log(bracket_width/tolerance)/numpy.log(1/GOLDEN_RATIO))))
+    n_evaluations = n_coarse_points + n_refinements + 1
+
+    computed = {}
+
+    def add(defocus, result):
+        computed[defocus] = result
+        electric_field, positions, hew = result
+
+        report_progress(min(99, 100*len(computed)/n_evaluations), "Best Focus Search (" + str(len(computed)) + " planes computed)")
+        report_partial_result(FocusSweepResult([defocus], [electric_field], [positions], [hew], indices=[len(computed)-1]))
+
+    def collect(indices, chunk_results):
+        for index, result in zip(indices, chunk_results): add(coarse_defocus_list[index], result)
+
+    _sweep(focussing_element, coarse_defocus_list, detector_size, n_pools, collect)
+
+    index_min = _get_result(computed).get_best_focus_index()
+    a = coarse_defocus_list[max(index_min - 1, 0)]
+    b = coarse_defocus_list[min(index_min + 1, n_coarse_points - 1)]
+
+    beamline, detector = _build_sweep_beamline(detach_optical_element(focussing_element), detector_size, n_pools)
+
+    def rounded_hew(defocus):
+        if not defocus in computed: add(defocus, _compute_defocus(beamline, detector, defocus))
+
+        return round(computed[defocus][2]*1e6, 11) # problems with double precision numbers: inconsistent comparisons
+
+    c = b - GOLDEN_RATIO*(b - a)
+    d = a + GOLDEN_RATIO*(b - a)
+
+    while b - a > tolerance:
+        check_cancelled()
+
+        hew_c = rounded_hew(c)
+        hew_d = rounded_hew(d)
+
+        if hew_c < hew_d:
+            b, d = d, c
+            c = b - GOLDEN_RATIO*(b - a)
+        elif hew_c > hew_d:
+            a, c = c, d
+            d = a + GOLDEN_RATIO*(b - a)
+        else: # same HEW: the minimum (or the plateau) is in between
+            a, b = c, d
+            c = b - GOLDEN_RATIO*(b - a)
+            d = a + GOLDEN_RATIO*(b - a)
+
+    return _get_result(computed)
+
+def _get_result(computed):
+    defocus_list = sorted(computed.keys())
+
+    return FocusSweepResult(defocus_list,
+                            [computed[defocus][0] for defocus in defocus_list],
+                            [computed[defocus][1] for defocus in defocus_list],
+                            [computed[defocus][2] for defocus in defocus_list])
+
+###############################################################
+#
+# BINARY EXPORT: a single HDF5 file per sweep
+#
+###############################################################
+
+def save_focus_sweep(file_name, focus_sweep_result, compressed=False, attributes=None):
+    import h5py
+
+    if attributes is None: attributes = {}
+
+    n_samples = numpy.array([len(positions) for positions in focus_sweep_result.positions])
+    n_max = n_samples.max()
+
+    electric_fields = numpy.zeros((len(n_samples), n_max), dtype=complex)
+    positions = numpy.zeros((len(n_samples), n_max), dtype=float)
+    for index, n in enumerate(n_samples):
+        electric_fields[index, :n] = focus_sweep_result.electric_fields[index]
+        positions[index, :n] = focus_sweep_result.positions[index]
+
+    options = {"compression" : "gzip", "compression_opts" : 4, "shuffle" : True} if compressed else {}
+
+    with h5py.File(file_name, "w") as file:
+        file.attrs["creator"] = "OASYS-WISEr Best Focus Calculation"
+
+        for key, value in attributes.items(): file.attrs[key] = value
+
+        file.create_dataset("defocus_list", data=focus_sweep_result.defocus_list)
+        file.create_dataset("hews_list", data=focus_sweep_result.hews)
+        file.create_dataset("n_samples", data=n_samples)
+        file.create_dataset("positions_list", data=positions, **options)
+        file.create_dataset("electric_fields_list", data=electric_fields, **options)
+
+def load_focus_sweep(file_name):
+    '''
+    Returns the FocusSweepResult and the attributes saved with save_focus_sweep:
+    uncompressed fields and positions are memory-mapped, not read
+    '''
+    import h5py
+
+    with h5py.File(file_name, "r") as file:
+        defocus_list = file["defocus_list"][()]
+        hews = file["hews_list"][()]
+        n_samples = file["n_samples"][()]
+        attributes = dict(file.attrs)
+
+        positions = read_dataset(file_name, file["positions_list"])
+        electric_fields = read_dataset(file_name, file["electric_fields_list"])
+
+    return FocusSweepResult(defocus_list,
+                            [electric_fields[index, :n] for index, n in enumerate(n_samples)],
+                            [positions[index, :n] for index, n in enumerate(n_samples)],
+                            hews), attributes
@@ -0,0 +1,13 @@
+import numpy
+
+def read_dataset(file_name, dataset):
+    '''
+    Memory-mapped content of an HDF5 dataset, when it is stored contiguous and uncompressed,
+    otherwise the dataset is read
+    '''
+    offset = dataset.id.get_offset() # None if chunked/compressed or empty
+
+    if offset is None or dataset.size == 0:
+        return dataset[()]
+    else:
+        return numpy.memmap(file_name, mode="r", dtype=dataset.dtype, offset=offset, shape=dataset.shape, order="C")
@@ -9,7 +9,9 @@ class WiserPreInputData:
                 figure_user_units_to_m=1.0,
                 roughness_file=NONE,
                 roughness_x_scaling=1.0,
-                roughness_y_scaling=1.0
+                roughness_y_scaling=1.0,
+                figure_error_ensemble=None,
+                figure_error_profile=None
                 ):
         super().__init__()
 
@@ -22,33 +24,97 @@ class WiserPreInputData:
         self.roughness_x_scaling = roughness_x_scaling
         self.roughness_y_scaling = roughness_y_scaling
 
+        self.figure_error_ensemble = figure_error_ensemble # wise_ensemble.ProfileEnsemble, generated by the height profile simulator
+        self.figure_error_profile = figure_error_profile # wise_figure_error.FigureErrorProfile: heights in memory, not copied (the file, if any, is an export)
 
-from WofryWiser.propagator.propagator1D.wise_propagator import WisePropagationElements
-from WofryWiser.propagator.wavefront1D.wise_wavefront import WiseWavefront
-from WofryWiser.beamline.beamline_elements import WiserBeamlineElement, WiserOpticalElement
+
+from orangecontrib.OasysWiser.util.wise_cache import fingerprint, collect_arrays
 
 import copy
 
 class WiserData(object):
     
-    def __init__(self, wise_beamline=WisePropagationElements(), wise_wavefront=WiseWavefront()):
+    def __init__(self, wise_beamline=None, wise_wavefront=None, element_keys=None, figure_error_ensembles=None, deferred_elements=None):
         super().__init__()
 
-        self.wise_beamline = wise_beamline
-        self.wise_wavefront = wise_wavefront
+        self.wise_beamline = wise_beamline # WisePropagationElements
+        self.wise_wavefront = wise_wavefront # WiseWavefront
+        self.element_keys = [] if element_keys is None else element_keys # one key per beamline element, chaining the upstream ones
+        self.figure_error_ensembles = {} if figure_error_ensembles is None else figure_error_ensembles # element index -> wise_ensemble.ProfileEnsemble
+        # Whole Beamline mode: wise_batch.DeferredElement downstream of wise_beamline, not built yet (wise_wavefront is upstream of them)
+        self.deferred_elements = [] if deferred_elements is None else deferred_elements
+
+    def get_elements_number(self): # deferred elements included: indexes are the ones of the built beamline
+        return self.get_built_elements_number() + len(self.deferred_elements)
+
+    def get_built_elements_number(self):
+        return 0 if self.wise_beamline is None else self.wise_beamline.get_propagation_elements_number()
+
+    def has_deferred_elements(self):
+        return len(self.deferred_elements) > 0
+
+    def add_deferred_element(self, deferred_element, element_key): # the element is shared with the duplicates: not to be modified
+        self.deferred_elements = self.deferred_elements + [deferred_element]
+        self.add_element_key(element_key)
+
+    def add_element_key(self, element_key): # to be called after the element has been added to the beamline
+        n_upstream_elements = self.get_elements_number() - 1
+
+        self.element_keys = (self.element_keys + [None]*n_upstream_elements)[:n_upstream_elements] + [element_key]
+
+    def set_figure_error_ensemble(self, element_index, figure_error_ensemble): # the dictionary may be shared with other duplicates
+        self.figure_error_ensembles = {index : ensemble for index, ensemble in self.figure_error_ensembles.items() if index != element_index}
+
+        if not figure_error_ensemble is None: self.figure_error_ensembles[element_index] = figure_error_ensemble
+
+    def get_chain_key(self):
+        n_elements = self.get_elements_number()
+
+        if n_elements > 0 and len(self.element_keys) == n_elements and not self.element_keys[-1] is None:
+            return self.element_keys[-1]
+        else: # content based: slower, used when the beamline was built by widgets not providing keys
+            return fingerprint([element.get_optical_element().native_optical_element for element in self.wise_beamline.get_propagation_elements()] if self.get_built_elements_number() > 0 else None,
+                               [(deferred_element.batch_element.widget, sorted(deferred_element.batch_element.settings.items())) for deferred_element in self.deferred_elements],
+                               None if self.wise_wavefront is None else self.wise_wavefront.wise_computation_result)
+
+    def duplicate(self, writable=False):
+        '''
+        Copy-on-write: the default duplicate shares beamline and wavefront with the original, and
+        it must not be modified. A writable duplicate copies the element definitions, sharing the
+        field and figure error buffers, which are never modified in place
+        '''
+        if not writable:
+            return WiserData(wise_beamline=self.wise_beamline,
+                             wise_wavefront=self.wise_wavefront,
+                             element_keys=copy.copy(self.element_keys),
+                             figure_error_ensembles=copy.copy(self.figure_error_ensembles),
+                             deferred_elements=copy.copy(self.deferred_elements))
+
+        from WofryWiser.propagator.propagator1D.wise_propagator import WisePropagationElements
+        from WofryWiser.propagator.wavefront1D.wise_wavefront import WiseWavefront
+        from WofryWiser.beamline.beamline_elements import WiserBeamlineElement, WiserOpticalElement
+
+        native_optical_elements = [] if self.wise_beamline is None else \
+                                  [beamline_element.get_optical_element().native_optical_element for beamline_element in self.wise_beamline.get_propagation_elements()]
+        wise_computation_result = None if self.wise_wavefront is None else self.wise_wavefront.wise_computation_result
+
+        memo = collect_arrays([native_optical_elements, wise_computation_result]) # deepcopy memo: arrays are not copied
+        # a single memo copies every element once, even if reached again through the Parent/Children links
+        duplicated_native_optical_elements = copy.deepcopy(native_optical_elements, memo)
 
-    def duplicate(self):
         duplicated_wise_beamline = None
 
         if not self.wise_beamline is None:
             duplicated_wise_beamline = WisePropagationElements()
-            for beamline_element in self.wise_beamline.get_propagation_elements():
-                duplicated_wise_optical_element = copy.deepcopy(beamline_element.get_optical_element().wise_optical_element)
-                duplicated_wise_beamline.add_beamline_element(WiserBeamlineElement(optical_element=WiserOpticalElement(native_OpticalElement=duplicated_wise_optical_element)))
+            for duplicated_native_optical_element in duplicated_native_optical_elements:
+                duplicated_wise_beamline.add_beamline_element(WiserBeamlineElement(optical_element=WiserOpticalElement(native_OpticalElement=duplicated_native_optical_element)))
 
         duplicated_wise_wavefront = None
         if not self.wise_wavefront is None:
-            duplicated_wise_wavefront = WiseWavefront(wise_computation_results=copy.deepcopy(self.wise_wavefront.wise_computation_result))
+            duplicated_wise_wavefront = WiseWavefront(wise_computation_results=copy.deepcopy(wise_computation_result, memo))
 
         return WiserData(wise_beamline=duplicated_wise_beamline,
-                         wise_wavefront=duplicated_wise_wavefront)
+                         wise_wavefront=duplicated_wise_wavefront,
+                         element_keys=copy.copy(self.element_keys),
+                         figure_error_ensembles=copy.copy(self.figure_error_ensembles),
+                         deferred_elements=copy.copy(self.deferred_elements)) # settings only: never modified
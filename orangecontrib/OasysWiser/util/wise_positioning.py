@@ -0,0 +1,34 @@
+###############################################################
+#
+# POSITIONING DIRECTIVES VALUES: the strings of LibWiser
+# (Foundation.PositioningDirectives, Optics.TypeOfAngle) saved
+# in the workflows (.ows), available to declare the settings and
+# the combo boxes of the widgets without importing LibWiser
+#
+###############################################################
+
+class What:
+    Centre = 'centre'
+    UpstreamFocus = 'upstream focus'
+    DownstreamFocus = 'downstream focus'
+
+class Where:
+    Centre = 'centre'
+    UpstreamFocus = 'upstream focus'
+    DownstreamFocus = 'downstream focus'
+
+class ReferTo:
+    AbsoluteReference = 'absolute'
+    UpstreamElement = 'upstream'
+    DownstreamElement = 'downstream'
+    DoNotMove = 'fix'
+    Source = 'source'
+    Locked = 'locked'
+
+class TypeOfAngle:
+    GrazingNominal = 'grazing'
+    InputNominal = 'input'
+    OutputNominal = 'output'
+    SelfFrameOfReference = 'aixs' # sic, as in LibWiser
+    NormalAbsolute = 'default'
+    TangentAbsolute = 'tangent'
@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import shutil
+import pstats
+import cProfile
+import tempfile
+import functools
+import itertools
+from collections import defaultdict
+
+###############################################################
+#
+# ON-DEMAND PROFILING: cProfile of a calculation, with the
+# chunks computed by the multipool workers (functions decorated
+# with profiled_worker) profiled in their processes and merged.
+# Outputs: merged pstats file (.prof: snakeviz, pstats) and
+# collapsed stacks (.collapsed: flamegraph.pl, speedscope)
+#
+###############################################################
+
+PROFILE_DIRECTORY_VARIABLE = "WISER_PROFILE_DIRECTORY" # inherited by the worker processes started while profiling
+
+_worker_counter = itertools.count()
+
+def profiled_worker(function):
+    '''
+    Decorator of the functions executed by the worker processes: profiled only while a WiserProfiler is running
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        directory = os.environ.get(PROFILE_DIRECTORY_VARIABLE, None)
+
+        if directory is None or not os.path.isdir(directory): return function(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            profile.dump_stats(os.path.join(directory, "worker-" + str(os.getpid()) + "-" + str(next(_worker_counter)) + ".prof"))
+
+    return wrapper
+
+class WiserProfiler(object):
+
+    def __init__(self, directory, name="wiser"):
+        self.directory = directory
+        self.name = name
+        self.profile_file = None
+        self.collapsed_stacks_file = None
+
+    def wrap(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return self.run(function, *args, **kwargs)
+
+        return wrapper
+
+    def run(self, function, *args, **kwargs):
+        '''
+        Calls function (in the calling thread only) with the profiler on, then saves the merged profile
+        and the collapsed stacks in directory
+        '''
+        workers_directory = tempfile.mkdtemp(prefix="wiser-profile-")
+        previous_directory = os.environ.get(PROFILE_DIRECTORY_VARIABLE, None)
+        os.environ[PROFILE_DIRECTORY_VARIABLE] = workers_directory
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+        finally:
+            if previous_directory is None: del os.environ[PROFILE_DIRECTORY_VARIABLE]
+            else: os.environ[PROFILE_DIRECTORY_VARIABLE] = previous_directory
+
+            try:
+                self.save(profile, workers_directory)
+            except Exception as exception: # the result of the calculation is not lost
+                print("Profile not saved: " + str(exception))
+            finally:
+                shutil.rmtree(workers_directory, ignore_errors=True)
+
+    def save(self, profile, workers_directory):
+        worker_files = sorted([os.path.join(workers_directory, file_name) for file_name in os.listdir(workers_directory) if file_name.endswith(".prof")])
+
+        stats = pstats.Stats(profile, stream=sys.stdout)
+        for worker_file in worker_files:
+            try:
+                stats.add(worker_file)
+            except Exception as exception: # a worker still writing, if the calculation was interrupted
+                print("Profile of worker not merged (" + os.path.basename(worker_file) + "): " + str(exception))
+
+        os.makedirs(self.directory, exist_ok=True)
+        file_root = os.path.join(self.directory, self.name + "-" + time.strftime("%Y%m%d-%H%M%S"))
+
+        self.profile_file = file_root + ".prof"
+        self.collapsed_stacks_file = file_root + ".collapsed"
+
+        stats.dump_stats(self.profile_file)
+        write_collapsed_stacks(stats, self.collapsed_stacks_file)
+
+        print("Profile (" + str(len(worker_files)) + " worker chunks merged) saved on " + self.profile_file + "\nCollapsed stacks saved on " + self.collapsed_stacks_file)
+
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(15)
+
+def get_frame_label(function):
+    file_name, line, name = function
+
+    if file_name == "~": return name.replace(";", ":") # built-in
+
+    return (name + " (" + os.path.basename(file_name) + ":" + str(line) + ")").replace(";", ":")
+
+def write_collapsed_stacks(stats, file_name, min_time=1e-6, max_depth=256):
+    '''
+    Collapsed stacks ("root;...;leaf <microseconds>") rebuilt from the caller/callee graph of the profile:
+    the time of a function is shared among its call paths in proportion to the time of each caller edge
+    '''
+    callees = defaultdict(dict)
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][function] = edge[3] # cumulative time of the calls from caller
+
+    stacks = defaultdict(float)
+
+    def visit(function, stack, path_time):
+        _, _, total_time, cumulative_time, _ = stats.stats[function]
+        fraction = path_time/cumulative_time if cumulative_time > 0 else 0.0
+
+        stack = stack + [function]
+        stacks[tuple(stack)] += total_time*fraction
+
+        if len(stack) < max_depth:
+            for callee, edge_time in callees[function].items():
+                if not callee in stack and edge_time*fraction >= min_time: visit(callee, stack, edge_time*fraction) # recursion: counted once
+
+    for function, (_, _, _, cumulative_time, callers) in stats.stats.items():
+        if len(callers) == 0: visit(function, [], cumulative_time)
+
+    with open(file_name, "w") as file:
+        for stack, stack_time in stacks.items():
+            microseconds = int(round(stack_time*1e6))
+            if microseconds > 0: file.write(";".join([get_frame_label(function) for function in stack]) + " " + str(microseconds) + "\n")
@@ -0,0 +1,383 @@
+import copy
+import json
+import time
+import threading
+import tracemalloc
+
+import numpy
+
+from wofry.propagator.propagator import PropagationManager, PropagationParameters, PropagationMode
+from wofry.propagator.wavefront1D.generic_wavefront import GenericWavefront1D
+
+from WofryWiser.propagator.propagator1D.wise_propagator import WisePropagator, WISE_APPLICATION
+from WofryWiser.propagator.wavefront1D.wise_wavefront import WiseWavefront
+
+from orangecontrib.OasysWiser.util import wise_positioning
+from orangecontrib.OasysWiser.util.wise_cache import WiserLRUCache, fingerprint
+from orangecontrib.OasysWiser.util.wise_sampling import get_sampling_geometry
+from orangecontrib.OasysWiser.util.wise_task import report_progress
+
+###############################################################
+#
+# PER-ELEMENT CHECKPOINTS
+#
+# Element keys chain the keys of the upstream elements (see
+# WiserData.element_keys): a change to element k changes the keys
+# of elements k..N only, so the checkpoints of elements 0..k-1 are
+# still valid and the computation can restart from element k.
+#
+# The number of samples of an element depends also on its next
+# propagation child (LibWiser GetSamplingListAuto): the checkpoint
+# key adds the sampling of the element to its element key.
+#
+###############################################################
+
+class WiserCheckpointStore(WiserLRUCache):
+
+    __instance = None
+
+    @classmethod
+    def Instance(cls):
+        if cls.__instance is None: cls.__instance = WiserCheckpointStore()
+
+        return cls.__instance
+
+    def store(self, element_key, native_optical_element):
+        computation_data = native_optical_element.ComputationData
+
+        if not element_key is None and not computation_data is None and not computation_data.Field is None:
+            self.put(element_key, copy.copy(computation_data)) # field buffers are shared, never modified in place
+
+    def restore(self, element_key, native_optical_element):
+        computation_data = None if element_key is None else self.get(element_key)
+
+        if computation_data is None:
+            return False
+        else:
+            native_optical_element.ComputationData = copy.copy(computation_data) # LibWiser assigns its attributes when recomputing
+
+            return True
+
+def get_checkpoint_key(element_key, native_optical_element, wavelength):
+    '''
+    Element key and sampling of the element, after the positions of the beamline have been refreshed:
+    custom number of samples, or the geometry of the automatic sampling. None if the sampling is unknown
+    '''
+    if element_key is None: return None
+
+    if native_optical_element.ComputationSettings.UseCustomSampling:
+        return fingerprint(element_key, int(native_optical_element.ComputationSettings.NSamples))
+    else:
+        sampling_geometry = get_sampling_geometry(native_optical_element, wavelength)
+
+        return None if sampling_geometry is None else fingerprint(element_key, sampling_geometry.get_key())
+
+class EvalFieldWrapper(object):
+    '''
+    Wraps the EvalField method of the CoreOptics of the beamline elements (LibWiser integrates the field
+    on an element by calling EvalField of the upstream one) for the duration of a with block: wrappers
+    can be nested, each one restoring what it replaced
+    '''
+
+    def __init__(self, native_optical_elements):
+        self.native_optical_elements = native_optical_elements
+        self.__replaced = []
+
+    def __enter__(self):
+        for index, native_optical_element in enumerate(self.native_optical_elements):
+            core_optics = native_optical_element.CoreOptics
+
+            self.__replaced.append(vars(core_optics).get("EvalField", None))
+            core_optics.EvalField = self.wrap(index, native_optical_element, core_optics.EvalField)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for native_optical_element, replaced in zip(self.native_optical_elements, self.__replaced):
+            if replaced is None: del native_optical_element.CoreOptics.EvalField # the class method is visible again
+            else: native_optical_element.CoreOptics.EvalField = replaced
+        self.__replaced = []
+
+        return False
+
+    def wrap(self, index, native_optical_element, eval_field):
+        raise NotImplementedError()
+
+class ElementStepMonitor(EvalFieldWrapper):
+    '''
+    Calls on_step(step, n_steps, optical_element) before every field integration performed by LibWiser
+    '''
+
+    def __init__(self, native_optical_elements, on_step, n_steps=None):
+        super().__init__(native_optical_elements)
+
+        self.on_step = on_step
+        self.n_steps = len(native_optical_elements) if n_steps is None else n_steps
+        self.step = 0
+
+    def wrap(self, index, native_optical_element, eval_field):
+        def wrapped_eval_field(*args, **kwargs):
+            self.on_step(self.step, self.n_steps, native_optical_element)
+            self.step += 1
+
+            return eval_field(*args, **kwargs)
+
+        return wrapped_eval_field
+
+###############################################################
+#
+# PER-ELEMENT INSTRUMENTATION
+#
+###############################################################
+
+FIELD_DATA = ["Field", "S", "X", "Y"]
+
+class MemoryTracing(object):
+    '''
+    tracemalloc is process-wide and every widget computes on its own thread: tracing is started by the first
+    user and stopped by the last one. Each measure resets the peak: it is valid only if no other user traced
+    meanwhile (see is_exclusive)
+    '''
+    __lock = threading.Lock()
+    __n_users = 0
+    __n_starts = 0
+    __is_owner = False # tracing started here, not by the user of the process
+
+    @classmethod
+    def start(cls):
+        with cls.__lock:
+            if cls.__n_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                cls.__is_owner = True
+
+            cls.__n_users += 1
+            cls.__n_starts += 1
+
+    @classmethod
+    def stop(cls):
+        with cls.__lock:
+            cls.__n_users -= 1
+
+            if cls.__n_users == 0 and cls.__is_owner:
+                tracemalloc.stop()
+                cls.__is_owner = False
+
+    @classmethod
+    def begin_measure(cls):
+        '''
+        Resets the peak: returns a token for is_exclusive and the memory in use
+        '''
+        with cls.__lock:
+            tracemalloc.reset_peak()
+
+            return cls.__n_starts, tracemalloc.get_traced_memory()[0]
+
+    @classmethod
+    def is_exclusive(cls, token):
+        # the only user from begin_measure until now: nobody else has reset the peak
+        with cls.__lock:
+            return cls.__n_users == 1 and cls.__n_starts == token
+
+class ElementMetrics(object):
+
+    def __init__(self, index, name, wall_time, peak_memory=None, n_samples=None, field_bytes=None):
+        self.index = index
+        self.name = name
+        self.wall_time = wall_time     # [s]
+        self.peak_memory = peak_memory # [bytes] process peak above the memory in use at the start of the integration
+        self.n_samples = n_samples
+        self.field_bytes = field_bytes
+
+    def to_dict(self):
+        return {"index" : self.index,
+                "name" : self.name,
+                "wall_time" : self.wall_time,
+                "n_samples" : self.n_samples,
+                "peak_memory" : self.peak_memory,
+                "field_bytes" : self.field_bytes}
+
+def get_field_bytes(computation_data):
+    if computation_data is None: return 0
+
+    return int(sum([data.nbytes for data in [getattr(computation_data, name, None) for name in FIELD_DATA] if isinstance(data, numpy.ndarray)]))
+
+class ElementInstrumentation(EvalFieldWrapper):
+    '''
+    Records the ElementMetrics of every field computed on the elements of a linear beamline: wall time of the
+    integration and, if track_memory, the peak memory of the process (tracemalloc: allocations of all the threads
+    of this process, not those of the multipool workers), None if another calculation was tracing meanwhile.
+    Number of samples and bytes of the field data are read at the end of the block
+    '''
+
+    def __init__(self, native_optical_elements, track_memory=True):
+        super().__init__(native_optical_elements)
+
+        self.track_memory = track_memory and hasattr(tracemalloc, "reset_peak") # Python >= 3.9
+        self.metrics = []
+
+    def __enter__(self):
+        if self.track_memory: MemoryTracing.start()
+
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            if self.track_memory: MemoryTracing.stop()
+
+        for metrics in self.metrics:
+            computation_data = self.native_optical_elements[metrics.index].ComputationData
+
+            metrics.n_samples = None if computation_data is None or computation_data.NSamples is None else int(computation_data.NSamples)
+            metrics.field_bytes = get_field_bytes(computation_data)
+
+        return False
+
+    def get_target_index(self, index):
+        # the field computed by EvalField of an element is on the first downstream element not ignored
+        for target_index in range(index + 1, len(self.native_optical_elements)):
+            if not self.native_optical_elements[target_index].ComputationSettings.Ignore: return target_index
+
+        return None
+
+    def wrap(self, index, native_optical_element, eval_field):
+        def wrapped_eval_field(*args, **kwargs):
+            if self.track_memory: token, memory_start = MemoryTracing.begin_measure()
+
+            t0 = time.perf_counter()
+            field = eval_field(*args, **kwargs)
+            wall_time = time.perf_counter() - t0
+
+            peak_memory = tracemalloc.get_traced_memory()[1] - memory_start if self.track_memory and MemoryTracing.is_exclusive(token) else None
+
+            target_index = self.get_target_index(index)
+
+            if not target_index is None:
+                self.metrics.append(ElementMetrics(target_index,
+                                                   self.native_optical_elements[target_index].Name,
+                                                   wall_time,
+                                                   peak_memory=peak_memory))
+
+            return field
+
+        return wrapped_eval_field
+
+    def get_total_time(self):
+        return sum([metrics.wall_time for metrics in self.metrics])
+
+def save_element_metrics(file_name, element_metrics, append=False, **context):
+    '''
+    JSON lines: one object per element, with the context (e.g. widget, run) added to each of them
+    '''
+    with open(file_name, "a" if append else "w") as file:
+        for metrics in element_metrics:
+            file.write(json.dumps(dict(context, **metrics.to_dict())) + "\n")
+
+def compute_fields_from(beamline, native_optical_elements, n_computed):
+    '''
+    Computes the fields on native_optical_elements[n_computed:], those on the first n_computed elements
+    being available: as in LibWiser.Foundation.ZSweep the last of them acts as source, since
+    ComputeFields does nothing on a single element
+    '''
+    if n_computed == 0:
+        beamline.ComputeFields(oeStart=native_optical_elements[0], oeEnd=native_optical_elements[-1], Verbose=False)
+    else:
+        upstream_optical_element = native_optical_elements[n_computed-1]
+        is_source = upstream_optical_element._IsSource
+
+        upstream_optical_element._IsSource = True
+        try:
+            beamline.ComputeFields(oeStart=upstream_optical_element, oeEnd=native_optical_elements[-1], Verbose=False)
+        finally:
+            upstream_optical_element._IsSource = is_source
+
+###############################################################
+#
+# INCREMENTAL PROPAGATOR
+#
+###############################################################
+
+class WiserIncrementalPropagator(WisePropagator):
+    '''
+    In Whole Beamline mode, the full propagation restarts from the last element whose field
+    has been computed before with the same upstream chain, instead of restarting from the source
+    '''
+
+    HANDLER_NAME = "WISER_INCREMENTAL_PROPAGATOR"
+
+    def get_handler_name(self):
+        return self.HANDLER_NAME
+
+    def do_propagation(self, parameters=PropagationParameters()):
+        if self.is_incremental_propagation(parameters):
+            return self.do_incremental_propagation(parameters)
+        else:
+            wise_propagation_elements = parameters.get_PropagationElements()
+            native_optical_elements = [wise_propagation_elements.get_wise_propagation_element(index) for index in range(wise_propagation_elements.get_propagation_elements_number())]
+
+            if parameters.has_additional_parameter("single_propagation") and parameters.get_additional_parameter("single_propagation"):
+                n_steps = 1 # only the field on the last element
+            else:
+                n_steps = max(1, len([oe for oe in native_optical_elements if not oe.IsSource]))
+
+            with self.get_step_monitor(native_optical_elements, n_steps):
+                return super(WiserIncrementalPropagator, self).do_propagation(parameters)
+
+    @classmethod
+    def get_step_monitor(cls, native_optical_elements, n_steps):
+        # progress reported, and cancellation checked, before the field on each element
+        def on_step(step, n_steps, native_optical_element):
+            report_progress(100*step/n_steps, "Propagating Wavefront (" + str(min(step+1, n_steps)) + "/" + str(n_steps) + ")")
+
+        return ElementStepMonitor(native_optical_elements, on_step, n_steps=n_steps)
+
+    @classmethod
+    def is_incremental_propagation(cls, parameters):
+        return PropagationManager.Instance().get_propagation_mode(WISE_APPLICATION) == PropagationMode.WHOLE_BEAMLINE and \
+               parameters.get_additional_parameter("is_full_propagator") and \
+               not parameters.get_additional_parameter("single_propagation") and \
+               parameters.has_additional_parameter("element_keys") and \
+               not isinstance(parameters.get_wavefront(), GenericWavefront1D)
+
+    def do_incremental_propagation(self, parameters):
+        wise_propagation_elements = parameters.get_PropagationElements()
+        element_keys = parameters.get_additional_parameter("element_keys")
+
+        n_elements = wise_propagation_elements.get_propagation_elements_number()
+        native_optical_elements = [wise_propagation_elements.get_wise_propagation_element(index) for index in range(n_elements)]
+
+        beamline = wise_propagation_elements.get_wise_propagation_elements()
+        beamline.ComputationSettings.NPools = int(parameters.get_additional_parameter("NPools"))
+        beamline.RefreshPositions()
+
+        checkpoint_store = WiserCheckpointStore.Instance()
+        checkpoint_keys = [get_checkpoint_key(element_keys[index] if index < len(element_keys) else None, native_optical_elements[index], beamline.Lambda)
+                           for index in range(n_elements)]
+
+        n_restored = 0
+        n_reused = 0 # fields restored, the source not included
+        if len(element_keys) == n_elements and not self.__has_downstream_references(native_optical_elements):
+            for index in range(n_elements - 1): # the last element is always computed
+                if not native_optical_elements[index].IsSource:
+                    if not checkpoint_store.restore(checkpoint_keys[index], native_optical_elements[index]): break
+                    n_reused += 1
+                n_restored += 1
+
+        if n_reused > 0: print("Fields on " + str(n_reused) + " upstream elements unchanged: propagation restarts from " + native_optical_elements[n_restored].Name)
+
+        n_steps = max(1, len([oe for oe in native_optical_elements[n_restored:] if not oe.IsSource]))
+
+        with self.get_step_monitor(native_optical_elements, n_steps):
+            compute_fields_from(beamline, native_optical_elements, n_restored)
+
+        for index in range(n_restored, n_elements):
+            checkpoint_store.store(checkpoint_keys[index], native_optical_elements[index])
+
+        return WiseWavefront(wise_computation_results=native_optical_elements[-1].ComputationData)
+
+    @classmethod
+    def __has_downstream_references(cls, native_optical_elements):
+        # the position (and then the field) of the element would depend on the downstream ones, not in its key
+        return any([not oe.PositioningDirectives is None and oe.PositioningDirectives.ReferTo == wise_positioning.ReferTo.DownstreamElement
+                    for oe in native_optical_elements])
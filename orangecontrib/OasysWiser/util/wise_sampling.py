@@ -0,0 +1,138 @@
+import numpy
+
+from orangecontrib.OasysWiser.util.wise_cache import WiserLRUCache, fingerprint
+
+###############################################################
+#
+# SAMPLING OF THE FIELD ON AN OPTICAL ELEMENT, as in LibWiser
+# (BeamlineElements.GetSamplingListAuto): the number of samples
+# of an element comes from the geometry of the element and of
+# its next propagation child; the last element keeps the one of
+# the element upstream (Rayman.ComputeSamplingA):
+#
+#   N0 = L0 * L1 * |cos(Theta0 - Theta1)| / (Lambda * z)
+#
+# LibWiser automatic sampling is OVERSAMPLING_FACTOR * N0.
+# Along the element, the phase of the Huygens-Fresnel kernel
+# changes by pi * N0 / N per sample at the edges of the element
+# (pi / OVERSAMPLING_FACTOR with the automatic sampling):
+# N = pi * N0 / phase_tolerance keeps it below phase_tolerance,
+# and never above the automatic sampling
+#
+# The number of samples of an element counts only when the field
+# upstream is analytic: downstream of a numeric field LibWiser
+# keeps its number of samples (ComputeFieldsMediator), so that
+# only the first numeric element of a beamline can be sampled
+# with a budget
+#
+###############################################################
+
+OVERSAMPLING_FACTOR = 10 # as in LibWiser Foundation.OpticalElement.GetNSamples12
+MINIMUM_SAMPLES = 2
+DEFAULT_PHASE_TOLERANCE = 1.0 # rad: N ~ 3 * N0, i.e. ~1/3 of the automatic sampling
+
+class SamplingGeometry(object):
+    '''
+    Propagation from the start plane (length, angle) to the arrival plane, at distance
+    '''
+    def __init__(self, wavelength, distance, start_length, arrival_length, start_angle, arrival_angle):
+        self.wavelength = wavelength
+        self.distance = distance
+        self.start_length = start_length
+        self.arrival_length = arrival_length
+        self.start_angle = start_angle
+        self.arrival_angle = arrival_angle
+
+    def get_key(self):
+        return fingerprint([float("%.12g" % value) for value in (self.wavelength, self.distance, self.start_length, self.arrival_length, self.start_angle, self.arrival_angle)])
+
+    def get_n0(self):
+        return self.start_length*self.arrival_length*numpy.abs(numpy.cos(self.start_angle - self.arrival_angle))/self.wavelength/self.distance
+
+    def get_automatic_samples(self):
+        return int(OVERSAMPLING_FACTOR*self.get_n0())
+
+    def get_samples_for_phase_tolerance(self, phase_tolerance):
+        return max(MINIMUM_SAMPLES, min(int(numpy.ceil(numpy.pi*self.get_n0()/phase_tolerance)), self.get_automatic_samples()))
+
+def get_sampling_geometry(native_optical_element, wavelength):
+    '''
+    Geometry LibWiser uses for the number of samples of native_optical_element, after the positions of
+    the beamline have been refreshed: the element and its next propagation child or, for the last element,
+    the upstream element and the element. None if the start element is missing or analytic (i.e. a
+    source, whose field is not integrated)
+    '''
+    try:
+        if wavelength is None or native_optical_element.CoreOptics._IsAnalytic: return None
+
+        orientation = native_optical_element.ParentContainer._GetFirstOrientedElement().CoreOptics.Orientation # as in GetSamplingListAuto
+        downstream_optical_element = native_optical_element.GetNextPropagationChild(Orientation=orientation)
+
+        if downstream_optical_element is None:
+            start_optical_element = native_optical_element.GetParent(SameOrientation=True, OnlyReference=False)
+            arrival_optical_element = native_optical_element
+
+            if start_optical_element is None or start_optical_element.CoreOptics._IsAnalytic: return None
+        else:
+            start_optical_element = native_optical_element
+            arrival_optical_element = downstream_optical_element
+
+        distance = numpy.linalg.norm(numpy.array(arrival_optical_element.CoreOptics.XYCentre) - numpy.array(start_optical_element.CoreOptics.XYCentre))
+
+        if distance == 0.0: return None
+
+        return SamplingGeometry(wavelength=wavelength,
+                                distance=distance,
+                                start_length=start_optical_element.CoreOptics.L,
+                                arrival_length=arrival_optical_element.CoreOptics.L,
+                                start_angle=start_optical_element.CoreOptics.VersorNorm.Angle,
+                                arrival_angle=arrival_optical_element.CoreOptics.VersorNorm.Angle)
+    except Exception as exception:
+        print("Sampling geometry not available: " + str(exception))
+
+        return None
+
+def get_upstream_element(native_optical_element):
+    '''
+    Element whose field LibWiser propagates to native_optical_element: the first upstream element not ignored
+    '''
+    upstream_optical_element = native_optical_element.GetParent(SameOrientation=True, OnlyReference=False)
+
+    while not upstream_optical_element is None and upstream_optical_element.ComputationSettings.Ignore and not upstream_optical_element.IsSource:
+        upstream_optical_element = upstream_optical_element.GetParent(SameOrientation=True, OnlyReference=False)
+
+    return upstream_optical_element
+
+def is_sampling_inherited(native_optical_element):
+    upstream_optical_element = get_upstream_element(native_optical_element)
+
+    return not upstream_optical_element is None and not upstream_optical_element.CoreOptics._IsAnalytic
+
+def get_budget_samples(native_optical_element, wavelength, phase_tolerance):
+    '''
+    Number of samples of native_optical_element for phase_tolerance, after the positions of the beamline
+    have been refreshed. None if the sampling is inherited from the upstream field or the geometry is not available
+    '''
+    if is_sampling_inherited(native_optical_element): return None
+
+    sampling_geometry = get_sampling_geometry(native_optical_element, wavelength)
+
+    return None if sampling_geometry is None else sampling_geometry.get_samples_for_phase_tolerance(phase_tolerance)
+
+class WiserSamplingCache(WiserLRUCache):
+    '''
+    Number of points chosen by LibWiser automatic sampling, per sampling geometry
+    '''
+    __instance = None
+
+    @classmethod
+    def Instance(cls):
+        if cls.__instance is None: cls.__instance = WiserSamplingCache()
+
+        return cls.__instance
+
+    def put_samples(self, sampling_geometry, n_samples):
+        if not sampling_geometry is None and not n_samples is None: self.put(sampling_geometry.get_key(), int(n_samples), nbytes=64) # nominal size: the memory budget bounds the number of entries
+
+    def get_samples(self, sampling_geometry):
+        return None if sampling_geometry is None else self.get(sampling_geometry.get_key())
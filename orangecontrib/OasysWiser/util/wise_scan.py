@@ -0,0 +1,220 @@
+import pickle
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+from orangecontrib.OasysWiser.util import wise_positioning
+from orangecontrib.OasysWiser.util.wise_batch import BatchElement, ELEMENT_BUILDERS, apply_sampling_budget, propagate, build_deferred_elements
+from orangecontrib.OasysWiser.util.wise_focus import detach_optical_element, normalize_intensity, half_energy_width, _build_sweep_beamline, _compute_defocus
+from orangecontrib.OasysWiser.util.wise_task import report_progress, report_partial_result, check_cancelled
+from orangecontrib.OasysWiser.util.wise_profiling import profiled_worker
+
+###############################################################
+#
+# PARAMETER SCAN: the settings of the last element of the beamline
+# change, the fields on the upstream elements are computed once
+# and shared by all the points of the scan
+#
+###############################################################
+
+class ScanMode:
+    GRID = 0
+    TOLERANCE = 1
+
+DISPLACEMENT_SETTINGS = ["rotation", "transverse", "longitudinal"]
+
+class ScanRange(object):
+
+    def __init__(self, name, start, stop, n_points):
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.n_points = n_points
+
+def parse_scan_ranges(text):
+    '''
+    One range per line: <setting> <start> <stop> <number of points>
+    '''
+    scan_ranges = []
+
+    for line in text.splitlines():
+        tokens = line.split("#")[0].split()
+
+        if len(tokens) == 0: continue
+        if len(tokens) != 4: raise ValueError("Bad scan range: \"" + line.strip() + "\" (expected: setting start stop points)")
+
+        scan_ranges.append(ScanRange(tokens[0], float(tokens[1]), float(tokens[2]), int(tokens[3])))
+
+    if len(scan_ranges) == 0: raise ValueError("No scan range defined")
+
+    return scan_ranges
+
+def make_scan_points(scan_ranges, mode=ScanMode.GRID, n_samples=100, seed=0):
+    '''
+    GRID: every combination of the values of the ranges.
+    TOLERANCE: n_samples points, each setting uniformly distributed between start and stop
+    '''
+    if mode == ScanMode.GRID:
+        return numpy.array(list(product(*[numpy.linspace(scan_range.start, scan_range.stop, scan_range.n_points) for scan_range in scan_ranges])))
+    else:
+        random_generator = numpy.random.default_rng(seed)
+
+        return numpy.array([random_generator.uniform(scan_range.start, scan_range.stop, n_samples) for scan_range in scan_ranges]).T
+
+class ScanResult(object):
+
+    def __init__(self, parameter_names, points, electric_fields, positions, hews, peak_intensities, indices=None):
+        self.parameter_names = list(parameter_names)
+        self.points = numpy.asarray(points, dtype=float)
+        self.electric_fields = electric_fields
+        self.positions = positions
+        self.hews = numpy.asarray(hews, dtype=float)
+        self.peak_intensities = numpy.asarray(peak_intensities, dtype=float)
+        self.indices = numpy.arange(len(self.hews)) if indices is None else numpy.asarray(indices)
+
+    def get_best_index(self):
+        return int(numpy.nanargmin(self.hews)) if numpy.any(numpy.isfinite(self.hews)) else -1
+
+    def save(self, file_name):
+        numpy.savetxt(file_name,
+                      numpy.column_stack((self.points, self.hews, self.peak_intensities)),
+                      header=" ".join(self.parameter_names + ["HEW[m]", "Peak_Intensity"]))
+
+def get_point_settings(settings, parameter_names, point):
+    point_settings = dict(settings)
+
+    for name, value in zip(parameter_names, point):
+        if isinstance(settings[name], int) and not isinstance(settings[name], bool): value = int(round(value))
+        point_settings[name] = value
+
+        if name in DISPLACEMENT_SETTINGS: point_settings["use_small_displacements"] = 1
+
+    return point_settings
+
+def prepare_upstream_data(upstream_data, n_pools=1):
+    '''
+    Shared view of the upstream beamline, with the field on its last element computed
+    '''
+    is_writable = upstream_data.has_deferred_elements()
+    if is_writable: upstream_data = build_deferred_elements(upstream_data) # Whole Beamline mode: no field computed yet
+
+    native_optical_elements = [upstream_data.wise_beamline.get_wise_propagation_element(index) for index in range(upstream_data.get_elements_number())]
+
+    if any([not oe.PositioningDirectives is None and oe.PositioningDirectives.ReferTo == wise_positioning.ReferTo.DownstreamElement for oe in native_optical_elements]):
+        raise ValueError("Scan not available: the position of an upstream element depends on the downstream elements")
+
+    last_optical_element = native_optical_elements[-1]
+
+    if not last_optical_element.IsSource and (last_optical_element.ComputationData is None or last_optical_element.ComputationData.Field is None):
+        report_progress(0, "Propagating Wavefront to the upstream element")
+
+        upstream_data = propagate(upstream_data if is_writable else upstream_data.duplicate(writable=True), n_pools=n_pools)
+
+    return upstream_data.duplicate()
+
+def _compute_point(upstream_data, widget, settings, workspace_units_to_m, detector_size, defocus, figure_error_profile=None):
+    from WofryWiser.beamline.beamline_elements import WiserBeamlineElement
+    from orangecontrib.OasysWiser.util.wise_propagation import compute_fields_from
+
+    wiser_data = upstream_data.duplicate(writable=True)
+    n_computed = wiser_data.get_elements_number()
+
+    wiser_data.wise_beamline.add_beamline_element(WiserBeamlineElement(optical_element=BatchElement(widget, settings, figure_error_profile=figure_error_profile).build(workspace_units_to_m)))
+
+    beamline = wiser_data.wise_beamline.get_wise_propagation_elements()
+    beamline.RefreshPositions()
+
+    if settings.get("calculation_type", 0) == 2: apply_sampling_budget(wiser_data, settings["phase_tolerance"])
+
+    native_optical_elements = [wiser_data.wise_beamline.get_wise_propagation_element(index) for index in range(n_computed + 1)]
+
+    compute_fields_from(beamline, native_optical_elements, n_computed)
+
+    if detector_size is None:
+        electric_field = numpy.copy(native_optical_elements[-1].ComputationData.Field)
+        positions = numpy.copy(native_optical_elements[-1].ComputationData.S)
+        hew = half_energy_width(normalize_intensity(electric_field), numpy.mean(numpy.abs(numpy.diff(positions))))
+    else:
+        sweep_beamline, detector = _build_sweep_beamline(detach_optical_element(native_optical_elements[-1]), detector_size, n_pools=1)
+        electric_field, positions, hew = _compute_defocus(sweep_beamline, detector, defocus)
+
+    return electric_field, positions, hew, numpy.max(numpy.abs(electric_field)**2)
+
+@profiled_worker
+def _compute_point_chunk(upstream_data_dump, widget, points_settings, workspace_units_to_m, detector_size, defocus, figure_error_profile):
+    upstream_data = pickle.loads(upstream_data_dump)
+
+    return [_compute_point(upstream_data, widget, settings, workspace_units_to_m, detector_size, defocus, figure_error_profile) for settings in points_settings]
+
+def compute_scan(upstream_data, widget, settings, parameter_names, points, workspace_units_to_m=1.0, detector_size=None, defocus=0.0, n_pools=1, figure_error_profile=None):
+    '''
+    Computes the field on the element built by widget (see wise_batch.ELEMENT_BUILDERS) with settings, at the end
+    of the beamline of upstream_data, for each point (values of the settings in parameter_names). With detector_size
+    the field is computed on a detector at defocus from the downstream focus of the element. With n_pools > 1 the
+    points are shared among n_pools processes. Every completed group of points is reported as partial ScanResult.
+    The figure error profile (wise_figure_error.FigureErrorProfile), if given, replaces the figure error file
+    '''
+    if not widget in ELEMENT_BUILDERS: raise ValueError("Scan not available for " + str(widget))
+
+    for name in parameter_names:
+        if not name in settings: raise ValueError("Unknown setting: " + name)
+
+    points = numpy.atleast_2d(numpy.asarray(points, dtype=float))
+    n_points = len(points)
+
+    upstream_data = prepare_upstream_data(upstream_data, n_pools)
+
+    points_settings = [get_point_settings(settings, parameter_names, point) for point in points]
+
+    electric_fields = [None]*n_points
+    positions = [None]*n_points
+    hews = numpy.full(n_points, numpy.nan)
+    peak_intensities = numpy.full(n_points, numpy.nan)
+
+    def collect(indices, chunk_results):
+        for index, (electric_field, position, hew, peak_intensity) in zip(indices, chunk_results):
+            electric_fields[index] = electric_field
+            positions[index] = position
+            hews[index] = hew
+            peak_intensities[index] = peak_intensity
+
+        n_done = n_points - len([field for field in electric_fields if field is None])
+
+        report_progress(100*n_done/n_points, "Scan (" + str(n_done) + "/" + str(n_points) + ")")
+        report_partial_result(ScanResult(parameter_names,
+                                         points[indices],
+                                         [electric_fields[index] for index in indices],
+                                         [positions[index] for index in indices],
+                                         hews[indices],
+                                         peak_intensities[indices],
+                                         indices=indices))
+
+    upstream_data_dump = None
+    if n_pools > 1 and n_points > 1:
+        try:
+            upstream_data_dump = pickle.dumps(upstream_data, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as exception:
+            print("Scan cannot be distributed among processes (" + str(exception) + "): running sequentially")
+
+    if upstream_data_dump is None:
+        for index in range(n_points):
+            check_cancelled()
+            collect([index], [_compute_point(upstream_data, widget, points_settings[index], workspace_units_to_m, detector_size, defocus, figure_error_profile)])
+    else:
+        chunks = numpy.array_split(numpy.arange(n_points), min(n_points, 4*n_pools))
+
+        executor = ProcessPoolExecutor(max_workers=n_pools)
+        futures = {}
+        try:
+            futures = {executor.submit(_compute_point_chunk, upstream_data_dump, widget, [points_settings[index] for index in chunk],
+                                       workspace_units_to_m, detector_size, defocus, figure_error_profile): chunk for chunk in chunks}
+
+            for future in as_completed(futures):
+                check_cancelled()
+                collect(futures[future], future.result())
+        finally:
+            for future in futures: future.cancel()
+            executor.shutdown(wait=False)
+
+    return ScanResult(parameter_names, points, electric_fields, positions, hews, peak_intensities)
@@ -0,0 +1,68 @@
+import threading
+
+class WiserCancelledException(Exception):
+    pass
+
+class WiserTask(object):
+
+    def __init__(self, progress_callback=None, partial_result_callback=None):
+        super().__init__()
+
+        self._cancelled = threading.Event()
+        self._progress_callback = progress_callback
+        self._partial_result_callback = partial_result_callback
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        if self.is_cancelled(): raise WiserCancelledException("Calculation cancelled by user")
+
+    def report_progress(self, value, message=""):
+        self.check_cancelled()
+
+        if not self._progress_callback is None: self._progress_callback(float(value), message)
+
+    def report_partial_result(self, partial_result):
+        self.check_cancelled()
+
+        if not self._partial_result_callback is None: self._partial_result_callback(partial_result)
+
+###############################################################
+#
+# TASK OF THE CURRENT THREAD: lets the calculation code report
+# progress or check cancellation without passing the task around
+#
+###############################################################
+
+_current = threading.local()
+
+def get_current_task():
+    return getattr(_current, "task", None)
+
+def set_current_task(task):
+    _current.task = task
+
+def report_progress(value, message=""):
+    task = get_current_task()
+    if not task is None: task.report_progress(value, message)
+
+def report_partial_result(partial_result):
+    task = get_current_task()
+    if not task is None: task.report_partial_result(partial_result)
+
+def check_cancelled():
+    task = get_current_task()
+    if not task is None: task.check_cancelled()
+
+def run_as_task(task, function, *args, **kwargs):
+    previous_task = get_current_task()
+    set_current_task(task)
+
+    try:
+        return function(*args, **kwargs)
+    finally:
+        set_current_task(previous_task)
@@ -0,0 +1,134 @@
+import sys
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from orangecontrib.OasysWiser.util.wise_task import WiserTask, WiserCancelledException, run_as_task, get_current_task
+
+class _WiserTaskSignals(QObject):
+    progress  = pyqtSignal(float, str)
+    partial   = pyqtSignal(object)
+    finished  = pyqtSignal(object)
+    failed    = pyqtSignal(object)
+    cancelled = pyqtSignal()
+    output    = pyqtSignal(str)
+
+class WiserBackgroundTask(WiserTask):
+
+    PROGRESS_INTERVAL = 0.1 # s: fast loops do not flood the GUI thread with progress signals
+
+    def __init__(self):
+        self.signals = _WiserTaskSignals() # created in the GUI thread: connected callbacks are executed there
+        self.future = None
+        self.has_output = False # standard output of the task sent to the output signal
+        self._last_progress_time = 0.0
+
+        super().__init__(progress_callback=self._emit_progress,
+                         partial_result_callback=self.signals.partial.emit)
+
+    def _emit_progress(self, value, message):
+        now = time.monotonic()
+
+        if value >= 100 or now - self._last_progress_time >= self.PROGRESS_INTERVAL:
+            self._last_progress_time = now
+            self.signals.progress.emit(value, message)
+
+    def disconnect(self):
+        # the callbacks of an abandoned task are not executed anymore
+        for signal in [self.signals.progress, self.signals.partial, self.signals.finished, self.signals.failed, self.signals.cancelled, self.signals.output]:
+            try:
+                signal.disconnect()
+            except TypeError:
+                pass # nothing connected
+
+    def is_running(self):
+        return not self.future is None and not self.future.done()
+
+###############################################################
+#
+# STANDARD OUTPUT: sys.stdout is one for all the threads, and
+# the tasks of different widgets run at the same time. The text
+# printed by a task with on_output goes to its output signal,
+# the rest to the stream set by redirect_stdout
+#
+###############################################################
+
+class _WiserOutputStream(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        task = get_current_task()
+
+        if isinstance(task, WiserBackgroundTask) and task.has_output: task.signals.output.emit(str(text))
+        elif not self.stream is None: self.stream.write(text)
+
+    def flush(self):
+        if hasattr(self.stream, "flush"): self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+_output_lock = threading.Lock()
+
+def redirect_stdout(stream=None):
+    '''
+    Output of the threads not running a task with on_output (e.g. the GUI thread) sent to stream: to be
+    used instead of sys.stdout = stream, that would redirect the output of the running tasks too
+    '''
+    with _output_lock:
+        if not isinstance(sys.stdout, _WiserOutputStream): sys.stdout = _WiserOutputStream(sys.stdout)
+        if not stream is None: sys.stdout.stream = stream
+
+class WiserExecutor(object):
+    '''
+    Runs calculations out of the Qt event loop: progress, partial results, standard output and the
+    outcome are delivered back to the GUI thread through Qt signals
+    '''
+
+    def __init__(self, max_workers=1):
+        super().__init__()
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, function, *args,
+               on_finished=None, on_failed=None, on_cancelled=None, on_progress=None, on_partial_result=None, on_output=None, **kwargs):
+        task = WiserBackgroundTask()
+
+        if not on_finished is None: task.signals.finished.connect(on_finished)
+        if not on_failed is None: task.signals.failed.connect(on_failed)
+        if not on_cancelled is None: task.signals.cancelled.connect(on_cancelled)
+        if not on_progress is None: task.signals.progress.connect(on_progress)
+        if not on_partial_result is None: task.signals.partial.connect(on_partial_result)
+        if not on_output is None:
+            task.signals.output.connect(on_output)
+            task.has_output = True
+
+            redirect_stdout()
+
+        task.future = self._executor.submit(self._run, task, function, *args, **kwargs)
+
+        return task
+
+    @classmethod
+    def _run(cls, task, function, *args, **kwargs):
+        try:
+            task.check_cancelled()
+
+            result = run_as_task(task, function, *args, **kwargs)
+
+            task.check_cancelled()
+            task.signals.finished.emit(result)
+        except WiserCancelledException:
+            task.signals.cancelled.emit()
+        except Exception as exception:
+            traceback.print_exc()
+
+            task.signals.failed.emit(exception)
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait)
@@ -2,23 +2,17 @@ __author__ = 'labx'
 
 import sys
 
-try:
-    import matplotlib
-    import matplotlib.pyplot as plt
-    from matplotlib import cm
-    from matplotlib import figure as matfig
-    import pylab
-except ImportError:
-    print(sys.exc_info()[1])
-    pass
-
-from LibWiser.ToolLib import CommonPlots as LibWiserPlot
+# matplotlib and LibWiser are imported when plotting: not needed to register the widgets
 
 class WiserPlot:
 
     @classmethod
     def plot_histo(cls, plot_window, x, y, title, xtitle, ytitle):
-        matplotlib.rcParams['axes.formatter.useoffset']='False'
+        try:
+            import matplotlib
+            matplotlib.rcParams['axes.formatter.useoffset']='False'
+        except ImportError:
+            print(sys.exc_info()[1])
 
         plot_window.addCurve(x, y, title, symbol='', color='blue', replace=True) #'+', '^', ','
         if not xtitle is None: plot_window.setGraphXLabel(xtitle)
@@ -29,6 +23,8 @@ class WiserPlot:
         plot_window.replot()
 
     def IntensityAtOE(self, **kwargs):
+        from LibWiser.ToolLib import CommonPlots as LibWiserPlot
+
         return LibWiserPlot.IntensityAtOpticalElement(self, **kwargs)
 
     ### TODO: put other plots here as well, or just overwrite WiserPlot with CommonPlots as WiserPlot
@@ -1,24 +1,30 @@
+import os, time
 import numpy
 import multiprocessing
 
-from PyQt5.QtWidgets import QApplication, QMessageBox, QInputDialog
+from PyQt5.QtWidgets import QApplication, QMessageBox, QInputDialog, QFileDialog, QTableWidget, QTableWidgetItem, QAbstractItemView
+from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QPalette, QColor, QFont
 from orangewidget import gui
 from orangewidget.settings import Setting
 from oasys.widgets import gui as oasysgui
 from oasys.widgets import congruence
+from oasys.util.oasys_util import EmittingStream
 
-from syned.widget.widget_decorator import WidgetDecorator
-from syned.beamline.optical_elements.mirrors.mirror import Mirror
-
-from wofry.propagator.propagator import PropagationManager, PropagationParameters, PropagationMode
-
-from WofryWiser.propagator.propagator1D.wise_propagator import WisePropagator, WisePropagationElements, WISE_APPLICATION
-from WofryWiser.propagator.wavefront1D.wise_wavefront import WiseWavefront
-from WofryWiser.beamline.beamline_elements import WiserBeamlineElement
+from syned.widget.widget_decorator import WidgetDecorator # the syned input channels are declared with the class
 
+from orangecontrib.OasysWiser.util.wise_util import WiserPlot
 from orangecontrib.OasysWiser.util.wise_objects import WiserData, WiserPreInputData
-from orangecontrib.OasysWiser.widgets.gui.ow_wise_widget import WiseWidget, ElementType
+from orangecontrib.OasysWiser.util.wise_cache import WiserResultCache, WiserDiskCache, fingerprint
+from orangecontrib.OasysWiser.util.wise_task import report_progress
+from orangecontrib.OasysWiser.util.wise_threading import redirect_stdout
+from orangecontrib.OasysWiser.util.wise_sampling import WiserSamplingCache, get_sampling_geometry, is_sampling_inherited, DEFAULT_PHASE_TOLERANCE
+from orangecontrib.OasysWiser.util.wise_batch import configure_optical_element, ELEMENT_BUILDERS, BatchElement, DeferredElement, build_deferred_elements, apply_sampling_budget
+from orangecontrib.OasysWiser.util.wise_figure_error import FILE_EXTENSION_FILTER as FIGURE_ERROR_FILE_EXTENSION_FILTER, WiserProfileCache
+from orangecontrib.OasysWiser.util.wise_scan import ScanMode, parse_scan_ranges, make_scan_points, compute_scan
+from orangecontrib.OasysWiser.util.wise_focus import normalize_intensity
+from orangecontrib.OasysWiser.util.wise_decimation import decimate_min_max
+from orangecontrib.OasysWiser.widgets.gui.ow_wise_widget import WiseWidget, ElementType, get_propagation_mode, is_whole_beamline_mode
 
 class OWOpticalElement(WiseWidget, WidgetDecorator):
     category = ""
@@ -58,12 +64,68 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
 
     calculation_type = Setting(0)
     number_of_points = Setting(7000)
+    phase_tolerance = Setting(DEFAULT_PHASE_TOLERANCE)
+
+    used_number_of_points = 0
+    automatic_number_of_points = 0
+    budget_number_of_points = 0
+
+    use_result_cache = Setting(1)
+    result_cache_memory_budget = Setting(1024.0)
+    use_disk_cache = Setting(0)
+    disk_cache_size = Setting(2048.0)
+    disk_cache_directory = Setting("")
+
+    scan_mode = Setting(0)
+    scan_ranges = Setting("alpha 1.9 2.1 5")
+    scan_n_samples = Setting(50)
+    scan_seed = Setting(0)
+    scan_evaluation = Setting(0)
+    scan_detector_size = Setting(0.05)
+    scan_defocus = Setting(0.0)
+
+    scan_task = None
+    scan_result = None
+
+    figure_error_ensemble = None
+    figure_error_profile = None # in memory, from the PreInput: it replaces the figure error file
+    figure_error_profile_key = None
 
     input_data = None
 
+    result_independent_settings = WiseWidget.result_independent_settings + ["use_multipool", "n_pools", "force_cpus",
+                                                                            "use_result_cache", "result_cache_memory_budget",
+                                                                            "use_disk_cache", "disk_cache_size", "disk_cache_directory",
+                                                                            "scan_mode", "scan_ranges", "scan_n_samples", "scan_seed",
+                                                                            "scan_evaluation", "scan_detector_size", "scan_defocus"]
+
     has_figure_error_box = True
     is_full_propagator   = False
 
+    def __init__(self):
+        super().__init__()
+
+        scan_tab = oasysgui.createTabPage(self.main_tabs, "Scan")
+
+        self.scan_table = QTableWidget(0, 0)
+        self.scan_table.setStyleSheet("background-color: #FBFBFB;")
+        self.scan_table.setAlternatingRowColors(True)
+        self.scan_table.verticalHeader().setVisible(False)
+        self.scan_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.scan_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.scan_table.setFixedHeight(180)
+        self.scan_table.itemClicked.connect(self.scan_table_item_clicked)
+
+        scan_tab.layout().addWidget(self.scan_table)
+
+        self.scan_tabs = oasysgui.tabWidget(scan_tab)
+        self.scan_plot_canvas = [oasysgui.plotWindow(roi=False, control=True, position=True) for _ in range(2)]
+
+        for title, plot_canvas in zip(["HEW", "Field Intensity"], self.scan_plot_canvas):
+            plot_canvas.setDefaultPlotLines(True)
+            plot_canvas.setActiveCurveColor(color='blue')
+            oasysgui.createTabPage(self.scan_tabs, title).layout().addWidget(plot_canvas)
+
     def build_gui(self):
         self.tabs_setting = oasysgui.tabWidget(self.controlArea)
         self.tabs_setting.setFixedHeight(self.TABS_AREA_HEIGHT)
@@ -164,17 +226,29 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
         calculation_box = oasysgui.widgetBox(self.tab_pro, "Calculation Parameters", orientation="vertical", width=self.CONTROL_AREA_WIDTH-20)
 
         gui.comboBox(calculation_box, self, "calculation_type", label="Numeric Integration",
-                     items=["Automatic Number of Points", "User Defined Number of Points"], labelWidth=140,
+                     items=["Automatic Number of Points", "User Defined Number of Points", "Sampling Budget"], labelWidth=140,
                      callback=self.set_CalculationType, sendSelectedValue=False, orientation="horizontal")
 
 
         self.empty_box = oasysgui.widgetBox(calculation_box, "", orientation="vertical", width=self.CONTROL_AREA_WIDTH-40, height=50)
         self.number_box = oasysgui.widgetBox(calculation_box, "", orientation="vertical", width=self.CONTROL_AREA_WIDTH-40, height=50)
 
+        self.budget_box = oasysgui.widgetBox(calculation_box, "", orientation="vertical", width=self.CONTROL_AREA_WIDTH-40, height=50)
+
         oasysgui.lineEdit(self.number_box, self, "number_of_points", "Number of Points", labelWidth=240, valueType=int, orientation="horizontal")
+        gui.button(self.number_box, self, "Use Automatic Number of Points", callback=self.use_automatic_number_of_points)
+
+        oasysgui.lineEdit(self.budget_box, self, "phase_tolerance", "Max Phase Error per Sample [rad]", labelWidth=240, valueType=float, orientation="horizontal")
 
         self.set_CalculationType()
 
+        le = oasysgui.lineEdit(calculation_box, self, "used_number_of_points", "Number of Points (last calculation)", labelWidth=240, valueType=int, orientation="horizontal")
+        le.setReadOnly(True)
+        le = oasysgui.lineEdit(calculation_box, self, "automatic_number_of_points", "Automatic Number of Points", labelWidth=240, valueType=int, orientation="horizontal")
+        le.setReadOnly(True)
+        le = oasysgui.lineEdit(calculation_box, self, "budget_number_of_points", "Sampling Budget Number of Points", labelWidth=240, valueType=int, orientation="horizontal")
+        le.setReadOnly(True)
+
         parallel_box = oasysgui.widgetBox(self.tab_pro, "Parallel Computing", orientation="vertical", width=self.CONTROL_AREA_WIDTH-20)
 
         gui.comboBox(parallel_box, self, "use_multipool", label="Use Parallel Processing",
@@ -204,12 +278,101 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
 
         self.set_Multipool()
 
+        cache_box = oasysgui.widgetBox(self.tab_pro, "Results Cache", orientation="vertical", width=self.CONTROL_AREA_WIDTH-20)
+
+        gui.comboBox(cache_box, self, "use_result_cache", label="Reuse results of unchanged calculations",
+                     items=["No", "Yes"], labelWidth=240,
+                     callback=self.set_UseResultCache, sendSelectedValue=False, orientation="horizontal")
+
+        self.use_result_cache_box = oasysgui.widgetBox(cache_box, "", addSpace=False, orientation="vertical", height=170, width=self.CONTROL_AREA_WIDTH-40)
+        self.use_result_cache_box_empty = oasysgui.widgetBox(cache_box, "", addSpace=False, orientation="vertical", height=170, width=self.CONTROL_AREA_WIDTH-40)
+
+        oasysgui.lineEdit(self.use_result_cache_box, self, "result_cache_memory_budget", "Memory budget (all widgets) [MB]", labelWidth=240, valueType=float, orientation="horizontal")
+
+        gui.comboBox(self.use_result_cache_box, self, "use_disk_cache", label="Keep results on disk between sessions",
+                     items=["No", "Yes"], labelWidth=240,
+                     callback=self.set_UseDiskCache, sendSelectedValue=False, orientation="horizontal")
+
+        self.use_disk_cache_box = oasysgui.widgetBox(self.use_result_cache_box, "", addSpace=False, orientation="vertical", height=60, width=self.CONTROL_AREA_WIDTH-40)
+        self.use_disk_cache_box_empty = oasysgui.widgetBox(self.use_result_cache_box, "", addSpace=False, orientation="vertical", height=60, width=self.CONTROL_AREA_WIDTH-40)
+
+        oasysgui.lineEdit(self.use_disk_cache_box, self, "disk_cache_size", "Disk space (all widgets) [MB]", labelWidth=240, valueType=float, orientation="horizontal")
+
+        file_box = oasysgui.widgetBox(self.use_disk_cache_box, "", addSpace=False, orientation="horizontal")
+        self.le_disk_cache_directory = oasysgui.lineEdit(file_box, self, "disk_cache_directory", "Directory (empty: default)", labelWidth=140, valueType=str, orientation="horizontal")
+        self.le_disk_cache_directory.setToolTip("Private directory of the user: directories writable by other users (e.g. shared folders) are refused,\n" +
+                                                "the cached results being Python objects that run code when loaded")
+        gui.button(file_box, self, "...", callback=self.selectDiskCacheDirectory)
+
+        gui.button(self.use_result_cache_box, self, "Clear Cache", callback=self.clear_result_cache)
+
+        self.set_UseDiskCache()
+
+        self.set_UseResultCache()
+
+        self.build_scan_gui()
+
+    def build_scan_gui(self):
+        tab_scan = oasysgui.createTabPage(self.tabs_setting, "Scan")
+
+        scan_box = oasysgui.widgetBox(tab_scan, "Scan/Tolerance Study", orientation="vertical", width=self.CONTROL_AREA_WIDTH-20)
+
+        gui.comboBox(scan_box, self, "scan_mode", label="Points", labelWidth=200,
+                     items=["Grid", "Tolerance (random)"],
+                     callback=self.set_ScanMode, sendSelectedValue=False, orientation="horizontal")
+
+        gui.label(scan_box, self, "One setting per line: name start stop points")
+
+        self.scan_ranges_text_area = oasysgui.textArea(height=100, width=self.CONTROL_AREA_WIDTH-40, readOnly=False)
+        self.scan_ranges_text_area.setText(self.scan_ranges)
+        self.scan_ranges_text_area.textChanged.connect(self.set_ScanRanges)
+        scan_box.layout().addWidget(self.scan_ranges_text_area)
+
+        self.scan_tolerance_box = oasysgui.widgetBox(scan_box, "", orientation="vertical", width=self.CONTROL_AREA_WIDTH-40, height=60)
+
+        oasysgui.lineEdit(self.scan_tolerance_box, self, "scan_n_samples", "Number of random points", labelWidth=240, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(self.scan_tolerance_box, self, "scan_seed", "Seed", labelWidth=240, valueType=int, orientation="horizontal")
+
+        self.set_ScanMode()
+
+        gui.comboBox(scan_box, self, "scan_evaluation", label="Field computed", labelWidth=200,
+                     items=["On the O.E.", "At Downstream Focus"],
+                     callback=self.set_ScanEvaluation, sendSelectedValue=False, orientation="horizontal")
+
+        self.scan_focus_box = oasysgui.widgetBox(scan_box, "", orientation="vertical", width=self.CONTROL_AREA_WIDTH-40, height=60)
+
+        self.le_scan_detector_size = oasysgui.lineEdit(self.scan_focus_box, self, "scan_detector_size", "Detector size", labelWidth=240, valueType=float, orientation="horizontal")
+        self.le_scan_defocus = oasysgui.lineEdit(self.scan_focus_box, self, "scan_defocus", "Defocus", labelWidth=240, valueType=float, orientation="horizontal")
+
+        self.set_ScanEvaluation()
+
+        button_box = oasysgui.widgetBox(scan_box, "", orientation="horizontal", width=self.CONTROL_AREA_WIDTH-40)
+
+        gui.button(button_box, self, "Run Scan", callback=self.do_scan, height=35)
+        stop_button = gui.button(button_box, self, "Interrupt", callback=self.stop_scan, height=35)
+        font = QFont(stop_button.font())
+        font.setBold(True)
+        stop_button.setFont(font)
+        palette = QPalette(stop_button.palette()) # make a copy of the palette
+        palette.setColor(QPalette.ButtonText, QColor('red'))
+        stop_button.setPalette(palette) # assign new palette
+
+        self.save_scan_button = gui.button(scan_box, self, "Save Scan Results", callback=self.save_scan_results, height=35)
+        self.save_scan_button.setEnabled(False)
+
     def selectFigureErrorFile(self):
-        self.le_figure_error_file.setText(oasysgui.selectFileFromDialog(self, self.figure_error_file, "Select File", file_extension_filter="Data Files (*.dat *.txt)"))
+        self.set_figure_error_profile(None)
+        self.le_figure_error_file.setText(oasysgui.selectFileFromDialog(self, self.figure_error_file, "Select File", file_extension_filter=FIGURE_ERROR_FILE_EXTENSION_FILTER))
 
     def selectRoughnessFile(self):
         self.le_roughness_file.setText(oasysgui.selectFileFromDialog(self, self.roughness_file, "Select File", file_extension_filter="Data Files (*.dat *.txt)"))
 
+    def set_figure_error_profile(self, figure_error_profile):
+        self.figure_error_profile = figure_error_profile
+        # the heights are hashed once per profile, not at every calculation
+        self.figure_error_profile_key = None if figure_error_profile is None else \
+                                        fingerprint(figure_error_profile.heights, figure_error_profile.step, figure_error_profile.amplitude_scaling)
+
     def set_FigureErrorPlot(self):
         if self.use_figure_error == 1:
             self.tab[2].setEnabled(True)
@@ -233,11 +396,47 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
     def set_CalculationType(self):
         self.empty_box.setVisible(self.calculation_type==0)
         self.number_box.setVisible(self.calculation_type==1)
+        self.budget_box.setVisible(self.calculation_type==2)
+
+    def use_automatic_number_of_points(self):
+        if self.automatic_number_of_points > 0: self.number_of_points = self.automatic_number_of_points
 
     def set_Multipool(self):
         self.use_multipool_box.setVisible(self.use_multipool == 1)
         self.use_multipool_box_empty.setVisible(self.use_multipool == 0)
 
+    def set_UseResultCache(self):
+        self.use_result_cache_box.setVisible(self.use_result_cache == 1)
+        self.use_result_cache_box_empty.setVisible(self.use_result_cache == 0)
+
+    def set_UseDiskCache(self):
+        self.use_disk_cache_box.setVisible(self.use_disk_cache == 1)
+        self.use_disk_cache_box_empty.setVisible(self.use_disk_cache == 0)
+
+    def selectDiskCacheDirectory(self):
+        self.le_disk_cache_directory.setText(oasysgui.selectDirectoryFromDialog(self, self.disk_cache_directory, "Select Directory"))
+
+    def set_ScanMode(self):
+        self.scan_tolerance_box.setVisible(self.scan_mode == ScanMode.TOLERANCE)
+
+    def set_ScanEvaluation(self):
+        self.scan_focus_box.setVisible(self.scan_evaluation == 1)
+
+    def set_ScanRanges(self):
+        self.scan_ranges = self.scan_ranges_text_area.toPlainText()
+
+    def clear_result_cache(self):
+        from orangecontrib.OasysWiser.util.wise_propagation import WiserCheckpointStore
+
+        WiserResultCache.Instance().clear()
+        WiserCheckpointStore.Instance().clear()
+        WiserProfileCache.Instance().clear()
+
+        if self.use_disk_cache == 1:
+            disk_cache = WiserDiskCache.Instance()
+            disk_cache.set_directory(self.disk_cache_directory)
+            disk_cache.clear()
+
     def after_change_workspace_units(self):
         super(OWOpticalElement, self).after_change_workspace_units()
 
@@ -250,6 +449,10 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
         label.setText(label.text() + " [" + self.workspace_units_label + "]")
         label = self.le_longitudinal.parent().layout().itemAt(0).widget()
         label.setText(label.text() + " [" + self.workspace_units_label + "]")
+        label = self.le_scan_detector_size.parent().layout().itemAt(0).widget()
+        label.setText(label.text() + " [" + self.workspace_units_label + "]")
+        label = self.le_scan_defocus.parent().layout().itemAt(0).widget()
+        label.setText(label.text() + " [" + self.workspace_units_label + "]")
 
     def build_mirror_specific_gui(self, container_box):
         raise NotImplementedError()
@@ -259,7 +462,7 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
 
         if not input_data is None:
             try:
-                if input_data.wise_beamline is None or input_data.wise_beamline.get_propagation_elements_number() == 0:
+                if input_data.get_elements_number() == 0:
                     if input_data.wise_wavefront is None: raise ValueError("Input Data contains no wavefront and/or no source to perform wavefront propagation")
 
                 self.input_data = input_data.duplicate()
@@ -273,10 +476,13 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
     def set_pre_input(self, data):
         if data is not None:
             try:
-                if data.figure_error_file != WiserPreInputData.NONE:
-                    self.figure_error_file = data.figure_error_file
-                    self.figure_error_step = data.figure_error_step
-                    self.figure_error_um_conversion = data.figure_user_units_to_m
+                if data.figure_error_file != WiserPreInputData.NONE or not data.figure_error_profile is None:
+                    if data.figure_error_file != WiserPreInputData.NONE:
+                        self.figure_error_file = data.figure_error_file
+                        self.figure_error_step = data.figure_error_step
+                        self.figure_error_um_conversion = data.figure_user_units_to_m
+                    self.set_figure_error_profile(data.figure_error_profile)
+                    self.figure_error_ensemble = data.figure_error_ensemble
                     self.use_figure_error = 1
 
                     self.set_UseFigureError()
@@ -297,14 +503,21 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
         self.alpha = congruence.checkAngle(self.alpha, "Incidence Angle")
         self.length = congruence.checkStrictlyPositiveNumber(self.length, "Length")
 
-        if self.use_figure_error == 1:
+        if self.use_figure_error == 1 and self.figure_error_profile is None:
             congruence.checkFileName(self.figure_error_file)
 
         if self.use_roughness == 1:
             congruence.checkFileName(self.roughness_file)
 
+            self.use_roughness = 0
+            self.set_UseRoughness()
+
+            raise NotImplementedError("Roughness Not yet supported")
+
         if self.calculation_type == 1:
             congruence.checkStrictlyPositiveNumber(self.number_of_points, "Number of Points")
+        elif self.calculation_type == 2:
+            congruence.checkStrictlyPositiveNumber(self.phase_tolerance, "Max Phase Error per Sample")
 
         if self.use_multipool == 1:
             congruence.checkStrictlyPositiveNumber(self.n_pools, "Nr. Parallel Processes")
@@ -315,71 +528,395 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
                 elif self.n_pools >= self.number_of_cpus:
                     raise Exception("Max number of parallel processes allowed on this computer (" + str(self.number_of_cpus) + ")")
 
+        if self.use_result_cache == 1:
+            congruence.checkStrictlyPositiveNumber(self.result_cache_memory_budget, "Memory budget")
+
+            if self.use_disk_cache == 1:
+                congruence.checkStrictlyPositiveNumber(self.disk_cache_size, "Disk space")
+                if not self.disk_cache_directory.strip() == "":
+                    congruence.checkDir(self.disk_cache_directory)
+
+                    if not WiserDiskCache.is_private_directory(self.disk_cache_directory):
+                        raise Exception("Disk cache directory can be written by other users: choose a private directory")
+
+    def get_settings_fingerprint(self):
+        figure_error_file_stat = None
+
+        if self.use_figure_error == 1:
+            if not self.figure_error_profile is None:
+                figure_error_file_stat = self.figure_error_profile_key
+            elif os.path.exists(self.figure_error_file):
+                stat = os.stat(self.figure_error_file)
+                figure_error_file_stat = (os.path.abspath(self.figure_error_file), stat.st_mtime_ns, stat.st_size)
+
+        return fingerprint(super(OWOpticalElement, self).get_settings_fingerprint(), figure_error_file_stat)
+
+    def get_element_key(self):
+        return fingerprint(self.input_data.get_chain_key(), self.get_settings_fingerprint())
 
     def do_wise_calculation(self):
+        from wofry.propagator.propagator import PropagationManager, PropagationParameters, PropagationMode
+        from WofryWiser.propagator.propagator1D.wise_propagator import WisePropagationElements
+        from WofryWiser.propagator.wavefront1D.wise_wavefront import WiseWavefront
+        from WofryWiser.beamline.beamline_elements import WiserBeamlineElement
+        from orangecontrib.OasysWiser.util.wise_propagation import WiserIncrementalPropagator, WiserCheckpointStore, ElementInstrumentation
+
         if self.input_data is None:
             raise Exception("No Input Data!")
 
+        self.element_metrics = [] # nothing computed, if the result comes from cache
+
+        element_key = self.get_element_key()
+
+        if self.is_deferred_calculation(): return self.defer_wise_calculation(element_key)
+
+        result_key = fingerprint(element_key, get_propagation_mode(), self.is_full_propagator)
+
+        if self.use_result_cache == 1:
+            result_cache = WiserResultCache.Instance()
+            result_cache.set_memory_budget(self.result_cache_memory_budget)
+            WiserCheckpointStore.Instance().set_memory_budget(self.result_cache_memory_budget)
+
+            output_data = result_cache.get(result_key)
+
+            if not output_data is None:
+                print("Nothing changed since a previous calculation: result retrieved from cache")
+
+                return self.attach_figure_error_ensemble(output_data)
+
+            if self.use_disk_cache == 1:
+                disk_cache = WiserDiskCache.Instance()
+                disk_cache.set_directory(self.disk_cache_directory)
+                disk_cache.set_size_cap(self.disk_cache_size)
+
+                output_data = disk_cache.get(result_key)
+
+                if not output_data is None:
+                    print("Nothing changed since a previous session: result retrieved from disk cache")
+
+                    result_cache.put(result_key, output_data)
+
+                    return self.attach_figure_error_ensemble(output_data)
+
+        report_progress(10, "Building Optical Element")
+
         optical_element = self.get_optical_element(self.get_inner_wise_optical_element())
 
         native_optical_element = optical_element.native_optical_element
 
-        native_optical_element.CoreOptics.ComputationSettings.Ignore = (self.ignore == 1)
+        configure_optical_element(native_optical_element, self.get_settings_values(), self.workspace_units_to_m,
+                                  self.figure_error_profile if self.use_figure_error == 1 else None)
 
-        if self.use_small_displacements == 1:
-            native_optical_element.CoreOptics.ComputationSettings.UseSmallDisplacements = True # serve per traslare/ruotare l'EO
-            native_optical_element.CoreOptics.SmallDisplacements.Rotation = numpy.deg2rad(self.rotation)
-            native_optical_element.CoreOptics.SmallDisplacements.Trans = self.transverse*self.workspace_units_to_m # Transverse displacement (rispetto al raggio uscente, magari faremo scegliere)
-            native_optical_element.CoreOptics.SmallDisplacements.Long = self.longitudinal*self.workspace_units_to_m # Longitudinal displacement (idem)
-        else:
-            native_optical_element.CoreOptics.ComputationSettings.UseSmallDisplacements = False
-            native_optical_element.CoreOptics.SmallDisplacements.Rotation = 0.0
-            native_optical_element.CoreOptics.SmallDisplacements.Trans = 0.0
-            native_optical_element.CoreOptics.SmallDisplacements.Long = 0.0
+        report_progress(20, "Propagating Wavefront")
 
-        if self.use_figure_error == 1:
-            native_optical_element.CoreOptics.ComputationSettings.UseFigureError = True
+        has_deferred_elements = self.input_data.has_deferred_elements() # built here, with no field: the beamline is propagated from the source
 
-            native_optical_element.CoreOptics.FigureErrorLoad(File = self.figure_error_file,
-                                                              Step = self.figure_error_step * self.workspace_units_to_m, # passo del file
-                                                              AmplitudeScaling = self.figure_error_amplitude_scaling * self.figure_error_um_conversion # fattore di scala
-                                                              )
+        if has_deferred_elements:
+            output_data = build_deferred_elements(self.input_data, optical_element) # the budgets of the deferred elements need their downstream element
         else:
-            native_optical_element.CoreOptics.ComputationSettings.UseFigureError = False
+            output_data = self.input_data.duplicate(writable=True)
 
-        if self.use_roughness == 1:
-            self.use_roughness = 0
-            self.set_UseRoughness()
-
-            raise NotImplementedError("Roughness Not yet supported")
-        else:
-            native_optical_element.CoreOptics.ComputationSettings.UseRoughness = False
+            if output_data.wise_beamline is None: output_data.wise_beamline = WisePropagationElements()
 
-        if self.calculation_type == 0:
-            native_optical_element.ComputationSettings.UseCustomSampling = False
-        else:
-            # l'utente decide di impostare a mano il campionamento
-            native_optical_element.ComputationSettings.UseCustomSampling = True
-            native_optical_element.ComputationSettings.NSamples = self.number_of_points
+            output_data.wise_beamline.add_beamline_element(WiserBeamlineElement(optical_element=optical_element))
 
-        output_data = self.input_data.duplicate()
         input_wavefront = output_data.wise_wavefront
+        output_data.add_element_key(element_key)
 
-        if output_data.wise_beamline is None: output_data.wise_beamline = WisePropagationElements()
-
-        output_data.wise_beamline.add_beamline_element(WiserBeamlineElement(optical_element=optical_element))
+        if self.calculation_type == 2: apply_sampling_budget(output_data, self.phase_tolerance)
 
         parameters = PropagationParameters(wavefront=input_wavefront if not input_wavefront is None else WiseWavefront(wise_computation_results=None),
                                            propagation_elements=output_data.wise_beamline)
 
-        parameters.set_additional_parameters("single_propagation", True if PropagationManager.Instance().get_propagation_mode(WISE_APPLICATION) == PropagationMode.STEP_BY_STEP else (not self.is_full_propagator))
+        parameters.set_additional_parameters("single_propagation", False if has_deferred_elements else True if get_propagation_mode() == PropagationMode.STEP_BY_STEP else (not self.is_full_propagator))
         parameters.set_additional_parameters("NPools", self.n_pools if self.use_multipool == 1 else 1)
         parameters.set_additional_parameters("is_full_propagator", self.is_full_propagator)
+        parameters.set_additional_parameters("element_keys", output_data.element_keys) # unchanged upstream fields are not recomputed
+
+        native_optical_elements = [output_data.wise_beamline.get_wise_propagation_element(index) for index in range(output_data.get_elements_number())]
+
+        with ElementInstrumentation(native_optical_elements, track_memory=self.record_peak_memory == 1) as instrumentation:
+            output_data.wise_wavefront = PropagationManager.Instance().do_propagation(propagation_parameters=parameters, handler_name=WiserIncrementalPropagator.HANDLER_NAME)
+
+        self.element_metrics = instrumentation.metrics
+        self.element_metrics_time = time.strftime("%Y-%m-%d %H:%M:%S")
+
+        report_progress(100, "Propagation completed")
+
+        if self.use_result_cache == 1:
+            result_cache.put(result_key, output_data)
+
+            if self.use_disk_cache == 1: disk_cache.put(result_key, output_data)
+
+        return self.attach_figure_error_ensemble(output_data)
+
+    def is_deferred_calculation(self):
+        # Whole Beamline mode: the elements upstream of the Detector are described by their settings, and propagated there
+        return not self.is_full_propagator and type(self).__name__ in ELEMENT_BUILDERS and is_whole_beamline_mode()
+
+    def defer_wise_calculation(self, element_key):
+        '''
+        No field computed and no copy of the beamline: the settings of the element are added to the
+        description of the beamline, built and propagated by the Detector
+        '''
+        output_data = self.input_data.duplicate()
+        output_data.add_deferred_element(DeferredElement(BatchElement(type(self).__name__,
+                                                                      self.get_settings_values(),
+                                                                      figure_error_profile=self.figure_error_profile if self.use_figure_error == 1 else None),
+                                                         self.workspace_units_to_m),
+                                         element_key)
+
+        print("Whole beamline at Detector: " + self.oe_name + " will be propagated by the Detector")
+
+        report_progress(100, "Added to the beamline")
+
+        return self.attach_figure_error_ensemble(output_data)
+
+    def attach_figure_error_ensemble(self, output_data):
+        # the ensemble does not change the field of the nominal profile: it is attached also to results coming from cache
+        element_index = output_data.get_elements_number() - 1
+        figure_error_ensemble = None if self.use_figure_error == 0 or self.figure_error_ensemble is None else \
+                                self.figure_error_ensemble.scaled(self.figure_error_amplitude_scaling)
 
-        output_data.wise_wavefront = PropagationManager.Instance().do_propagation(propagation_parameters=parameters, handler_name=WisePropagator.HANDLER_NAME)
+        if figure_error_ensemble is None and not element_index in output_data.figure_error_ensembles: return output_data
+
+        output_data = output_data.duplicate()
+        output_data.set_figure_error_ensemble(element_index, figure_error_ensemble)
 
         return output_data
 
+    def get_sampling_geometry(self, wiser_data, refresh_positions=True):
+        wise_propagation_elements = wiser_data.wise_beamline.get_wise_propagation_elements()
+
+        if refresh_positions: wise_propagation_elements.RefreshPositions()
+
+        return get_sampling_geometry(wiser_data.wise_beamline.get_wise_propagation_element(-1), wise_propagation_elements.Lambda)
+
+    def compute_finished(self, calculation_output):
+        if not calculation_output is None:
+            try:
+                self.show_sampling(calculation_output)
+            except Exception as exception:
+                print("Sampling information not available: " + str(exception))
+
+        super(OWOpticalElement, self).compute_finished(calculation_output)
+
+    def show_sampling(self, calculation_output):
+        if calculation_output.has_deferred_elements(): return # no field on this element
+
+        native_optical_element = calculation_output.wise_beamline.get_wise_propagation_element(-1)
+        n_samples = native_optical_element.ComputationData.NSamples
+        sampling_geometry = self.get_sampling_geometry(calculation_output, refresh_positions=False)
+        is_inherited = is_sampling_inherited(native_optical_element) # LibWiser keeps the number of samples of the numeric field upstream
+
+        sampling_cache = WiserSamplingCache.Instance()
+        if self.calculation_type == 0 and not is_inherited: sampling_cache.put_samples(sampling_geometry, n_samples)
+
+        automatic_number_of_points = sampling_cache.get_samples(sampling_geometry)
+        if automatic_number_of_points is None and not sampling_geometry is None: automatic_number_of_points = sampling_geometry.get_automatic_samples()
+
+        self.used_number_of_points = 0 if n_samples is None else int(n_samples)
+        self.automatic_number_of_points = 0 if automatic_number_of_points is None else int(automatic_number_of_points)
+        self.budget_number_of_points = 0 if sampling_geometry is None or is_inherited else sampling_geometry.get_samples_for_phase_tolerance(self.phase_tolerance)
+
+        if is_inherited:
+            print("Number of Points: " + str(self.used_number_of_points) + ", inherited from the numeric field upstream: " +
+                  "Automatic Number of Points and Sampling Budget do not apply to this element")
+        elif not sampling_geometry is None:
+            print("Number of Points: " + str(self.used_number_of_points) +
+                  ", Automatic: " + str(self.automatic_number_of_points) +
+                  ", Sampling Budget (" + str(self.phase_tolerance) + " rad): " + str(self.budget_number_of_points))
+
+    ###############################################################
+    # SCAN
+
+    def do_scan(self):
+        if not self.scan_task is None: return
+
+        try:
+            if self.input_data is None: raise Exception("No Input Data!")
+            if not type(self).__name__ in ELEMENT_BUILDERS: raise Exception("Scan not available for this optical element")
+
+            self.check_fields()
+
+            scan_ranges = parse_scan_ranges(self.scan_ranges)
+            settings = self.get_settings_values()
+
+            for scan_range in scan_ranges:
+                if not scan_range.name in settings: raise Exception("Unknown setting: " + scan_range.name)
+                congruence.checkStrictlyPositiveNumber(scan_range.n_points, "Points of " + scan_range.name)
+
+            if self.scan_mode == ScanMode.TOLERANCE: congruence.checkStrictlyPositiveNumber(self.scan_n_samples, "Number of random points")
+
+            if self.scan_evaluation == 1:
+                congruence.checkStrictlyPositiveNumber(self.scan_detector_size, "Detector size")
+                detector_size = self.scan_detector_size*self.workspace_units_to_m
+            else:
+                detector_size = None
+
+            redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
+
+            points = make_scan_points(scan_ranges, self.scan_mode, self.scan_n_samples, self.scan_seed)
+            parameter_names = [scan_range.name for scan_range in scan_ranges]
+
+            self.scan_result = None
+            self.save_scan_button.setEnabled(False)
+            self.initialize_scan_table(parameter_names, points)
+
+            self.setStatusMessage("Running Scan")
+            self.progressBarInit()
+
+            self.scan_task = self.executor.submit(compute_scan,
+                                                  self.input_data,
+                                                  type(self).__name__,
+                                                  settings,
+                                                  parameter_names,
+                                                  points,
+                                                  workspace_units_to_m=self.workspace_units_to_m,
+                                                  detector_size=detector_size,
+                                                  defocus=self.scan_defocus*self.workspace_units_to_m,
+                                                  n_pools=self.n_pools if self.use_multipool == 1 else 1,
+                                                  figure_error_profile=self.figure_error_profile if self.use_figure_error == 1 else None,
+                                                  on_finished=self.scan_finished,
+                                                  on_failed=self.scan_failed,
+                                                  on_cancelled=self.scan_cancelled,
+                                                  on_progress=self.scan_progress,
+                                                  on_partial_result=self.scan_partial_result,
+                                                  on_output=self.writeStdOut)
+
+            self.main_tabs.setCurrentIndex(2)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+            self.setStatusMessage("Error!")
+
+            self.scan_terminated()
+
+    def stop_scan(self):
+        if not self.scan_task is None: self.scan_task.cancel()
+
+    def initialize_scan_table(self, parameter_names, points):
+        self.scan_table.clear()
+        self.scan_table.setColumnCount(len(parameter_names) + 3)
+        self.scan_table.setRowCount(len(points))
+        self.scan_table.setHorizontalHeaderLabels(["#"] + parameter_names + ["HEW [" + u"\u03BC" + "m]", "Peak Intensity"])
+
+        for index, point in enumerate(points):
+            self.set_scan_table_row(index, point, numpy.nan, numpy.nan)
+
+    def set_scan_table_row(self, index, point, hew, peak_intensity):
+        values = [str(index+1)] + [str(round(value, 6)) for value in point] + ["" if numpy.isnan(hew) else str(round(hew*1e6, 4)),
+                                                                                "" if numpy.isnan(peak_intensity) else "%.4g" % peak_intensity]
+
+        for column, value in enumerate(values):
+            table_item = QTableWidgetItem(value)
+            table_item.setTextAlignment(Qt.AlignCenter if column == 0 else Qt.AlignRight)
+            self.scan_table.setItem(index, column, table_item)
+
+    def scan_progress(self, value, message):
+        self.progressBarSet(value)
+        self.setStatusMessage(message)
+
+    def scan_partial_result(self, partial_result):
+        for index, point, hew, peak_intensity in zip(partial_result.indices, partial_result.points, partial_result.hews, partial_result.peak_intensities):
+            self.set_scan_table_row(index, point, hew, peak_intensity)
+
+    def scan_finished(self, scan_result):
+        try:
+            self.scan_result = scan_result
+            self.save_scan_button.setEnabled(True)
+
+            for index, point in enumerate(scan_result.points):
+                self.set_scan_table_row(index, point, scan_result.hews[index], scan_result.peak_intensities[index])
+
+            self.plot_scan_hew()
+
+            best_index = scan_result.get_best_index()
+
+            if best_index >= 0:
+                self.scan_table.selectRow(best_index)
+                self.plot_scan_point(best_index)
+
+                print("Scan completed, best point (" + str(best_index+1) + "): " +
+                      ", ".join([name + " = " + str(value) for name, value in zip(scan_result.parameter_names, scan_result.points[best_index])]) +
+                      ", HEW = " + str(round(scan_result.hews[best_index]*1e6, 4)) + " um")
+
+            self.setStatusMessage("")
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+            self.setStatusMessage("Error!")
+
+        self.scan_terminated()
+
+    def scan_failed(self, exception):
+        QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+        self.setStatusMessage("Error!")
+
+        self.scan_terminated()
+
+    def scan_cancelled(self):
+        self.setStatusMessage("Scan interrupted")
+
+        self.scan_terminated()
+
+    def scan_terminated(self):
+        self.scan_task = None
+        self.progressBarFinished()
+
+    def onDeleteWidget(self):
+        self.stop_scan()
+
+        super(OWOpticalElement, self).onDeleteWidget()
+
+    def plot_scan_hew(self):
+        scan_result = self.scan_result
+
+        if len(scan_result.parameter_names) == 1 and self.scan_mode == ScanMode.GRID:
+            x, xtitle = scan_result.points[:, 0], scan_result.parameter_names[0]
+        else:
+            x, xtitle = numpy.arange(1, len(scan_result.hews) + 1), "Point"
+
+        plot_canvas = self.scan_plot_canvas[0]
+        plot_canvas.clear()
+        plot_canvas.setDefaultPlotPoints(True)
+        plot_canvas.addCurve(x, scan_result.hews*1e6, "HEW", symbol="o", color="blue", replace=True)
+        plot_canvas.setGraphTitle("HEW vs " + xtitle)
+        plot_canvas.setGraphXLabel(xtitle)
+        plot_canvas.setGraphYLabel("HEW [$\mu$m]")
+
+    def plot_scan_point(self, index):
+        scan_result = self.scan_result
+
+        if not scan_result is None and 0 <= index < len(scan_result.hews) and not scan_result.electric_fields[index] is None:
+            title = ", ".join([name + " = " + str(round(value, 6)) for name, value in zip(scan_result.parameter_names, scan_result.points[index])]) + \
+                    ", HEW: " + str(round(scan_result.hews[index]*1e6, 4)) + " [$\mu$m]"
+
+            x, y = decimate_min_max(scan_result.positions[index]*1e6,
+                                    normalize_intensity(scan_result.electric_fields[index]),
+                                    self.get_plot_bins(self.scan_plot_canvas[1]))
+
+            WiserPlot.plot_histo(self.scan_plot_canvas[1], x, y, title, "S [$\mu$m]", "Intensity")
+
+            self.scan_tabs.setCurrentIndex(1)
+
+    def scan_table_item_clicked(self):
+        indexes = self.scan_table.selectionModel().selectedRows()
+
+        if len(indexes) > 0: self.plot_scan_point(indexes[0].row())
+
+    def save_scan_results(self):
+        try:
+            file_name, _ = QFileDialog.getSaveFileName(self, "Save Scan Results", ".", "Data Files (*.dat *.txt)")
+
+            if not file_name is None and not file_name.strip() == "":
+                self.scan_result.save(file_name)
+
+                QMessageBox.information(self, "Save Scan Results", "Scan results saved on file " + file_name, QMessageBox.Ok)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
     def get_inner_wise_optical_element(self):
         raise NotImplementedError()
 
@@ -407,7 +944,7 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
     def extract_plot_data_from_calculation_output(self, calculation_output):
         output_wavefront = calculation_output.wise_wavefront
 
-        if not output_wavefront is None and not output_wavefront.wise_computation_result is None:
+        if not calculation_output.has_deferred_elements() and not output_wavefront is None and not output_wavefront.wise_computation_result is None:
             wise_optical_element = calculation_output.wise_beamline.get_wise_propagation_element(-1)
 
             S = output_wavefront.wise_computation_result.S
@@ -501,6 +1038,8 @@ class OWOpticalElement(WiseWidget, WidgetDecorator):
                 raise Exception("Empty Data")
 
     def receive_syned_data(self, data):
+        from syned.beamline.optical_elements.mirrors.mirror import Mirror
+
         if not data is None:
             try:
                 beamline_element = data.get_beamline_element_at(-1)
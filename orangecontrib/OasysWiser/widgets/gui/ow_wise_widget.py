@@ -14,48 +14,66 @@ from oasys.util.oasys_util import EmittingStream
 
 from orangecontrib.OasysWiser.util.wise_util import WiserPlot
 from orangecontrib.OasysWiser.util.wise_objects import WiserData
-
-from LibWiser.Foundation import PositioningDirectives
-import LibWiser.Optics as Optics
-
-from wofry.propagator.propagator import PropagationManager, PropagationMode, WavefrontDimension
-from WofryWiser.propagator.propagator1D.wise_propagator import WisePropagator, WISE_APPLICATION
+from orangecontrib.OasysWiser.util.wise_cache import fingerprint
+from orangecontrib.OasysWiser.util.wise_threading import WiserExecutor, redirect_stdout
+from orangecontrib.OasysWiser.util.wise_profiling import WiserProfiler
+from orangecontrib.OasysWiser.util.wise_decimation import DecimatedCurve
+from orangecontrib.OasysWiser.util import wise_positioning
+
+###############################################################
+#
+# LibWiser, WofryWiser and wofry are imported when the first
+# widget is created: not needed to register the widgets
+#
+###############################################################
 
 def initialize_propagator_1D():
+    from wofry.propagator.propagator import PropagationManager, PropagationMode, WavefrontDimension
+    from WofryWiser.propagator.propagator1D.wise_propagator import WisePropagator, WISE_APPLICATION
+    from orangecontrib.OasysWiser.util.wise_propagation import WiserIncrementalPropagator
+
     propagation_manager = PropagationManager.Instance()
 
     if not propagation_manager.is_initialized(WISE_APPLICATION):
         if not propagation_manager.has_propagator(WisePropagator.HANDLER_NAME, WavefrontDimension.ONE): propagation_manager.add_propagator(WisePropagator())
+        if not propagation_manager.has_propagator(WiserIncrementalPropagator.HANDLER_NAME, WavefrontDimension.ONE): propagation_manager.add_propagator(WiserIncrementalPropagator())
 
+        # default set only once: the widgets created later keep the mode chosen in the menu
         propagation_manager.set_propagation_mode(WISE_APPLICATION, PropagationMode.STEP_BY_STEP)
 
-        propagation_manager.set_initialized(True)
+        propagation_manager.set_initialized(WISE_APPLICATION, True)
+
+def get_propagation_mode():
+    from wofry.propagator.propagator import PropagationManager
+    from WofryWiser.propagator.propagator1D.wise_propagator import WISE_APPLICATION
+
+    return PropagationManager.Instance().get_propagation_mode(WISE_APPLICATION)
+
+def is_whole_beamline_mode():
+    from wofry.propagator.propagator import PropagationMode
 
-try:
-    initialize_propagator_1D()
-except Exception as e:
-    print("Error while initializing propagators", str(e))
+    return get_propagation_mode() == PropagationMode.WHOLE_BEAMLINE
 
-positioning_directives_what = [PositioningDirectives.What.Centre,
-                               PositioningDirectives.What.UpstreamFocus,
-                               PositioningDirectives.What.DownstreamFocus]
+positioning_directives_what = [wise_positioning.What.Centre,
+                               wise_positioning.What.UpstreamFocus,
+                               wise_positioning.What.DownstreamFocus]
 
-positioning_directives_where = [PositioningDirectives.Where.Centre,
-                                PositioningDirectives.Where.UpstreamFocus,
-                                PositioningDirectives.Where.DownstreamFocus]
+positioning_directives_where = [wise_positioning.Where.Centre,
+                                wise_positioning.Where.UpstreamFocus,
+                                wise_positioning.Where.DownstreamFocus]
 
-positioning_directives_refer_to = [PositioningDirectives.ReferTo.AbsoluteReference,
-                                   PositioningDirectives.ReferTo.UpstreamElement,
-                                   PositioningDirectives.ReferTo.DownstreamElement,
-                                   PositioningDirectives.ReferTo.DoNotMove,
-                                   PositioningDirectives.ReferTo.Source]
+positioning_directives_refer_to = [wise_positioning.ReferTo.AbsoluteReference,
+                                   wise_positioning.ReferTo.UpstreamElement,
+                                   wise_positioning.ReferTo.DownstreamElement,
+                                   wise_positioning.ReferTo.DoNotMove,
+                                   wise_positioning.ReferTo.Source]
 
-positioning_directives_which_angle = [Optics.TypeOfAngle.GrazingNominal,
-                                      Optics.TypeOfAngle.InputNominal,
-                                      Optics.TypeOfAngle.OutputNominal,
-                                      Optics.TypeOfAngle.SelfFrameOfReference,
-                                      Optics.TypeOfAngle.NormalAbsolute,
-                                      Optics.TypeOfAngle.TangentAbsolute]
+positioning_directives_which_angle = [wise_positioning.TypeOfAngle.GrazingNominal,
+                                      wise_positioning.TypeOfAngle.InputNominal,
+                                      wise_positioning.TypeOfAngle.OutputNominal,
+                                      wise_positioning.TypeOfAngle.SelfFrameOfReference,
+                                      wise_positioning.TypeOfAngle.NormalAbsolute,
+                                      wise_positioning.TypeOfAngle.TangentAbsolute]
 
 
 class ElementType:
@@ -88,9 +106,9 @@ class WiseWidget(widget.OWWidget):
     want_main_area = 1
 
 
-    ReferTo = Setting(PositioningDirectives.ReferTo.AbsoluteReference)
-    What = Setting(PositioningDirectives.What.Centre)
-    Where = Setting(PositioningDirectives.Where.Centre)
+    ReferTo = Setting(wise_positioning.ReferTo.AbsoluteReference)
+    What = Setting(wise_positioning.What.Centre)
+    Where = Setting(wise_positioning.Where.Centre)
     Distance = Setting(0.0)
     XCentre = Setting(0.0)
     YCentre = Setting(0.0)
@@ -105,13 +123,36 @@ class WiseWidget(widget.OWWidget):
 
     wise_live_propagation_mode = "Unknown"
 
+    record_peak_memory = Setting(1)
+
+    # settings not affecting the result of the calculation
+    result_independent_settings = ["is_automatic_run", "view_type", "record_peak_memory"]
+
+    element_metrics = [] # ElementMetrics of the last computation
+    element_metrics_time = None
+
+    current_task = None
+    compute_requested = False
+    profile_directory = None # the next calculation is profiled, if set
+
     def __init__(self):
         super().__init__()
 
+        try:
+            initialize_propagator_1D()
+        except Exception as e:
+            print("Error while initializing propagators", str(e))
+
+        self.executor = WiserExecutor()
+
         self.runaction = OWAction("Compute", self)
         self.runaction.triggered.connect(self.compute)
         self.addAction(self.runaction)
 
+        self.profile_action = OWAction("Profile Next Compute", self)
+        self.profile_action.triggered.connect(self.profile_next_compute)
+        self.addAction(self.profile_action)
+
         geom = QApplication.desktop().availableGeometry()
         self.setGeometry(QRect(round(geom.width()*0.05),
                                round(geom.height()*0.05),
@@ -128,7 +169,15 @@ class WiseWidget(widget.OWWidget):
 
         self.button_box = gui.widgetBox(self.controlArea, "", orientation="horizontal")
         #widget buttons: compute, set defaults, help
-        gui.button(self.button_box, self, "Compute", callback=self.compute, height=35)
+        self.compute_button = gui.button(self.button_box, self, "Compute", callback=self.compute, height=35)
+        self.cancel_button = gui.button(self.button_box, self, "Cancel", callback=self.cancel_compute, height=35)
+        font = QFont(self.cancel_button.font())
+        font.setBold(True)
+        self.cancel_button.setFont(font)
+        palette = QPalette(self.cancel_button.palette()) # make a copy of the palette
+        palette.setColor(QPalette.ButtonText, QColor('red'))
+        self.cancel_button.setPalette(palette) # assign new palette
+        self.cancel_button.setEnabled(False)
         gui.button(self.button_box, self, "Defaults", callback=self.defaults, height=35)
 
         gui.separator(self.controlArea, height=10)
@@ -171,6 +220,8 @@ class WiseWidget(widget.OWWidget):
 
         self.initializeTabs()
 
+        self.tabs.currentChanged.connect(self.show_pending_plot)
+
         self.wise_output = QtWidgets.QTextEdit()
         self.wise_output.setReadOnly(True)
         self.wise_output.setStyleSheet("background-color: white;")
@@ -178,20 +229,42 @@ class WiseWidget(widget.OWWidget):
         out_box = gui.widgetBox(out_tab, "System Output", addSpace=True, orientation="horizontal")
         out_box.layout().addWidget(self.wise_output)
 
-        self.wise_output.setFixedHeight(590)
+        self.wise_output.setFixedHeight(380)
         self.wise_output.setFixedWidth(700)
 
+        metrics_box = gui.widgetBox(out_tab, "Elements (last computation)", addSpace=False, orientation="vertical")
+
+        self.element_metrics_table = QtWidgets.QTableWidget(0, 0)
+        self.element_metrics_table.setStyleSheet("background-color: #FBFBFB;")
+        self.element_metrics_table.setAlternatingRowColors(True)
+        self.element_metrics_table.verticalHeader().setVisible(False)
+        self.element_metrics_table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.element_metrics_table.setFixedHeight(150)
+        self.element_metrics_table.setFixedWidth(700)
+        metrics_box.layout().addWidget(self.element_metrics_table)
+
+        metrics_button_box = gui.widgetBox(metrics_box, "", addSpace=False, orientation="horizontal")
+        gui.checkBox(metrics_button_box, self, "record_peak_memory", "Record process peak memory (slower)")
+        self.export_metrics_button = gui.button(metrics_button_box, self, "Export Metrics", callback=self.export_element_metrics, height=25)
+        self.export_metrics_button.setEnabled(False)
+
+        self.show_element_metrics()
+
         gui.rubber(self.mainArea)
 
     def set_wise_live_propagation_mode(self):
-        self.wise_live_propagation_mode = "Element by Element" if PropagationManager.Instance().get_propagation_mode(WISE_APPLICATION) == PropagationMode.STEP_BY_STEP  else \
-                                          "Whole beamline at Detector" if PropagationManager.Instance().get_propagation_mode(WISE_APPLICATION) == PropagationMode.WHOLE_BEAMLINE else \
+        from wofry.propagator.propagator import PropagationMode
+
+        propagation_mode = get_propagation_mode()
+
+        self.wise_live_propagation_mode = "Element by Element" if propagation_mode == PropagationMode.STEP_BY_STEP  else \
+                                          "Whole beamline at Detector" if propagation_mode == PropagationMode.WHOLE_BEAMLINE else \
                                           "Unknown"
 
         palette = QPalette(self.le_wise_live_propagation_mode.palette())
 
-        color = 'dark green' if PropagationManager.Instance().get_propagation_mode(WISE_APPLICATION) == PropagationMode.STEP_BY_STEP  else \
-                'dark red' if PropagationManager.Instance().get_propagation_mode(WISE_APPLICATION) == PropagationMode.WHOLE_BEAMLINE else \
+        color = 'dark green' if propagation_mode == PropagationMode.STEP_BY_STEP  else \
+                'dark red' if propagation_mode == PropagationMode.WHOLE_BEAMLINE else \
                 'black'
 
         palette.setColor(QPalette.Text, QColor(color))
@@ -302,6 +375,8 @@ class WiseWidget(widget.OWWidget):
         set_positioning_directives()
 
     def get_PositionDirectives(self):
+        from LibWiser.Foundation import PositioningDirectives
+
         return PositioningDirectives(PlaceWhat=self.What,
                                      PlaceWhere=self.Where,
                                      ReferTo=self.ReferTo,
@@ -324,6 +399,9 @@ class WiseWidget(widget.OWWidget):
             label.setText(label.text() + " [" + self.workspace_units_label + "]")
 
     def initializeTabs(self):
+        self.plot_curves = {}
+        self.plot_pending = {}
+
         size = len(self.tab)
         indexes = range(0, size)
 
@@ -412,6 +490,44 @@ class WiseWidget(widget.OWWidget):
             else:
                 raise Exception("Empty Data")
 
+    def show_element_metrics(self):
+        self.element_metrics_table.clear()
+        self.element_metrics_table.setColumnCount(6)
+        self.element_metrics_table.setRowCount(len(self.element_metrics) + (1 if len(self.element_metrics) > 0 else 0))
+        self.element_metrics_table.setHorizontalHeaderLabels(["#", "Element", "Time [s]", "Samples", "Process Peak Memory [MB]", "Field Data [MB]"])
+
+        def to_mb(value): return "" if value is None else str(round(value/2**20, 2))
+
+        rows = [[str(metrics.index), metrics.name, "%.3f" % metrics.wall_time, "" if metrics.n_samples is None else str(metrics.n_samples),
+                 to_mb(metrics.peak_memory), to_mb(metrics.field_bytes)] for metrics in self.element_metrics]
+
+        if len(self.element_metrics) > 0:
+            rows.append(["", "Total", "%.3f" % sum([metrics.wall_time for metrics in self.element_metrics]), "",
+                         to_mb(max([0 if metrics.peak_memory is None else metrics.peak_memory for metrics in self.element_metrics])),
+                         to_mb(sum([metrics.field_bytes or 0 for metrics in self.element_metrics]))])
+
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                table_item = QtWidgets.QTableWidgetItem(value)
+                table_item.setTextAlignment(Qt.AlignCenter if column == 0 else Qt.AlignLeft if column == 1 else Qt.AlignRight)
+                self.element_metrics_table.setItem(row, column, table_item)
+
+        self.element_metrics_table.resizeColumnsToContents()
+        self.export_metrics_button.setEnabled(len(self.element_metrics) > 0)
+
+    def export_element_metrics(self):
+        try:
+            file_name, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Export Metrics", ".", "JSON Lines (*.jsonl)")
+
+            if not file_name is None and not file_name.strip() == "":
+                from orangecontrib.OasysWiser.util.wise_propagation import save_element_metrics
+
+                save_element_metrics(file_name, self.element_metrics, widget=self.windowTitle(), computed=self.element_metrics_time)
+
+                QtWidgets.QMessageBox.information(self, "Export Metrics", "Metrics saved on file " + file_name, QtWidgets.QMessageBox.Ok)
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error", str(exception), QtWidgets.QMessageBox.Ok)
+
     def writeStdOut(self, text):
         cursor = self.wise_output.textCursor()
         cursor.movePosition(QtGui.QTextCursor.End)
@@ -421,33 +537,131 @@ class WiseWidget(widget.OWWidget):
 
     def plot_histo(self, x, y, progressBarValue, tabs_canvas_index, plot_canvas_index, title="", xtitle="", ytitle="", log_x=False, log_y=False):
         if self.plot_canvas[plot_canvas_index] is None:
-            self.plot_canvas[plot_canvas_index] = oasysgui.plotWindow(roi=False, control=True, position=True)
-            self.plot_canvas[plot_canvas_index].setDefaultPlotLines(True)
-            self.plot_canvas[plot_canvas_index].setActiveCurveColor(color='blue')
-            self.plot_canvas[plot_canvas_index].setXAxisLogarithmic(log_x)
-            self.plot_canvas[plot_canvas_index].setYAxisLogarithmic(log_y)
+            plot_canvas = oasysgui.plotWindow(roi=False, control=True, position=True)
+            plot_canvas.setDefaultPlotLines(True)
+            plot_canvas.setActiveCurveColor(color='blue')
+            plot_canvas.setXAxisLogarithmic(log_x)
+            plot_canvas.setYAxisLogarithmic(log_y)
+            plot_canvas.getXAxis().sigLimitsChanged.connect(lambda x_min, x_max, index=plot_canvas_index, canvas=plot_canvas: self.refine_plot(index, canvas))
+
+            self.plot_canvas[plot_canvas_index] = plot_canvas
+            self.tab[tabs_canvas_index].layout().addWidget(plot_canvas)
 
-            self.tab[tabs_canvas_index].layout().addWidget(self.plot_canvas[plot_canvas_index])
+        self.plot_curves[plot_canvas_index] = (DecimatedCurve(x, y), title, xtitle, ytitle)
 
-        WiserPlot.plot_histo(self.plot_canvas[plot_canvas_index], x, y, title, xtitle, ytitle)
+        # hidden tabs are drawn when shown: only the last curve sent to them (e.g. during animations) is drawn
+        if self.tabs.currentIndex() == tabs_canvas_index:
+            self.plot_pending.pop(tabs_canvas_index, None)
+            self.draw_plot(plot_canvas_index)
+        else:
+            self.plot_pending[tabs_canvas_index] = plot_canvas_index
 
         self.progressBarSet(progressBarValue)
 
+    def get_plot_bins(self, plot_canvas):
+        return max(plot_canvas.width(), self.IMAGE_WIDTH) # 2 points (min, max) per pixel column
+
+    def draw_plot(self, plot_canvas_index):
+        plot_canvas = self.plot_canvas[plot_canvas_index]
+        curve, title, xtitle, ytitle = self.plot_curves[plot_canvas_index]
+
+        x, y = curve.get_points(self.get_plot_bins(plot_canvas))
+
+        WiserPlot.plot_histo(plot_canvas, x, y, title, xtitle, ytitle)
+
+    def show_pending_plot(self, tabs_canvas_index):
+        if tabs_canvas_index in self.plot_pending: self.draw_plot(self.plot_pending.pop(tabs_canvas_index))
+
+    def refine_plot(self, plot_canvas_index, plot_canvas):
+        '''
+        Level of detail: on zoom/pan the visible range is decimated again, down to full resolution
+        '''
+        if self.plot_canvas[plot_canvas_index] is plot_canvas and plot_canvas_index in self.plot_curves:
+            curve, title, _, _ = self.plot_curves[plot_canvas_index]
+            n_bins = self.get_plot_bins(plot_canvas)
+
+            if not curve.last_view is None and curve.needs_decimation(n_bins): # drawn and decimated
+                x_min, x_max = plot_canvas.getXAxis().getLimits()
+
+                points = curve.get_points(n_bins, x_min, x_max)
+
+                if not points is None: plot_canvas.addCurve(points[0], points[1], title, symbol='', color='blue', replace=False, resetzoom=False)
 
     def compute(self):
+        if self.is_computing():
+            # the running calculation is obsolete: it will be restarted as soon as it stops
+            self.compute_requested = True
+            self.current_task.cancel()
+
+            return
+
+        self.compute_requested = False
+
         self.setStatusMessage("Running WISEr")
 
         self.progressBarInit()
 
         try:
-            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
 
-            self.progressBarSet(20)
+            self.progressBarSet(5)
 
             self.check_fields()
 
-            calculation_output = self.do_wise_calculation()
+            self.current_task = self.executor.submit(self.get_profiled(self.do_wise_calculation),
+                                                     on_finished=self.compute_finished,
+                                                     on_failed=self.compute_failed,
+                                                     on_cancelled=self.compute_cancelled,
+                                                     on_progress=self.compute_progress,
+                                                     on_output=self.writeStdOut)
+            self.set_Computing(True)
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       str(exception), QtWidgets.QMessageBox.Ok)
+
+            self.setStatusMessage("Error!")
+            self.progressBarFinished()
+
+            raise exception
+
+    def profile_next_compute(self):
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self, "Profile Next Compute: output directory", ".")
+
+        if not directory is None and not directory.strip() == "":
+            self.profile_directory = directory
+            self.setStatusMessage("Next computation will be profiled")
+
+    def get_profiled(self, function):
+        '''
+        function wrapped by the profiler, if the next calculation has to be profiled (once)
+        '''
+        if self.profile_directory is None: return function
+
+        profiler = WiserProfiler(self.profile_directory, type(self).__name__ + "-" + function.__name__)
+        self.profile_directory = None
 
+        return profiler.wrap(function)
+
+    def cancel_compute(self):
+        self.compute_requested = False
+
+        if self.is_computing():
+            self.setStatusMessage("Cancelling...")
+            self.current_task.cancel()
+
+    def is_computing(self):
+        return not self.current_task is None # until its outcome is processed in the GUI thread
+
+    def set_Computing(self, computing):
+        self.compute_button.setEnabled(not computing)
+        self.cancel_button.setEnabled(computing)
+
+    def compute_progress(self, value, message):
+        self.progressBarSet(5 + 0.45*value) # the calculation takes the progress bar from 5 to 50
+        if message: self.setStatusMessage(message)
+
+    def compute_finished(self, calculation_output):
+        try:
             self.progressBarSet(50)
 
             if calculation_output is None:
@@ -464,19 +678,59 @@ class WiseWidget(widget.OWWidget):
                 wise_data = self.extract_wise_data_from_calculation_output(calculation_output)
                 if not wise_data is None: self.send("WiseData", wise_data)
 
+            self.show_element_metrics()
+
         except Exception as exception:
             QtWidgets.QMessageBox.critical(self, "Error",
                                        str(exception), QtWidgets.QMessageBox.Ok)
 
             self.setStatusMessage("Error!")
 
-            raise exception
+        self.compute_terminated()
+
+    def compute_failed(self, exception):
+        QtWidgets.QMessageBox.critical(self, "Error",
+                                   str(exception), QtWidgets.QMessageBox.Ok)
+
+        self.setStatusMessage("Error!")
 
+        self.compute_terminated()
+
+    def compute_cancelled(self):
+        self.setStatusMessage("Cancelled")
+
+        self.compute_terminated()
+
+    def compute_terminated(self):
+        self.current_task = None
+        self.set_Computing(False)
         self.progressBarFinished()
 
+        if self.compute_requested: self.compute()
+
+    def onDeleteWidget(self):
+        self.compute_requested = False
+        if self.is_computing(): self.current_task.cancel()
+        self.executor.shutdown(wait=False)
+
+        super().onDeleteWidget()
+
     def defaults(self):
          self.resetSettings()
 
+    def get_settings_values(self):
+        settings_values = {}
+
+        for widget_class in reversed(type(self).__mro__):
+            for name, value in vars(widget_class).items():
+                if isinstance(value, Setting) and not name in self.result_independent_settings:
+                    settings_values[name] = getattr(self, name)
+
+        return settings_values
+
+    def get_settings_fingerprint(self):
+        return fingerprint(type(self).__name__, self.get_settings_values(), getattr(self, "workspace_units_to_m", 1.0))
+
     def check_fields(self):
         raise Exception("This method should be reimplementd in subclasses!")
 
@@ -1,4 +1,4 @@
-import sys, numpy
+import numpy
 
 from PyQt5.QtGui import QPalette, QColor, QFont
 from PyQt5.QtWidgets import QMessageBox, QFileDialog, QSlider
@@ -12,14 +12,12 @@ from orangewidget.settings import Setting
 
 from syned.widget.widget_decorator import WidgetDecorator
 
-from LibWiser import Foundation, Optics
-
-from WofryWiser.beamline.beamline_elements import WiserOpticalElement
-
+from orangecontrib.OasysWiser.util.wise_focus import FocusSweepResult, compute_focus_sweep, search_best_focus, normalize_intensity, save_focus_sweep, load_focus_sweep
+from orangecontrib.OasysWiser.util.wise_ensemble import compute_ensemble
+from orangecontrib.OasysWiser.util.wise_decimation import decimate_min_max
+from orangecontrib.OasysWiser.util.wise_threading import redirect_stdout
 from orangecontrib.OasysWiser.widgets.gui.ow_optical_element import OWOpticalElement
 
-WiseDetector = WiserOpticalElement()
-
 class OWDetector(OWOpticalElement, WidgetDecorator):
     name = "Detector"
     id = "Detector"
@@ -29,18 +27,41 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
 
     has_figure_error_box = False
     is_full_propagator = True
-    run_calculation = False
+    best_focus_task = None
+    best_focus_progress_value = 0
 
     defocus_sweep = Setting(0.0)
     defocus_start = Setting(-1.0)
     defocus_stop = Setting(1.0)
     defocus_step = Setting(0.1)
+    best_focus_search = Setting(0)
+    n_coarse_points = Setting(11)
+    best_focus_tolerance = Setting(0.001)
     show_animation = Setting(0)
+    compress_best_focus_results = Setting(0)
+    ensemble_percentile_low = Setting(5.0)
+    ensemble_percentile_high = Setting(95.0)
+
+    ensemble_task = None
+    ensemble_result = None
 
     output_data_best_focus = None
 
     _defocus_sign = 1
 
+    def __init__(self):
+        super().__init__()
+
+        ensemble_tab = oasysgui.createTabPage(self.main_tabs, "Figure Error Ensemble")
+
+        self.ensemble_tabs = oasysgui.tabWidget(ensemble_tab)
+        self.ensemble_plot_canvas = [oasysgui.plotWindow(roi=False, control=True, position=True) for _ in range(2)]
+
+        for title, plot_canvas in zip(["Intensity Bands", "HEW"], self.ensemble_plot_canvas):
+            plot_canvas.setDefaultPlotLines(True)
+            plot_canvas.setActiveCurveColor(color='blue')
+            oasysgui.createTabPage(self.ensemble_tabs, title).layout().addWidget(plot_canvas)
+
     def after_change_workspace_units(self):
         super(OWDetector, self).after_change_workspace_units()
 
@@ -50,6 +71,8 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
         label.setText(label.text() + " [" + self.workspace_units_label + "]")
         label = self.le_defocus_step.parent().layout().itemAt(0).widget()
         label.setText(label.text() + " [" + self.workspace_units_label + "]")
+        label = self.le_best_focus_tolerance.parent().layout().itemAt(0).widget()
+        label.setText(label.text() + " [" + self.workspace_units_label + "]")
 
 
     def check_fields(self):
@@ -60,9 +83,23 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
 
         best_focus_box = oasysgui.widgetBox(self.tab_best, "", orientation="vertical", width=self.CONTROL_AREA_WIDTH-20)
 
+        gui.comboBox(best_focus_box, self, "best_focus_search", label="Search", labelWidth=240,
+                     items=["Uniform Grid", "Adaptive"],
+                     callback=self.set_BestFocusSearch, sendSelectedValue=False, orientation="horizontal")
+
         self.le_defocus_start = oasysgui.lineEdit(best_focus_box, self, "defocus_start", "Defocus sweep start", labelWidth=240, valueType=float, orientation="horizontal")
         self.le_defocus_stop  = oasysgui.lineEdit(best_focus_box, self, "defocus_stop",  "Defocus sweep stop", labelWidth=240, valueType=float, orientation="horizontal")
-        self.le_defocus_step  = oasysgui.lineEdit(best_focus_box, self, "defocus_step",  "Defocus sweep step", labelWidth=240, valueType=float, orientation="horizontal")
+
+        self.uniform_grid_box = oasysgui.widgetBox(best_focus_box, "", orientation="vertical", width=self.CONTROL_AREA_WIDTH-20, height=30)
+
+        self.le_defocus_step  = oasysgui.lineEdit(self.uniform_grid_box, self, "defocus_step",  "Defocus sweep step", labelWidth=240, valueType=float, orientation="horizontal")
+
+        self.adaptive_box = oasysgui.widgetBox(best_focus_box, "", orientation="vertical", width=self.CONTROL_AREA_WIDTH-20, height=60)
+
+        oasysgui.lineEdit(self.adaptive_box, self, "n_coarse_points", "Coarse grid points", labelWidth=240, valueType=int, orientation="horizontal")
+        self.le_best_focus_tolerance = oasysgui.lineEdit(self.adaptive_box, self, "best_focus_tolerance", "Tolerance", labelWidth=240, valueType=float, orientation="horizontal")
+
+        self.set_BestFocusSearch()
 
         gui.separator(best_focus_box, height=5)
 
@@ -81,11 +118,45 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
         palette.setColor(QPalette.ButtonText, QColor('red'))
         stop_button.setPalette(palette) # assign new palette
 
-        self.save_button = gui.button(best_focus_box, self, "Save Best Focus Calculation Complete Results", callback=self.save_best_focus_results, height=35)
+        gui.separator(best_focus_box, height=5)
+
+        gui.checkBox(best_focus_box, self, "compress_best_focus_results", "Compress saved results")
+
+        button_box = oasysgui.widgetBox(best_focus_box, "", orientation="horizontal", width=self.CONTROL_AREA_WIDTH-20)
+
+        self.save_button = gui.button(button_box, self, "Save Complete Results", callback=self.save_best_focus_results, height=35)
         self.save_button.setEnabled(False)
+        gui.button(button_box, self, "Load Complete Results", callback=self.load_best_focus_results, height=35)
 
         self.best_focus_slider = None
 
+        tab_ensemble = oasysgui.createTabPage(self.tabs_setting, "Figure Error Ensemble")
+
+        ensemble_box = oasysgui.widgetBox(tab_ensemble, "", orientation="vertical", width=self.CONTROL_AREA_WIDTH-20)
+
+        gui.label(ensemble_box, self, "Ensembles are defined by the Height Profile Simulator")
+
+        oasysgui.lineEdit(ensemble_box, self, "ensemble_percentile_low", "Lower percentile [%]", labelWidth=240, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(ensemble_box, self, "ensemble_percentile_high", "Upper percentile [%]", labelWidth=240, valueType=float, orientation="horizontal")
+
+        button_box = oasysgui.widgetBox(ensemble_box, "", orientation="horizontal", width=self.CONTROL_AREA_WIDTH-20)
+
+        gui.button(button_box, self, "Propagate Ensemble", callback=self.do_ensemble_calculation, height=35)
+        stop_button = gui.button(button_box, self, "Interrupt", callback=self.stop_ensemble_calculation, height=35)
+        font = QFont(stop_button.font())
+        font.setBold(True)
+        stop_button.setFont(font)
+        palette = QPalette(stop_button.palette()) # make a copy of the palette
+        palette.setColor(QPalette.ButtonText, QColor('red'))
+        stop_button.setPalette(palette) # assign new palette
+
+        self.save_ensemble_button = gui.button(ensemble_box, self, "Save Ensemble HEWs", callback=self.save_ensemble_results, height=35)
+        self.save_ensemble_button.setEnabled(False)
+
+    def set_BestFocusSearch(self):
+        self.uniform_grid_box.setVisible(self.best_focus_search == 0)
+        self.adaptive_box.setVisible(self.best_focus_search == 1)
+
     def initializeTabs(self):
         super(OWDetector, self).initializeTabs()
 
@@ -99,10 +170,14 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
             tab.setFixedWidth(self.IMAGE_WIDTH)
 
     def get_inner_wise_optical_element(self):
+        from LibWiser import Optics
+
         return Optics.Detector(L=self.length*self.workspace_units_to_m,
                                AngleGrazing = numpy.deg2rad(self.alpha))
 
     def get_optical_element(self, inner_wise_optical_element):
+         from WofryWiser.beamline.beamline_elements import WiserOpticalElement
+
          return WiserOpticalElement(name=self.oe_name,
                                     boundary_shape=None,
                                     native_CoreOptics=inner_wise_optical_element,
@@ -134,7 +209,7 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
         return [(False, False), (False, False)]
 
     def stop_best_focus_calculation(self):
-        self.run_calculation = False
+        if not self.best_focus_task is None: self.best_focus_task.cancel()
 
     def do_wise_calculation(self):
         self.output_data_best_focus = super(OWDetector, self).do_wise_calculation()
@@ -142,6 +217,8 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
         return self.output_data_best_focus
 
     def do_best_focus_calculation(self):
+        if not self.best_focus_task is None: return
+
         try:
             if self.input_data is None:
                 raise Exception("No Input Data!")
@@ -149,41 +226,44 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
             if not self.output_data_best_focus:
                 raise Exception("Run computation first!")
 
-            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
 
             # TODO: TO BE CHECKED THE EQUiVALENT OF THE OLD QUANTITY!!!!
             self.oe_f2 = self.output_data_best_focus.wise_beamline.get_wise_propagation_element(-1).PositioningDirectives.Distance
 
             self.check_fields()
             if self.defocus_start >= self.defocus_stop: raise Exception("Defocus sweep start must be < Defocus sweep stop")
-            self.defocus_step = congruence.checkStrictlyPositiveNumber(self. defocus_step, "Defocus sweep step")
-            if self.defocus_step >= self.defocus_stop - self.defocus_start: raise Exception("Defocus step is too big")
-
-            if self.best_focus_slider is None:
-                self.best_focus_slider = QSlider(self.tab[1])
-                self.best_focus_slider.setGeometry(QRect(0, 0, 320, 50))
-                self.best_focus_slider.setMinimumHeight(30)
-                self.best_focus_slider.setOrientation(Qt.Horizontal)
-                self.best_focus_slider.setInvertedAppearance(False)
-                self.best_focus_slider.setInvertedControls(False)
-
-                self.tab[2].layout().addWidget(self.best_focus_slider)
+            if self.best_focus_search == 0:
+                self.defocus_step = congruence.checkStrictlyPositiveNumber(self. defocus_step, "Defocus sweep step")
+                if self.defocus_step >= self.defocus_stop - self.defocus_start: raise Exception("Defocus step is too big")
             else:
-                self.best_focus_slider.valueChanged.disconnect()
+                self.n_coarse_points = congruence.checkStrictlyPositiveNumber(self.n_coarse_points, "Coarse grid points")
+                if self.n_coarse_points < 3: raise Exception("Coarse grid points must be >= 3")
+                self.best_focus_tolerance = congruence.checkStrictlyPositiveNumber(self.best_focus_tolerance, "Tolerance")
+                if self.best_focus_tolerance >= self.defocus_stop - self.defocus_start: raise Exception("Tolerance is too big")
+
+            self.initialize_best_focus_slider()
 
             self.setStatusMessage("")
             self.progressBarInit()
 
-            self.defocus_list = numpy.arange(self.defocus_start * self.workspace_units_to_m,
-                                             self.defocus_stop  * self.workspace_units_to_m,
-                                             self.defocus_step  * self.workspace_units_to_m)
+            if self.best_focus_search == 0:
+                self.defocus_list = numpy.arange(self.defocus_start * self.workspace_units_to_m,
+                                                 self.defocus_stop  * self.workspace_units_to_m,
+                                                 self.defocus_step  * self.workspace_units_to_m)
+
+                n_defocus = len(self.defocus_list)
 
-            n_defocus = len(self.defocus_list)
+                if self.defocus_list[-1] != self.defocus_stop  * self.workspace_units_to_m:
+                    n_defocus += 1
+                    self.defocus_list.resize(n_defocus)
+                    self.defocus_list[-1] = self.defocus_stop  * self.workspace_units_to_m
 
-            if self.defocus_list[-1] != self.defocus_stop  * self.workspace_units_to_m:
-                n_defocus += 1
-                self.defocus_list.resize(n_defocus)
-                self.defocus_list[-1] = self.defocus_stop  * self.workspace_units_to_m
+                self.defocus_list[numpy.where(numpy.abs(self.defocus_list) < 1e-15)] = 0.0
+            else: # planes are known at the end of the search
+                self.defocus_list = numpy.array([])
+
+                n_defocus = 1
 
             self.best_focus_slider.setTickInterval(1)
             self.best_focus_slider.setSingleStep(1)
@@ -191,162 +271,191 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
             self.best_focus_slider.setMaximum(n_defocus-1)
             self.best_focus_slider.setValue(0)
 
-            progress_bar_increment = 100/n_defocus
+            self.best_focus_index = -1
+            self.electric_fields_list = [None]*n_defocus
+            self.positions_list = [None]*n_defocus
+            self.hews_list = [numpy.nan]*n_defocus
+
+            self.setStatusMessage("Calculating Best Focus Position")
 
             n_pools = self.n_pools if self.use_multipool == 1 else 1
+            callbacks = {"on_finished" : self.best_focus_finished,
+                         "on_failed" : self.best_focus_failed,
+                         "on_cancelled" : self.best_focus_cancelled,
+                         "on_progress" : self.best_focus_progress,
+                         "on_partial_result" : self.best_focus_partial_result if self.show_animation == 1 else None,
+                         "on_output" : self.writeStdOut}
+
+            if self.best_focus_search == 0:
+                self.best_focus_task = self.executor.submit(self.get_profiled(compute_focus_sweep),
+                                                            self.get_last_element(),
+                                                            self.defocus_list,
+                                                            self.length*self.workspace_units_to_m,
+                                                            n_pools=n_pools,
+                                                            **callbacks)
+            else:
+                self.best_focus_task = self.executor.submit(self.get_profiled(search_best_focus),
+                                                            self.get_last_element(),
+                                                            self.defocus_start * self.workspace_units_to_m,
+                                                            self.defocus_stop * self.workspace_units_to_m,
+                                                            self.length*self.workspace_units_to_m,
+                                                            n_coarse_points=self.n_coarse_points,
+                                                            tolerance=self.best_focus_tolerance * self.workspace_units_to_m,
+                                                            n_pools=n_pools,
+                                                            **callbacks)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
 
-            hew_min = numpy.inf
-            index_min_list = []
+            self.setStatusMessage("Error!")
 
-            self.best_focus_index = -1
-            self.electric_fields_list = []
-            self.positions_list = []
-            self.hews_list = []
+            self.best_focus_terminated()
 
-            import copy
-            last_element = self.get_last_element()
-            last_element = copy.deepcopy(last_element)
+            #raise exception
 
-            self.setStatusMessage("Calculating Best Focus Position")
+    def initialize_best_focus_slider(self):
+        if self.best_focus_slider is None:
+            self.best_focus_slider = QSlider(self.tab[1])
+            self.best_focus_slider.setGeometry(QRect(0, 0, 320, 50))
+            self.best_focus_slider.setMinimumHeight(30)
+            self.best_focus_slider.setOrientation(Qt.Horizontal)
+            self.best_focus_slider.setInvertedAppearance(False)
+            self.best_focus_slider.setInvertedControls(False)
 
-            self.run_calculation = True
-
-            self.defocus_list[numpy.where(numpy.abs(self.defocus_list) < 1e-15)] = 0.0
-
-            if self.show_animation == 1:
-                for i, defocus in enumerate(self.defocus_list):
-                    if not self.run_calculation:
-                        if not self.best_focus_slider is None: self.best_focus_slider.valueChanged.connect(self.plot_detail)
-                        return
-
-                    ResultList, HewList, SigmaList, More = Foundation.FocusSweep(last_element, [self.defocus_list[i]],
-                                                                                 DetectorSize = self.length*self.workspace_units_to_m,
-                                                                                 NPools = n_pools)
-
-                    S = ResultList[0].S
-                    E = ResultList[0].Field
-                    I = abs(E)**2
-                    norm = max(I)
-                    norm = 1.0 if norm == 0.0 else norm
-                    I = I/norm
-                    HEW = HewList[0]
-
-                    # E1
-                    self.electric_fields_list.append(E)
-                    self.positions_list.append(S)
-                    self.hews_list.append(HEW)
-
-                    self.best_focus_slider.setValue(i)
-
-                    self.plot_histo(S * 1e6,
-                                    I,
-                                    i*progress_bar_increment,
-                                    tabs_canvas_index=2,
-                                    plot_canvas_index=2,
-                                    title="Defocus Sweep: " + str(self._defocus_sign * defocus/self.workspace_units_to_m) + " (" + str(i+1) + "/" + str(n_defocus) +
-                                          "), HEW: " + str(round(HEW*1e6, 4)) + " [$\mu$m]",
-                                    xtitle="Y [$\mu$m]",
-                                    ytitle="Intensity",
-                                    log_x=False,
-                                    log_y=False)
-
-                    self.tabs.setCurrentIndex(2)
-
-                    hew = round(HEW*1e6, 11) # problems with double precision numbers: inconsistent comparisons
-
-                    if hew < hew_min:
-                        hew_min = hew
-                        index_min_list = [i]
-                    elif hew == hew_min:
-                        index_min_list.append(i)
-            else: # NOT INTERACTIVE
-                ResultList, HewList, SigmaList, More = Foundation.FocusSweep(last_element,
-                                                                             self.defocus_list,
-                                                                             DetectorSize = self.length*self.workspace_units_to_m,
-                                                                             NPools = n_pools)
-
-                i=0
-                for Result, HEW in zip(ResultList, HewList):
-                    self.electric_fields_list.append(Result.Field)
-                    self.positions_list.append(Result.S)
-                    self.hews_list.append(HEW)
-
-                    hew = round(HEW*1e6, 11) # problems with double precision numbers: inconsistent comparisons
-
-                    if hew < hew_min:
-                        hew_min = hew
-                        index_min_list = [i]
-                    elif hew == hew_min:
-                        index_min_list.append(i)
-
-                    i += 1
-
-            index_min = index_min_list[int(len(index_min_list)/2)] # choosing the central value, when hew reach a pletau
-
-            self.best_focus_index = index_min
-            best_focus_electric_fields = self.electric_fields_list[index_min]
-            best_focus_I = abs(best_focus_electric_fields)**2
-            norm = max(best_focus_I)
-            norm = 1.0 if norm == 0.0 else norm
-            best_focus_I = best_focus_I/norm
+            self.tab[2].layout().addWidget(self.best_focus_slider)
+        else:
+            self.best_focus_slider.valueChanged.disconnect()
 
-            best_focus_positions       = self.positions_list[index_min]
+    def best_focus_progress(self, value, message):
+        self.best_focus_progress_value = value
 
-            QMessageBox.information(self,
-                                    "Best Focus Calculation",
-                                    "Best Focus Found!\n\nPosition: " + str(self.oe_f2 + (self._defocus_sign * self.defocus_list[index_min]/self.workspace_units_to_m)) +
-                                    "\nHEW: " + str(round(self.hews_list[index_min]*1e6, 4)) + " [" + u"\u03BC" + "m]",
-                                    QMessageBox.Ok
-                                    )
+        self.progressBarSet(value)
+        self.setStatusMessage(message)
 
-            self.plot_histo(best_focus_positions * 1e6,
-                            best_focus_I,
-                            100,
-                            tabs_canvas_index=2,
-                            plot_canvas_index=2,
-                            title="(BEST FOCUS) Defocus Sweep: " + str(self._defocus_sign * self.defocus_list[index_min]/self.workspace_units_to_m) +
-                                  " ("+ str(index_min+1) + "/" + str(n_defocus) + "), Position: " +
-                                  str(self.oe_f2 + (self._defocus_sign * self.defocus_list[index_min]/self.workspace_units_to_m)) +
-                                  ", HEW: " + str(round(self.hews_list[index_min]*1e6, 4)) + " [$\mu$m]",
-                            xtitle="Y [$\mu$m]",
-                            ytitle="Intensity",
-                            log_x=False,
-                            log_y=False)
+    def best_focus_partial_result(self, partial_result):
+        if self.best_focus_search == 0:
+            for index, electric_field, positions, hew in zip(partial_result.indices, partial_result.electric_fields, partial_result.positions, partial_result.hews):
+                self.electric_fields_list[index] = electric_field
+                self.positions_list[index] = positions
+                self.hews_list[index] = hew
 
-            self.plot_histo(self._defocus_sign * self.defocus_list,
-                            numpy.multiply(self.hews_list, 1e6),
-                            100,
-                            tabs_canvas_index=3,
-                            plot_canvas_index=3,
-                            title="HEW vs Defocus Sweep",
-                            xtitle="",
-                            ytitle="",
-                            log_x=False,
-                            log_y=False)
+            self.best_focus_slider.setValue(partial_result.indices[-1])
 
-            self.plot_canvas[3].setDefaultPlotLines(True)
-            self.plot_canvas[3].setDefaultPlotPoints(True)
-            self.plot_canvas[3].setGraphXLabel("Defocus [" + self.workspace_units_label + "]")
-            self.plot_canvas[3].setGraphYLabel("HEW [$\mu$m]")
+            counter = str(partial_result.indices[-1]+1) + "/" + str(len(self.defocus_list))
+        else:
+            counter = "plane " + str(partial_result.indices[-1]+1)
+
+        defocus = partial_result.defocus_list[-1]
+        HEW = partial_result.hews[-1]
+
+        self.plot_histo(partial_result.positions[-1] * 1e6,
+                        normalize_intensity(partial_result.electric_fields[-1]),
+                        self.best_focus_progress_value,
+                        tabs_canvas_index=2,
+                        plot_canvas_index=2,
+                        title="Defocus Sweep: " + str(self._defocus_sign * defocus/self.workspace_units_to_m) + " (" + counter +
+                              "), HEW: " + str(round(HEW*1e6, 4)) + " [$\mu$m]",
+                        xtitle="Y [$\mu$m]",
+                        ytitle="Intensity",
+                        log_x=False,
+                        log_y=False)
+
+        self.tabs.setCurrentIndex(2)
+
+    def best_focus_finished(self, focus_sweep_result):
+        try:
+            self.defocus_list = focus_sweep_result.defocus_list
+            self.electric_fields_list = focus_sweep_result.electric_fields
+            self.positions_list = focus_sweep_result.positions
+            self.hews_list = focus_sweep_result.hews
 
-            self.best_focus_slider.setValue(index_min)
+            self.best_focus_slider.setMaximum(len(self.defocus_list)-1)
 
-            self.tabs.setCurrentIndex(3 if self.show_animation == 1 else 2)
-            self.setStatusMessage("")
+            if self.best_focus_search == 1 and not self.best_focus_task is None: print("Best Focus Search: " + str(len(self.defocus_list)) + " planes computed")
 
-            self.save_button.setEnabled(True)
+            self.show_best_focus(focus_sweep_result.get_best_focus_index())
 
+            self.save_button.setEnabled(True)
         except Exception as exception:
             QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
 
             self.setStatusMessage("Error!")
 
-            #raise exception
+        self.best_focus_terminated()
+
+    def best_focus_failed(self, exception):
+        QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+        self.setStatusMessage("Error!")
+
+        self.best_focus_terminated()
+
+    def best_focus_cancelled(self):
+        self.setStatusMessage("Best Focus Calculation interrupted")
+
+        self.best_focus_terminated()
+
+    def best_focus_terminated(self):
+        self.best_focus_task = None
 
         if not self.best_focus_slider is None: self.best_focus_slider.valueChanged.connect(self.plot_detail)
         self.progressBarFinished()
 
+    def onDeleteWidget(self):
+        self.stop_best_focus_calculation()
+        self.stop_ensemble_calculation()
+
+        super(OWDetector, self).onDeleteWidget()
+
+    def show_best_focus(self, index_min):
+        n_defocus = len(self.defocus_list)
+
+        self.best_focus_index = index_min
+        best_focus_I = normalize_intensity(self.electric_fields_list[index_min])
+        best_focus_positions = self.positions_list[index_min]
+
+        QMessageBox.information(self,
+                                "Best Focus Calculation",
+                                "Best Focus Found!\n\nPosition: " + str(self.oe_f2 + (self._defocus_sign * self.defocus_list[index_min]/self.workspace_units_to_m)) +
+                                "\nHEW: " + str(round(self.hews_list[index_min]*1e6, 4)) + " [" + u"\u03BC" + "m]",
+                                QMessageBox.Ok
+                                )
+
+        self.plot_histo(best_focus_positions * 1e6,
+                        best_focus_I,
+                        100,
+                        tabs_canvas_index=2,
+                        plot_canvas_index=2,
+                        title="(BEST FOCUS) Defocus Sweep: " + str(self._defocus_sign * self.defocus_list[index_min]/self.workspace_units_to_m) +
+                              " ("+ str(index_min+1) + "/" + str(n_defocus) + "), Position: " +
+                              str(self.oe_f2 + (self._defocus_sign * self.defocus_list[index_min]/self.workspace_units_to_m)) +
+                              ", HEW: " + str(round(self.hews_list[index_min]*1e6, 4)) + " [$\mu$m]",
+                        xtitle="Y [$\mu$m]",
+                        ytitle="Intensity",
+                        log_x=False,
+                        log_y=False)
+
+        self.plot_histo(self._defocus_sign * self.defocus_list,
+                        numpy.multiply(self.hews_list, 1e6),
+                        100,
+                        tabs_canvas_index=3,
+                        plot_canvas_index=3,
+                        title="HEW vs Defocus Sweep",
+                        xtitle="Defocus [" + self.workspace_units_label + "]",
+                        ytitle="HEW [$\mu$m]",
+                        log_x=False,
+                        log_y=False)
+
+        self.plot_canvas[3].setDefaultPlotLines(True)
+        self.plot_canvas[3].setDefaultPlotPoints(True)
+
+        self.best_focus_slider.setValue(index_min)
+
+        self.tabs.setCurrentIndex(3 if self.show_animation == 1 else 2)
+        self.setStatusMessage("")
+
     def get_last_element(self):
+        from LibWiser import Optics
+
         last_element = self.output_data_best_focus.wise_beamline.get_wise_propagation_element(-1)
 
         if isinstance(last_element.CoreOptics, Optics.Detector):
@@ -392,41 +501,168 @@ class OWDetector(OWOpticalElement, WidgetDecorator):
 
     def save_best_focus_results(self):
         try:
-            path_dir = QFileDialog.getExistingDirectory(self, "Select destination directory", ".", QFileDialog.ShowDirsOnly)
+            file_name, _ = QFileDialog.getSaveFileName(self, "Save Best Focus Calculation Complete Results", ".", "HDF5 Files (*.h5 *.hdf5)")
+
+            if not file_name is None and not file_name.strip() == "":
+                if not file_name.endswith((".h5", ".hdf5")): file_name += ".h5"
+
+                save_focus_sweep(file_name,
+                                 FocusSweepResult(self.defocus_list, self.electric_fields_list, self.positions_list, self.hews_list),
+                                 compressed=self.compress_best_focus_results == 1,
+                                 attributes={"oe_f2" : self.oe_f2})
+
+                QMessageBox.information(self,
+                                        "Best Focus Calculation",
+                                        "Best Focus Calculation complete results saved on file:\n\n" + file_name,
+                                        QMessageBox.Ok
+                                        )
+
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+            self.setStatusMessage("Error!")
+
+    def load_best_focus_results(self):
+        if not self.best_focus_task is None: return
+
+        try:
+            file_name, _ = QFileDialog.getOpenFileName(self, "Load Best Focus Calculation Complete Results", ".", "HDF5 Files (*.h5 *.hdf5)")
+
+            if not file_name is None and not file_name.strip() == "":
+                focus_sweep_result, attributes = load_focus_sweep(file_name)
+
+                self.oe_f2 = attributes.get("oe_f2", 0.0)
+
+                self.initialize_best_focus_slider()
+                self.best_focus_slider.setTickInterval(1)
+                self.best_focus_slider.setSingleStep(1)
+                self.best_focus_slider.setMinimum(0)
+
+                self.best_focus_finished(focus_sweep_result)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+            self.setStatusMessage("Error!")
+
+    ###############################################################
+    # FIGURE ERROR ENSEMBLE
+
+    def do_ensemble_calculation(self):
+        if not self.ensemble_task is None: return
+
+        try:
+            if not self.output_data_best_focus:
+                raise Exception("Run computation first!")
 
-            if not path_dir is None:
-                if not path_dir.strip() == "":
-                    if QMessageBox.question(self,
-                                            "Save Data",
-                                            "Data will be saved in :\n\n" + path_dir + "\n\nConfirm?",
-                                            QMessageBox.Yes | QMessageBox.No) == QMessageBox.Yes:
-                        for index in range(0, len(self.electric_fields_list)):
-                            file_name = "best_focus_partial_result_" + str(index) + ".dat"
+            if len(self.output_data_best_focus.figure_error_ensembles) == 0:
+                raise Exception("No figure error ensemble upstream: set Monte Carlo ensemble members > 1 in the Height Profile Simulator")
 
-                            file = open(path_dir + "/" + file_name, "w")
+            congruence.checkPositiveNumber(self.ensemble_percentile_low, "Lower percentile")
+            congruence.checkPositiveNumber(self.ensemble_percentile_high, "Upper percentile")
+            if self.ensemble_percentile_low >= self.ensemble_percentile_high or self.ensemble_percentile_high > 100:
+                raise Exception("Percentiles must be 0 <= lower < upper <= 100")
 
-                            intensities = abs(self.electric_fields_list[index])**2
-                            norm = max(intensities)
-                            norm = 1.0 if norm == 0.0 else norm
-                            intensities = intensities/norm
+            redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
 
-                            file.write("# Defocus Sweep: " + str(self.defocus_list[index]) + " [m]\n")
-                            file.write("# HEW          : " + str(self.hews_list[index]) + " [m]\n")
-                            file.write("# Position [m]  Intensity\n")
+            self.ensemble_result = None
+            self.save_ensemble_button.setEnabled(False)
 
-                            for i in range (0, len(self.positions_list[index])):
-                                file.write(str(self.positions_list[index][i]) + " " + str(intensities[i]) + "\n")
+            self.setStatusMessage("Propagating Figure Error Ensemble")
+            self.progressBarInit()
 
+            self.ensemble_task = self.executor.submit(compute_ensemble,
+                                                      self.output_data_best_focus,
+                                                      self.output_data_best_focus.figure_error_ensembles,
+                                                      n_pools=self.n_pools if self.use_multipool == 1 else 1,
+                                                      on_finished=self.ensemble_finished,
+                                                      on_failed=self.ensemble_failed,
+                                                      on_cancelled=self.ensemble_cancelled,
+                                                      on_progress=self.ensemble_progress,
+                                                      on_output=self.writeStdOut)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
 
-                            file.close()
+            self.setStatusMessage("Error!")
 
-                        QMessageBox.information(self,
-                                                "Best Focus Calculation",
-                                                "Best Focus Calculation complete results saved on directory:\n\n" + path_dir,
-                                                QMessageBox.Ok
-                                                )
+            self.ensemble_terminated()
 
+    def stop_ensemble_calculation(self):
+        if not self.ensemble_task is None: self.ensemble_task.cancel()
+
+    def ensemble_progress(self, value, message):
+        self.progressBarSet(value)
+        self.setStatusMessage(message)
+
+    def ensemble_finished(self, ensemble_result):
+        try:
+            self.ensemble_result = ensemble_result
+            self.save_ensemble_button.setEnabled(True)
+
+            percentiles = (self.ensemble_percentile_low, 50, self.ensemble_percentile_high)
+
+            hew_mean, hew_std, hew_percentiles = ensemble_result.get_hew_statistics(percentiles)
+            positions, intensity_mean, intensity_percentiles = ensemble_result.get_intensity_bands(percentiles)
+
+            print("Figure Error Ensemble (" + str(len(ensemble_result.hews)) + " members), HEW [um]: mean = " + str(round(hew_mean*1e6, 4)) +
+                  ", std = " + str(round(hew_std*1e6, 4)) +
+                  ", " + ", ".join(["P" + str(percentile) + " = " + str(round(value*1e6, 4)) for percentile, value in zip(percentiles, hew_percentiles)]))
+
+            plot_canvas = self.ensemble_plot_canvas[0]
+            plot_canvas.clear()
+
+            n_bins = self.get_plot_bins(plot_canvas)
+            for intensity, legend, color in [(intensity_percentiles[0], "P" + str(percentiles[0]), "lightblue"),
+                                             (intensity_percentiles[2], "P" + str(percentiles[2]), "lightblue"),
+                                             (intensity_percentiles[1], "Median", "green"),
+                                             (intensity_mean, "Mean", "blue")]:
+                x, y = decimate_min_max(positions*1e6, intensity, n_bins)
+                plot_canvas.addCurve(x, y, legend, color=color, replace=False)
+            plot_canvas.setGraphTitle("Intensity: mean, median and P" + str(percentiles[0]) + "-P" + str(percentiles[2]) + " band")
+            plot_canvas.setGraphXLabel("Y [$\mu$m]")
+            plot_canvas.setGraphYLabel("Intensity")
+            plot_canvas.resetZoom()
+
+            plot_canvas = self.ensemble_plot_canvas[1]
+            plot_canvas.clear()
+            plot_canvas.setDefaultPlotPoints(True)
+            plot_canvas.addCurve(ensemble_result.seeds, ensemble_result.hews*1e6, "HEW", symbol="o", color="blue", replace=True)
+            plot_canvas.setGraphTitle("HEW: mean " + str(round(hew_mean*1e6, 4)) + ", P" + str(percentiles[0]) + " " + str(round(hew_percentiles[0]*1e6, 4)) +
+                                      ", P" + str(percentiles[2]) + " " + str(round(hew_percentiles[2]*1e6, 4)) + " [$\mu$m]")
+            plot_canvas.setGraphXLabel("Seed")
+            plot_canvas.setGraphYLabel("HEW [$\mu$m]")
+
+            self.main_tabs.setCurrentIndex(3)
+            self.setStatusMessage("")
         except Exception as exception:
             QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
 
             self.setStatusMessage("Error!")
+
+        self.ensemble_terminated()
+
+    def ensemble_failed(self, exception):
+        QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+        self.setStatusMessage("Error!")
+
+        self.ensemble_terminated()
+
+    def ensemble_cancelled(self):
+        self.setStatusMessage("Figure Error Ensemble interrupted")
+
+        self.ensemble_terminated()
+
+    def ensemble_terminated(self):
+        self.ensemble_task = None
+        self.progressBarFinished()
+
+    def save_ensemble_results(self):
+        try:
+            file_name, _ = QFileDialog.getSaveFileName(self, "Save Figure Error Ensemble HEWs", ".", "Data Files (*.dat *.txt)")
+
+            if not file_name is None and not file_name.strip() == "":
+                self.ensemble_result.save(file_name)
+
+                QMessageBox.information(self, "Figure Error Ensemble", "HEWs saved on file " + file_name, QMessageBox.Ok)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
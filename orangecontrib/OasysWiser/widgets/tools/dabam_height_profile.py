@@ -1,16 +1,10 @@
 import sys
-import time
 import numpy
-import threading
 
-from PyQt5.QtCore import QRect, Qt
-from PyQt5.QtWidgets import QApplication, QMessageBox, QScrollArea, QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView, QWidget, QLabel, QSizePolicy
+from PyQt5.QtCore import QRect, Qt, QTimer
+from PyQt5.QtWidgets import QApplication, QMessageBox, QScrollArea, QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView, QWidget, QLabel, QSizePolicy, QPushButton
 from PyQt5.QtGui import QTextCursor,QFont, QPalette, QColor, QPainter, QBrush, QPen, QPixmap
 
-from matplotlib import cm
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
-from matplotlib.figure import Figure
-
 import orangecanvas.resources as resources
 
 from orangewidget import gui, widget
@@ -22,11 +16,12 @@ from oasys.widgets import congruence
 from oasys.widgets.gui import ConfirmDialog
 from oasys.util.oasys_util import EmittingStream
 
-from orangecontrib.wise2.util.wise_objects import WisePreInputData
-from orangecontrib.wise2.util.wise_util import WisePlot
+from orangecontrib.OasysWiser.util.wise_objects import WiserPreInputData
 
-from srxraylib.metrology import profiles_simulation, dabam
-from Shadow import ShadowTools as ST
+from orangecontrib.OasysWiser.util.wise_profile import slopes, rms, FIGURE_ERROR
+from orangecontrib.OasysWiser.util.wise_dabam import DabamStore, DabamProfile
+from orangecontrib.OasysWiser.util.wise_threading import WiserExecutor, redirect_stdout
+from orangecontrib.OasysWiser.util.wise_figure_error import FigureErrorProfile, save_figure_error, is_binary_figure_error_file, FILE_EXTENSION_FILTER
 
 class OWdabam_height_profile(OWWidget):
     name = "DABAM Height Profile"
@@ -40,7 +35,7 @@ class OWdabam_height_profile(OWWidget):
     keywords = ["dabam_height_profile"]
 
     outputs = [{"name": "PreInput",
-                "type": WisePreInputData,
+                "type": WiserPreInputData,
                 "doc": "PreInput",
                 "id": "PreInput"}]
 
@@ -59,6 +54,9 @@ class OWdabam_height_profile(OWWidget):
     xx = None
     yy = None
 
+    dabam_source = Setting(0)
+    dabam_store_directory = Setting("")
+
     entry_number = Setting(1)
 
     shape=Setting(0)
@@ -66,6 +64,11 @@ class OWdabam_height_profile(OWWidget):
     slope_error_to = Setting(1.5)
     dimension_y_from = Setting(0.0)
     dimension_y_to = Setting(200.0)
+    use_derived_quantities = Setting(0)
+    correlation_length_from = Setting(0.0)
+    correlation_length_to = Setting(100.0)
+    psd_beta_from = Setting(0.0)
+    psd_beta_to = Setting(4.0)
 
     use_undetrended = Setting(0)
 
@@ -80,10 +83,13 @@ class OWdabam_height_profile(OWWidget):
 
     dabam_profile_index = Setting(1)
 
+    write_heigth_profile_file = Setting(1)
     heigth_profile_file_name = Setting('mirror.dat')
 
     tab=[]
 
+    current_task = None
+
     def __init__(self):
         super().__init__()
 
@@ -105,9 +111,14 @@ class OWdabam_height_profile(OWWidget):
         self.setMaximumWidth(self.geometry().width())
 
         # DABAM INITIALIZATION
+        from srxraylib.metrology import dabam
+
         self.server = dabam.dabam()
         self.server.set_input_silent(True)
 
+        # searches, downloads and imports run out of the Qt event loop
+        self.executor = WiserExecutor(max_workers=2)
+
         gui.separator(self.controlArea)
 
         button_box = oasysgui.widgetBox(self.controlArea, "", addSpace=False, orientation="horizontal")
@@ -144,6 +155,18 @@ class OWdabam_height_profile(OWWidget):
         tab_gener = oasysgui.createTabPage(tabs_setting, "DABAM Generation Setting")
         tab_out = oasysgui.createTabPage(tabs_setting, "Output")
 
+        source_box = oasysgui.widgetBox(tab_input, "DABAM Database", addSpace=True, orientation="vertical")
+
+        gui.comboBox(source_box, self, "dabam_source", label="Profiles from", labelWidth=150,
+                     items=["DABAM Repository (remote)", "Local Store"], callback=self.set_DabamSource, sendSelectedValue=False, orientation="horizontal")
+
+        self.dabam_store_box = oasysgui.widgetBox(source_box, "", addSpace=False, orientation="horizontal")
+
+        self.le_dabam_store_directory = oasysgui.lineEdit(self.dabam_store_box, self, "dabam_store_directory", "Directory (empty: default)", labelWidth=140, valueType=str, orientation="horizontal")
+        gui.button(self.dabam_store_box, self, "...", callback=self.selectDabamStoreDirectory)
+        gui.button(self.dabam_store_box, self, "Import", callback=self.import_dabam_files)
+        gui.button(self.dabam_store_box, self, "Statistics", callback=self.precompute_dabam_statistics)
+
         manual_box = oasysgui.widgetBox(tab_input, "Manual Entry", addSpace=True, orientation="vertical")
 
         oasysgui.lineEdit(manual_box, self, "entry_number", "Entry Number",
@@ -177,12 +200,33 @@ class OWdabam_height_profile(OWWidget):
         self.le_dimension_y_to = oasysgui.lineEdit(input_box_2, self, "dimension_y_to", "To",
                            labelWidth=60, valueType=float, orientation="horizontal")
 
+        self.derived_quantities_box = oasysgui.widgetBox(input_box, "", addSpace=False, orientation="vertical")
+
+        gui.comboBox(self.derived_quantities_box, self, "use_derived_quantities", label="Filter on precomputed statistics", labelWidth=300,
+                     items=["No", "Yes"], callback=self.set_DabamSource, sendSelectedValue=False, orientation="horizontal")
+
+        self.derived_quantities_box_1 = oasysgui.widgetBox(self.derived_quantities_box, "", addSpace=False, orientation="horizontal")
+
+        self.le_correlation_length_from = oasysgui.lineEdit(self.derived_quantities_box_1, self, "correlation_length_from", "Correlation Length From",
+                           labelWidth=150, valueType=float, orientation="horizontal")
+        self.le_correlation_length_to = oasysgui.lineEdit(self.derived_quantities_box_1, self, "correlation_length_to", "To",
+                           labelWidth=60, valueType=float, orientation="horizontal")
+
+        self.derived_quantities_box_2 = oasysgui.widgetBox(self.derived_quantities_box, "", addSpace=False, orientation="horizontal")
+
+        oasysgui.lineEdit(self.derived_quantities_box_2, self, "psd_beta_from", "PSD Power Law " + u"\u03B2" + " From",
+                           labelWidth=150, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.derived_quantities_box_2, self, "psd_beta_to", "To",
+                           labelWidth=60, valueType=float, orientation="horizontal")
+
+        self.set_DabamSource()
+
         table_box = oasysgui.widgetBox(tab_input, "Search Results", addSpace=True, orientation="vertical", height=250)
 
-        self.overlay_search = Overlay(table_box, self.search_profiles)
+        self.overlay_search = Overlay(table_box, self.cancel_task)
         self.overlay_search.hide()
 
-        button = gui.button(input_box, self, "Search", callback=self.overlay_search.show)
+        button = gui.button(input_box, self, "Search", callback=self.search_profiles)
         button.setFixedHeight(35)
         button.setFixedWidth(self.CONTROL_AREA_WIDTH-35)
 
@@ -253,12 +297,17 @@ class OWdabam_height_profile(OWWidget):
 
         output_box = oasysgui.widgetBox(tab_gener, "Outputs", addSpace=True, orientation="vertical")
 
-        select_file_box = oasysgui.widgetBox(output_box, "", addSpace=True, orientation="horizontal")
+        gui.comboBox(output_box, self, "write_heigth_profile_file", label="Write Height Profile File", labelWidth=300,
+                     items=["No", "Yes"], callback=self.set_WriteHeigthProfileFile, sendSelectedValue=False, orientation="horizontal")
+
+        self.select_file_box = oasysgui.widgetBox(output_box, "", addSpace=True, orientation="horizontal")
 
-        self.le_heigth_profile_file_name = oasysgui.lineEdit(select_file_box, self, "heigth_profile_file_name", "Output File Name",
+        self.le_heigth_profile_file_name = oasysgui.lineEdit(self.select_file_box, self, "heigth_profile_file_name", "Output File Name",
                                                         labelWidth=120, valueType=str, orientation="horizontal")
 
-        gui.button(select_file_box, self, "...", callback=self.selectFile)
+        gui.button(self.select_file_box, self, "...", callback=self.selectFile)
+
+        self.set_WriteHeigthProfileFile()
 
         self.shadow_output = oasysgui.textArea(height=400)
 
@@ -290,6 +339,10 @@ class OWdabam_height_profile(OWWidget):
         label.setText(label.text() + " [" + self.workspace_units_label + "]")
         label = self.le_dimension_y_to.parent().layout().itemAt(0).widget()
         label.setText(label.text() + " [" + self.workspace_units_label + "]")
+        label = self.le_correlation_length_from.parent().layout().itemAt(0).widget()
+        label.setText(label.text() + " [" + self.workspace_units_label + "]")
+        label = self.le_correlation_length_to.parent().layout().itemAt(0).widget()
+        label.setText(label.text() + " [" + self.workspace_units_label + "]")
         label = self.le_new_length_1.parent().layout().itemAt(0).widget()
         label.setText(label.text() + " [" + self.workspace_units_label + "]")
         label = self.le_new_length_2.parent().layout().itemAt(0).widget()
@@ -378,11 +431,109 @@ class OWdabam_height_profile(OWWidget):
         self.plot_canvas[plot_canvas_index].setGraphYLabel(ytitle)
         self.plot_canvas[plot_canvas_index].replot()
 
+    def set_DabamSource(self):
+        self.dabam_store_box.setVisible(self.dabam_source == 1)
+        self.derived_quantities_box.setVisible(self.dabam_source == 1)
+        self.derived_quantities_box_1.setVisible(self.use_derived_quantities == 1)
+        self.derived_quantities_box_2.setVisible(self.use_derived_quantities == 1)
+
+    def selectDabamStoreDirectory(self):
+        self.le_dabam_store_directory.setText(oasysgui.selectDirectoryFromDialog(self, self.dabam_store_directory, "Select Directory"))
+
+    def get_dabam_store(self):
+        return DabamStore(self.dabam_store_directory)
+
+    def import_dabam_files(self):
+        try:
+            source_directory = oasysgui.selectDirectoryFromDialog(self, self.dabam_store_directory, "Select Directory with DABAM files")
+
+            if not source_directory is None and not source_directory.strip() == "":
+                redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
+
+                dabam_store = self.get_dabam_store()
+
+                self.run_task(dabam_store.import_directory, source_directory,
+                              on_finished=lambda n_entries: QMessageBox.information(self, "QMessageBox.information()",
+                                                                                    str(n_entries) + " DABAM entries imported in " + dabam_store.directory,
+                                                                                    QMessageBox.Ok))
+        except Exception as exception:
+            QMessageBox.critical(self, "Error",
+                                 str(exception),
+                                 QMessageBox.Ok)
+
+    def precompute_dabam_statistics(self):
+        redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
+
+        dabam_store = self.get_dabam_store()
+
+        self.run_task(dabam_store.precompute_statistics,
+                      on_finished=lambda n_entries: QMessageBox.information(self, "QMessageBox.information()",
+                                                                            "Statistics of " + str(n_entries) + " DABAM entries computed in " + dabam_store.directory,
+                                                                            QMessageBox.Ok))
+
+    ###############################################################
+    # BACKGROUND TASKS: one at a time, with the busy indicator over
+    # the search results and the progress in the progress bar
+
+    def run_task(self, function, *args, on_finished=None, **kwargs):
+        self.cancel_task()
+
+        self.overlay_search.show()
+        self.progressBarInit()
+
+        self.current_task = self.executor.submit(function, *args,
+                                                 on_finished=lambda result: self.task_finished(on_finished, result),
+                                                 on_failed=self.task_failed,
+                                                 on_cancelled=self.task_terminated,
+                                                 on_progress=self.task_progress,
+                                                 on_output=self.writeStdOut,
+                                                 **kwargs)
+
+    def cancel_task(self):
+        if not self.current_task is None:
+            self.current_task.cancel()
+            self.current_task.disconnect() # its result, if any, is discarded
+
+            self.task_terminated()
+
+    def task_progress(self, value, message):
+        self.progressBarSet(value)
+        self.setStatusMessage(message)
+
+    def task_finished(self, on_finished, result):
+        self.task_terminated()
+
+        try:
+            if not on_finished is None: on_finished(result)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+    def task_failed(self, exception):
+        self.task_terminated()
+
+        QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+    def task_terminated(self):
+        self.current_task = None
+
+        self.overlay_search.hide()
+        self.progressBarFinished()
+        self.setStatusMessage("")
+
+    def onDeleteWidget(self):
+        self.cancel_task()
+        self.executor.shutdown(wait=False)
+
+        super().onDeleteWidget()
+
     def set_ModifyY(self):
         self.modify_box_1.setVisible(self.modify_y == 0)
         self.modify_box_2.setVisible(self.modify_y == 1)
         self.modify_box_3.setVisible(self.modify_y == 2)
 
+    def set_WriteHeigthProfileFile(self):
+        self.select_file_box.setVisible(self.write_heigth_profile_file == 1)
+
     def set_RenormalizeY(self):
         self.output_profile_box_1.setVisible(self.renormalize_y==1)
 
@@ -400,7 +551,29 @@ class OWdabam_height_profile(OWWidget):
             if self.entry_number is None or self.entry_number <= 0:
                 raise Exception("Entry number should be a strictly positive integer number")
 
-            self.server.load(self.entry_number)
+            self.run_task(self.load_profile, self.entry_number, self.get_dabam_store() if self.dabam_source == 1 else None, on_finished=self.show_profile)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error",
+                                 exception.args[0],
+                                 QMessageBox.Ok)
+
+    @classmethod
+    def load_profile(cls, entry_number, dabam_store=None):
+        # background task: no access to the widget
+        if not dabam_store is None:
+            return dabam_store.load_profile(entry_number) # precomputed statistics
+        else:
+            from srxraylib.metrology import dabam
+
+            server = dabam.dabam()
+            server.set_input_silent(True)
+            server.load(entry_number)
+
+            return DabamProfile.from_dabam(server, entry_number)
+
+    def show_profile(self, dabam_profile):
+        try:
+            self.server = dabam_profile
             self.profileInfo.setText(self.server.info_profiles())
             title0 = "Heights Profile. St.Dev.=%.3f nm" % (self.server.stdev_profile_heights() * 1e9)
             title1 = "Slopes Profile. St.Dev.=%.3f $\mu$rad" % (self.server.stdev_profile_slopes() * 1e6)
@@ -429,9 +602,8 @@ class OWdabam_height_profile(OWWidget):
             self.plot_dabam_graph(2, "psd_heights_3", self.server.f[i0:i1], y[i0:i1], "f [m^-1]", "PSD [m^3]", color='red',
                                   replace=False)
             self.plot_dabam_graph(3, "csd", self.server.f, self.server.csd_heights(), "f [m^-1]", "CSD [m^3]")
-            c1, c2, c3 = dabam.autocorrelationfunction(self.server.y, self.server.zHeights)
-            self.plot_dabam_graph(4, "acf", c1[0:-1], c2, "Length [m]", "Heights Autocovariance",
-                                  title="Autocovariance Function of Heights Profile.\nAutocorrelation Length (ACF=0.5)=%.3f m" % (c3))
+            self.plot_dabam_graph(4, "acf", self.server.acf_lags, self.server.acf, "Length [m]", "Heights Autocovariance",
+                                  title="Autocovariance Function of Heights Profile.\nAutocorrelation Length (ACF=1/e)=%.3f m" % (self.server.correlation_length))
             # surface error removal
             if not self.yy is None and not self.xx is None:
                 self.xx = None
@@ -449,6 +621,30 @@ class OWdabam_height_profile(OWWidget):
 
 
     def search_profiles(self):
+        search_parameters = {"surface" : self.get_dabam_shape(),
+                             "slp_err_from" : self.slope_error_from*1e-6,
+                             "slp_err_to" : self.slope_error_to*1e-6,
+                             "length_from" : self.dimension_y_from / self.si_to_user_units,
+                             "length_to" : self.dimension_y_to / self.si_to_user_units}
+
+        if self.dabam_source == 1 and self.use_derived_quantities == 1:
+            search_parameters.update({"correlation_length_from" : self.correlation_length_from / self.si_to_user_units,
+                                      "correlation_length_to" : self.correlation_length_to / self.si_to_user_units,
+                                      "psd_beta_from" : self.psd_beta_from,
+                                      "psd_beta_to" : self.psd_beta_to})
+
+        self.run_task(self.find_profiles, self.get_dabam_store() if self.dabam_source == 1 else None, search_parameters, on_finished=self.show_profiles)
+
+    @classmethod
+    def find_profiles(cls, dabam_store, search_parameters):
+        # background task: no access to the widget
+        if not dabam_store is None: return dabam_store.search(**search_parameters)
+        else:
+            from srxraylib.metrology import dabam
+
+            return dabam.dabam_summary_dictionary(**search_parameters)
+
+    def show_profiles(self, profiles):
         try:
             self.table.itemClicked.disconnect(self.table_item_clicked)
             self.table.clear()
@@ -459,12 +655,6 @@ class OWdabam_height_profile(OWWidget):
 
             self.table.setHorizontalHeaderLabels(self.horHeaders)
 
-            profiles = dabam.dabam_summary_dictionary(surface=self.get_dabam_shape(),
-                                                      slp_err_from=self.slope_error_from*1e-6,
-                                                      slp_err_to=self.slope_error_to*1e-6,
-                                                      length_from=self.dimension_y_from / self.si_to_user_units,
-                                                      length_to=self.dimension_y_to / self.si_to_user_units)
-
             for index in range(0, len(profiles)):
                 self.table.insertRow(0)
 
@@ -490,12 +680,7 @@ class OWdabam_height_profile(OWWidget):
             self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
 
             self.table.itemClicked.connect(self.table_item_clicked)
-
-            self.overlay_search.hide()
-
         except Exception as exception:
-            self.overlay_search.hide()
-
             QMessageBox.critical(self, "Error",
                                  exception.args[0],
                                  QMessageBox.Ok)
@@ -518,7 +703,7 @@ class OWdabam_height_profile(OWWidget):
         try:
             if self.server.y is None: raise Exception("No Profile Selected")
 
-            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
 
             self.check_fields()
 
@@ -592,7 +777,7 @@ class OWdabam_height_profile(OWWidget):
             if self.renormalize_y == 0:
                 rms_y = None
             else:
-                if self.error_type_y == profiles_simulation.FIGURE_ERROR:
+                if self.error_type_y == FIGURE_ERROR:
                     rms_y = self.si_to_user_units * self.rms_y * 1e-9   # from nm to user units
 
                     profile_1D_y_y = profile_1D_y_y / profile_1D_y_y.std() * rms_y
@@ -609,15 +794,8 @@ class OWdabam_height_profile(OWWidget):
             x_to_plot = self.xx
             y_to_plot = self.yy * 1e9 / self.si_to_user_units
 
-            ny = len(self.yy)
-            slope = numpy.zeros(ny)
-            for i in range(ny-1):
-                step = self.xx[i+1] - self.xx[i]
-                slope[i] = numpy.arctan( (self.yy[i+1] - self.yy[i] ) / step )
-            slope[ny-1] = slope[ny-2]
-
-            title = ' Slope error rms  : %f $\mu$rad' % (slope.std() * 1e6) + '\n' + \
-                    ' Figure error rms : %f nm' % (round(self.yy.std()* 1e9 / self.si_to_user_units, 6))
+            title = ' Slope error rms  : %f $\mu$rad' % (rms(slopes(self.xx, self.yy)) * 1e6) + '\n' + \
+                    ' Figure error rms : %f nm' % (round(rms(self.yy)* 1e9 / self.si_to_user_units, 6))
 
             self.plot_dabam_graph(5, "heights_profile_generated", x_to_plot, y_to_plot, "Y [" + self.workspace_units_label + "]", "Z [nm]", title=title)
 
@@ -638,18 +816,37 @@ class OWdabam_height_profile(OWWidget):
     def generate_heigth_profile_file(self, not_interactive_mode=False):
         if not self.yy is None and not self.xx is None:
             try:
-                congruence.checkDir(self.heigth_profile_file_name)
-
-                sys.stdout = EmittingStream(textWritten=self.writeStdOut)
-                numpy.savetxt(self.heigth_profile_file_name, self.yy)
+                redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
+
+                # the mirrors use the heights in memory (user units, not copied): the file is an export
+                figure_error_profile = FigureErrorProfile(self.yy,
+                                                          step=numpy.abs(self.xx[1]-self.xx[0]) / self.si_to_user_units,
+                                                          amplitude_scaling=1/self.si_to_user_units,
+                                                          provenance={"creator" : self.name,
+                                                                      "dabam_entry" : self.entry_number,
+                                                                      "undetrended" : self.use_undetrended == 1,
+                                                                      "modify_length" : self.modify_y,
+                                                                      "renormalized_rms" : None if self.renormalize_y == 0 else self.rms_y})
+
+                if self.write_heigth_profile_file == 1:
+                    congruence.checkDir(self.heigth_profile_file_name)
+
+                    if is_binary_figure_error_file(self.heigth_profile_file_name):
+                        save_figure_error(self.heigth_profile_file_name,
+                                          self.yy / self.si_to_user_units,
+                                          figure_error_profile.step,
+                                          provenance=figure_error_profile.provenance)
+                    else:
+                        numpy.savetxt(self.heigth_profile_file_name, self.yy)
 
-                QMessageBox.information(self, "QMessageBox.information()",
-                                            "Height Profile file " + self.heigth_profile_file_name + " written on disk",
-                                            QMessageBox.Ok)
+                    QMessageBox.information(self, "QMessageBox.information()",
+                                                "Height Profile file " + self.heigth_profile_file_name + " written on disk",
+                                                QMessageBox.Ok)
 
-                self.send("PreInput", WisePreInputData(figure_error_file=self.heigth_profile_file_name,
-                                                       figure_error_step=numpy.abs(self.xx[1]-self.xx[0]),
-                                                       figure_user_units_to_m=self.workspace_units_to_m))
+                self.send("PreInput", WiserPreInputData(figure_error_file=self.heigth_profile_file_name if self.write_heigth_profile_file == 1 else WiserPreInputData.NONE,
+                                                        figure_error_step=numpy.abs(self.xx[1]-self.xx[0]),
+                                                        figure_user_units_to_m=self.workspace_units_to_m,
+                                                        figure_error_profile=figure_error_profile))
             except Exception as exception:
                 QMessageBox.critical(self, "Error",
                                      exception.args[0],
@@ -669,7 +866,7 @@ class OWdabam_height_profile(OWWidget):
         if self.renormalize_y == 1:
             self.rms_y = congruence.checkPositiveNumber(self.rms_y, "Rms Y")
 
-        congruence.checkDir(self.heigth_profile_file_name)
+        if self.write_heigth_profile_file == 1: congruence.checkDir(self.heigth_profile_file_name)
 
     def writeStdOut(self, text):
         cursor = self.shadow_output.textCursor()
@@ -679,20 +876,33 @@ class OWdabam_height_profile(OWWidget):
         self.shadow_output.ensureCursorVisible()
 
     def selectFile(self):
-        self.le_heigth_profile_file_name.setText(oasysgui.selectFileFromDialog(self, self.heigth_profile_file_name, "Select Output File", file_extension_filter="Data Files (*.dat)"))
+        self.le_heigth_profile_file_name.setText(oasysgui.selectFileFromDialog(self, self.heigth_profile_file_name, "Select Output File", file_extension_filter=FILE_EXTENSION_FILTER))
 
 
 class Overlay(QWidget):
+    '''
+    Busy indicator: the animation is driven by a timer at a fixed frame rate, the work is done by background tasks
+    '''
+    FRAME_INTERVAL = 100 # ms
 
-    def __init__(self, container_widget=None, target_method=None):
+    def __init__(self, container_widget=None, cancel_method=None):
 
         QWidget.__init__(self, container_widget)
         self.container_widget = container_widget
-        self.target_method = target_method
         palette = QPalette(self.palette())
         palette.setColor(palette.Background, Qt.transparent)
         self.setPalette(palette)
 
+        self.position_index = 0
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(self.FRAME_INTERVAL)
+        self.timer.timeout.connect(self.next_frame)
+
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.setFixedWidth(80)
+        if not cancel_method is None: self.cancel_button.clicked.connect(cancel_method)
+
     def paintEvent(self, event):
         painter = QPainter()
         painter.begin(self)
@@ -706,28 +916,24 @@ class Overlay(QWidget):
             else:
                 painter.setBrush(QBrush(QColor(127, 127, 127)))
             painter.drawEllipse(
-                self.width()/2 + 30 * numpy.cos(2 * numpy.pi * i / 6.0) - 10,
-                self.height()/2 + 30 * numpy.sin(2 * numpy.pi * i / 6.0) - 10,
+                round(self.width()/2 + 30 * numpy.cos(2 * numpy.pi * i / 6.0) - 10),
+                round(self.height()/2 + 30 * numpy.sin(2 * numpy.pi * i / 6.0) - 10),
                 20, 20)
 
-            time.sleep(0.005)
-
         painter.end()
 
+    def resizeEvent(self, event):
+        self.cancel_button.move(round((self.width() - self.cancel_button.width())/2), round(self.height()/2 + 50))
+
     def showEvent(self, event):
-        self.timer = self.startTimer(0)
-        self.counter = 0
         self.position_index = 0
-        t = threading.Thread(target=self.target_method)
-        t.start()
+        self.timer.start()
 
     def hideEvent(self, QHideEvent):
-        self.killTimer(self.timer)
+        self.timer.stop()
 
-    def timerEvent(self, event):
-        self.counter += 1
-        self.position_index += 1
-        if self.position_index == 7: self.position_index = 1
+    def next_frame(self):
+        self.position_index = self.position_index % 6 + 1
         self.update()
 
 if __name__ == "__main__":
@@ -5,7 +5,6 @@ from PyQt5.QtCore import QRect
 from PyQt5.QtGui import QTextCursor, QFont, QPalette, QColor
 from PyQt5.QtWidgets import QTextEdit, QApplication, QMessageBox
 
-from srxraylib.metrology import profiles_simulation
 from oasys.widgets.widget import OWWidget
 from orangewidget import gui, widget
 from orangewidget.settings import Setting
@@ -15,8 +14,12 @@ from oasys.widgets import congruence
 from oasys.widgets.gui import ConfirmDialog
 from oasys.util.oasys_util import EmittingStream
 
-from orangecontrib.wise2.util.wise_objects import WisePreInputData
-from orangecontrib.wise2.util.wise_util import WisePlot
+from orangecontrib.OasysWiser.util.wise_objects import WiserPreInputData
+from orangecontrib.OasysWiser.util.wise_util import WiserPlot
+from orangecontrib.OasysWiser.util.wise_ensemble import ProfileEnsemble
+from orangecontrib.OasysWiser.util.wise_profile import slopes, rms, FIGURE_ERROR
+from orangecontrib.OasysWiser.util.wise_figure_error import FigureErrorProfile, save_figure_error, is_binary_figure_error_file, FILE_EXTENSION_FILTER
+from orangecontrib.OasysWiser.util.wise_threading import redirect_stdout
 
 class OWheight_profile_simulator(OWWidget):
     name = "Height Profile Simulator"
@@ -30,7 +33,7 @@ class OWheight_profile_simulator(OWWidget):
     keywords = ["height_profile_simulator"]
 
     outputs = [{"name": "PreInput",
-                "type": WisePreInputData,
+                "type": WiserPreInputData,
                 "doc": "PreInput",
                 "id": "PreInput"}]
 
@@ -56,8 +59,10 @@ class OWheight_profile_simulator(OWWidget):
     correlation_length_y = Setting(30.0)
     rms_y = Setting(1)
     montecarlo_seed_y = Setting(8788)
-    error_type_y = Setting(profiles_simulation.FIGURE_ERROR)
+    error_type_y = Setting(FIGURE_ERROR)
+    ensemble_members = Setting(1)
 
+    write_heigth_profile_file = Setting(1)
     heigth_profile_file_name = Setting('figure_error.dat')
 
     def __init__(self):
@@ -126,7 +131,7 @@ class OWheight_profile_simulator(OWWidget):
 
         gui.separator(input_box_l)
 
-        self.kind_of_profile_y_box_1 = oasysgui.widgetBox(input_box_l, "", addSpace=False, orientation="vertical", height=230)
+        self.kind_of_profile_y_box_1 = oasysgui.widgetBox(input_box_l, "", addSpace=False, orientation="vertical", height=260)
 
         self.le_dimension_y = oasysgui.lineEdit(self.kind_of_profile_y_box_1, self, "dimension_y", "Dimensions",
                            labelWidth=260, valueType=float, orientation="horizontal")
@@ -134,6 +139,8 @@ class OWheight_profile_simulator(OWWidget):
                            labelWidth=260, valueType=float, orientation="horizontal")
         oasysgui.lineEdit(self.kind_of_profile_y_box_1, self, "montecarlo_seed_y", "Monte Carlo initial seed", labelWidth=260,
                            valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(self.kind_of_profile_y_box_1, self, "ensemble_members", "Monte Carlo ensemble members", labelWidth=260,
+                           valueType=int, orientation="horizontal")
 
         self.kind_of_profile_y_box_1_1 = oasysgui.widgetBox(self.kind_of_profile_y_box_1, "", addSpace=False, orientation="vertical")
 
@@ -159,6 +166,9 @@ class OWheight_profile_simulator(OWWidget):
 
         self.output_box = oasysgui.widgetBox(tab_input, "Outputs", addSpace=True, orientation="vertical")
 
+        gui.comboBox(self.output_box, self, "write_heigth_profile_file", label="Write Height Profile File", labelWidth=260,
+                     items=["No", "Yes"], callback=self.set_WriteHeigthProfileFile, sendSelectedValue=False, orientation="horizontal")
+
         self.select_file_box = oasysgui.widgetBox(self.output_box, "", addSpace=False, orientation="horizontal")
 
         self.le_heigth_profile_file_name = oasysgui.lineEdit(self.select_file_box, self, "heigth_profile_file_name", "Output File Name",
@@ -166,6 +176,8 @@ class OWheight_profile_simulator(OWWidget):
 
         gui.button(self.select_file_box, self, "...", callback=self.selectFile)
 
+        self.set_WriteHeigthProfileFile()
+
         self.wise_output = QTextEdit()
         self.wise_output.setReadOnly(True)
         self.wise_output.setStyleSheet("background-color: white;")
@@ -196,17 +208,21 @@ class OWheight_profile_simulator(OWWidget):
         self.kind_of_profile_y_box_1_1.setVisible(self.kind_of_profile_y==0)
         self.kind_of_profile_y_box_1_2.setVisible(self.kind_of_profile_y==1)
 
+    def set_WriteHeigthProfileFile(self):
+        self.select_file_box.setVisible(self.write_heigth_profile_file == 1)
+
     def calculate_heigth_profile(self, not_interactive_mode=False):
         try:
-            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
 
             self.check_fields()
 
-            if self.error_type_y == profiles_simulation.FIGURE_ERROR:
+            if self.error_type_y == FIGURE_ERROR:
                 rms_y = self.rms_y * 1e-9 # from nm to m
             else:
                 rms_y = self.rms_y * 1e-6 # from urad to rad
 
+            from srxraylib.metrology import profiles_simulation
 
             xx, yy = profiles_simulation.simulate_profile_1D(step = self.step_y * self.workspace_units_to_m,
                                                              mirror_length = self.dimension_y * self.workspace_units_to_m,
@@ -221,14 +237,7 @@ class OWheight_profile_simulator(OWWidget):
             yy_to_plot = yy * 1e9 # nm
             self.yy = yy/self.workspace_units_to_m # to user units
 
-            ny = yy.size
-
-            slope = numpy.zeros(ny)
-            for i in range(ny-1):
-                step = xx[i+1] - xx[i]
-                slope[i] = numpy.arctan((yy[i+1] - yy[i]) / step)
-            slope[ny-1] = slope[ny-2]
-            sloperms = slope.std()
+            sloperms = rms(slopes(xx, yy))
 
             title = ' Slope error rms in Z direction: %f $\mu$rad' % (sloperms*1e6)
 
@@ -239,7 +248,7 @@ class OWheight_profile_simulator(OWWidget):
 
                 self.plot_tab.layout().addWidget(self.plot_canvas)
 
-            WisePlot.plot_histo(self.plot_canvas, xx_to_plot, yy_to_plot, title, "X [" + self.workspace_units_label + "]", "Z [nm]")
+            WiserPlot.plot_histo(self.plot_canvas, xx_to_plot, yy_to_plot, title, "X [" + self.workspace_units_label + "]", "Z [nm]")
 
             QMessageBox.information(self, "QMessageBox.information()",
                                     "Height Profile calculated: if the result is satisfactory,\nclick \'Generate Height Profile File\' to complete the operation ",
@@ -253,25 +262,57 @@ class OWheight_profile_simulator(OWWidget):
     def generate_heigth_profile_file(self, not_interactive_mode=False):
         if not self.yy is None:
             try:
-                congruence.checkDir(self.heigth_profile_file_name)
-
-                sys.stdout = EmittingStream(textWritten=self.writeStdOut)
-
-                numpy.savetxt(self.heigth_profile_file_name, self.yy)
-
-                QMessageBox.information(self, "QMessageBox.information()",
-                                            "Height Profile file " + self.heigth_profile_file_name + " written on disk",
-                                            QMessageBox.Ok)
-
-
-                self.send("PreInput", WisePreInputData(figure_error_file=self.heigth_profile_file_name,
-                                                       figure_error_step=self.step_y,
-                                                       figure_user_units_to_m=self.workspace_units_to_m))
+                redirect_stdout(EmittingStream(textWritten=self.writeStdOut))
+
+                # the mirrors use the heights in memory (user units, not copied): the file is an export
+                figure_error_profile = FigureErrorProfile(self.yy,
+                                                          step=self.step_y * self.workspace_units_to_m,
+                                                          amplitude_scaling=self.workspace_units_to_m,
+                                                          provenance={"creator" : self.name,
+                                                                      "profile" : ["Fractal", "Gaussian"][self.kind_of_profile_y],
+                                                                      "seed" : self.montecarlo_seed_y,
+                                                                      "rms" : self.rms_y,
+                                                                      "rms_units" : "nm" if self.error_type_y == FIGURE_ERROR else "urad",
+                                                                      "power_law_exponent_beta" : self.power_law_exponent_beta_y,
+                                                                      "correlation_length" : self.correlation_length_y * self.workspace_units_to_m})
+
+                if self.write_heigth_profile_file == 1:
+                    congruence.checkDir(self.heigth_profile_file_name)
+
+                    if is_binary_figure_error_file(self.heigth_profile_file_name):
+                        save_figure_error(self.heigth_profile_file_name,
+                                          self.yy * self.workspace_units_to_m,
+                                          figure_error_profile.step,
+                                          provenance=figure_error_profile.provenance)
+                    else:
+                        numpy.savetxt(self.heigth_profile_file_name, self.yy)
+
+                    QMessageBox.information(self, "QMessageBox.information()",
+                                                "Height Profile file " + self.heigth_profile_file_name + " written on disk",
+                                                QMessageBox.Ok)
+
+                self.send("PreInput", WiserPreInputData(figure_error_file=self.heigth_profile_file_name if self.write_heigth_profile_file == 1 else WiserPreInputData.NONE,
+                                                        figure_error_step=self.step_y,
+                                                        figure_user_units_to_m=self.workspace_units_to_m,
+                                                        figure_error_ensemble=self.get_profile_ensemble() if self.ensemble_members > 1 else None,
+                                                        figure_error_profile=figure_error_profile))
             except Exception as exception:
                 QMessageBox.critical(self, "Error",
                                      exception.args[0],
                                      QMessageBox.Ok)
 
+    def get_profile_ensemble(self):
+        # the members are propagated by the Detector widget (Figure Error Ensemble), the nominal profile is the first one
+        return ProfileEnsemble(n_members=self.ensemble_members,
+                               seed=self.montecarlo_seed_y,
+                               step=self.step_y * self.workspace_units_to_m,
+                               mirror_length=self.dimension_y * self.workspace_units_to_m,
+                               error_type=self.error_type_y,
+                               profile_type=1-self.kind_of_profile_y,
+                               rms=self.rms_y * (1e-9 if self.error_type_y == FIGURE_ERROR else 1e-6),
+                               correlation_length=self.correlation_length_y * self.workspace_units_to_m,
+                               power_law_exponent_beta=self.power_law_exponent_beta_y)
+
     def call_reset_settings(self):
         if ConfirmDialog.confirmed(parent=self, message="Confirm Reset of the Fields?"):
             try:
@@ -286,8 +327,9 @@ class OWheight_profile_simulator(OWWidget):
         if self.kind_of_profile_y == 1: self.correlation_length_y = congruence.checkStrictlyPositiveNumber(self.correlation_length_y, "Correlation Length")
         self.rms_y = congruence.checkPositiveNumber(self.rms_y, "Rms")
         self.montecarlo_seed_y = congruence.checkPositiveNumber(self.montecarlo_seed_y, "Monte Carlo initial seed")
+        self.ensemble_members = congruence.checkStrictlyPositiveNumber(self.ensemble_members, "Monte Carlo ensemble members")
 
-        congruence.checkDir(self.heigth_profile_file_name)
+        if self.write_heigth_profile_file == 1: congruence.checkDir(self.heigth_profile_file_name)
 
     def writeStdOut(self, text):
         cursor = self.wise_output.textCursor()
@@ -297,7 +339,7 @@ class OWheight_profile_simulator(OWWidget):
         self.wise_output.ensureCursorVisible()
 
     def selectFile(self):
-        self.le_heigth_profile_file_name.setText(oasysgui.selectFileFromDialog(self, self.heigth_profile_file_name, "Select Output File", file_extension_filter="Data Files (*.dat *.txt)"))
+        self.le_heigth_profile_file_name.setText(oasysgui.selectFileFromDialog(self, self.heigth_profile_file_name, "Select Output File", file_extension_filter=FILE_EXTENSION_FILTER))
 
 
 if __name__ == "__main__":
@@ -41,6 +41,7 @@ SETUP_REQUIRES = (
 )
 
 INSTALL_REQUIRES = (
+    'h5py',
     'LibWiser',
     'oasys1>=1.1.19',
     'WofryWiser'
@@ -63,7 +64,9 @@ ENTRY_POINTS = {
         "WISEr Optical Elements = orangecontrib.OasysWiser.widgets.optical_elements",
         "WISEr Tools = orangecontrib.OasysWiser.widgets.tools",
     ),
-    'oasys.menus' : ("wisemenu = orangecontrib.OasysWiser.menu",)
+    'oasys.menus' : ("wisemenu = orangecontrib.OasysWiser.menu",),
+    'console_scripts' : ("wiser-batch = orangecontrib.OasysWiser.util.wise_batch:main",
+                        "wiser-dabam-import = orangecontrib.OasysWiser.util.wise_dabam:main"),
 }
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+import numpy
+import pytest
+
+pytest.importorskip("LibWiser")
+pytest.importorskip("WofryWiser")
+
+from LibWiser.Foundation import PositioningDirectives
+
+from wofry.propagator.propagator import PropagationParameters
+from WofryWiser.propagator.wavefront1D.wise_wavefront import WiseWavefront
+
+from orangecontrib.OasysWiser.util.wise_batch import BatchElement, build_beamline, propagate
+from orangecontrib.OasysWiser.util.wise_propagation import WiserIncrementalPropagator, WiserCheckpointStore
+
+def get_beamline(detector_distance):
+    # automatic sampling on the mirror: its number of samples depends on the position of the detector
+    return [BatchElement("OWGaussianSource1d", {"source_lambda" : 10,
+                                                "source_waist" : 125e-6,
+                                                "XYCentre_checked" : 1}),
+            BatchElement("OWEllipticMirror", {"oe_name" : "Elliptic Mirror",
+                                              "f1" : 98.0,
+                                              "f2" : 1.2,
+                                              "alpha" : 2.5,
+                                              "length" : 0.4,
+                                              "calculation_type" : 0,
+                                              "ReferTo" : PositioningDirectives.ReferTo.Source,
+                                              "What" : PositioningDirectives.What.UpstreamFocus,
+                                              "Where" : PositioningDirectives.Where.Centre}),
+            BatchElement("OWDetector", {"oe_name" : "Detector",
+                                        "alpha" : 90.0,
+                                        "length" : 50e-6,
+                                        "calculation_type" : 1,
+                                        "number_of_points" : 2000,
+                                        "ReferTo" : PositioningDirectives.ReferTo.UpstreamElement,
+                                        "What" : PositioningDirectives.What.Centre,
+                                        "Where" : PositioningDirectives.Where.DownstreamFocus,
+                                        "Distance_checked" : 1,
+                                        "Distance" : detector_distance})]
+
+def propagate_incrementally(wiser_data):
+    parameters = PropagationParameters(wavefront=WiseWavefront(wise_computation_results=None),
+                                       propagation_elements=wiser_data.wise_beamline)
+    parameters.set_additional_parameters("NPools", 1)
+    parameters.set_additional_parameters("element_keys", wiser_data.element_keys)
+
+    return WiserIncrementalPropagator().do_incremental_propagation(parameters)
+
+def test_last_element_moved():
+    WiserCheckpointStore.Instance().clear()
+
+    propagate_incrementally(build_beamline(get_beamline(0.0))) # checkpoints of the first beamline
+
+    incremental_data = build_beamline(get_beamline(0.05)) # same element keys, but the detector
+    incremental_wavefront = propagate_incrementally(incremental_data)
+
+    reference_data = propagate(build_beamline(get_beamline(0.05)))
+
+    incremental_mirror = incremental_data.wise_beamline.get_wise_propagation_element(1).ComputationData
+    reference_mirror = reference_data.wise_beamline.get_wise_propagation_element(1).ComputationData
+
+    assert incremental_mirror.NSamples == reference_mirror.NSamples
+    assert numpy.allclose(incremental_mirror.Field, reference_mirror.Field)
+    assert numpy.allclose(incremental_wavefront.wise_computation_result.Field, reference_data.wise_wavefront.wise_computation_result.Field)
@@ -0,0 +1,119 @@
+import os
+import json
+
+import pytest
+
+from orangecontrib.OasysWiser.util import wise_positioning
+from orangecontrib.OasysWiser.util.wise_cache import fingerprint
+from orangecontrib.OasysWiser.util.wise_batch import BatchElement, OPTICAL_ELEMENT_DEFAULTS, load_json_beamline, load_beamline_description, set_setting, main
+
+# source -> elliptic mirror -> detector at the focus, SI units
+BEAMLINE = [{"widget" : "OWGaussianSource1d",
+             "settings" : {"source_lambda" : 10, "source_waist" : 125e-6, "XYCentre_checked" : 1}},
+            {"widget" : "OWEllipticMirror",
+             "title" : "KB",
+             "settings" : {"oe_name" : "Elliptic Mirror", "f1" : 98.0, "f2" : 1.2, "alpha" : 2.5, "length" : 0.4,
+                           "calculation_type" : 1, "number_of_points" : 500,
+                           "ReferTo" : wise_positioning.ReferTo.Source,
+                           "What" : wise_positioning.What.UpstreamFocus,
+                           "Where" : wise_positioning.Where.Centre}},
+            {"widget" : "OWDetector",
+             "settings" : {"oe_name" : "Detector", "alpha" : 90.0, "length" : 50e-6,
+                           "calculation_type" : 1, "number_of_points" : 500,
+                           "ReferTo" : wise_positioning.ReferTo.UpstreamElement,
+                           "What" : wise_positioning.What.Centre,
+                           "Where" : wise_positioning.Where.DownstreamFocus,
+                           "Distance_checked" : 1, "Distance" : 0.0}}]
+
+@pytest.fixture
+def beamline_file(tmp_path):
+    file_name = str(tmp_path / "beamline.json")
+
+    with open(file_name, "w") as file: json.dump({"elements" : BEAMLINE, "workspace_units_to_m" : 1.0}, file)
+
+    return file_name
+
+def test_load_json_beamline(beamline_file):
+    batch_elements, workspace_units_to_m = load_beamline_description(beamline_file)
+
+    assert workspace_units_to_m == 1.0
+    assert [batch_element.widget for batch_element in batch_elements] == ["OWGaussianSource1d", "OWEllipticMirror", "OWDetector"]
+    assert [batch_element.title for batch_element in batch_elements] == ["OWGaussianSource1d", "KB", "OWDetector"]
+    assert [batch_element.get_name() for batch_element in batch_elements] == ["Gaussian Source", "Elliptic Mirror", "Detector"]
+
+    detector = batch_elements[2]
+    assert detector.settings["number_of_points"] == 500
+    assert detector.settings["use_figure_error"] == OPTICAL_ELEMENT_DEFAULTS["use_figure_error"] # defaults of the widget
+
+def test_load_json_element_list(tmp_path):
+    file_name = str(tmp_path / "elements.json")
+
+    with open(file_name, "w") as file: json.dump(BEAMLINE, file)
+
+    batch_elements, workspace_units_to_m = load_json_beamline(file_name)
+
+    assert len(batch_elements) == 3 and workspace_units_to_m == 1.0
+
+def test_default_settings_are_not_shared():
+    first, second = BatchElement("OWDetector"), BatchElement("OWDetector")
+    first.settings["length"] = 1.0
+
+    assert second.settings["length"] == OPTICAL_ELEMENT_DEFAULTS["length"]
+
+    with pytest.raises(ValueError): BatchElement("OWUnknownWidget")
+
+def test_set_setting(beamline_file):
+    batch_elements, _ = load_json_beamline(beamline_file)
+
+    set_setting(batch_elements, "KB.f2=1.21")                  # title
+    set_setting(batch_elements, "Detector.number_of_points=1000") # name
+    set_setting(batch_elements, "0.source_lambda=2.5")         # index
+    set_setting(batch_elements, "KB.oe_name=Vertical Mirror") # not a literal: string
+
+    assert batch_elements[1].settings["f2"] == 1.21
+    assert batch_elements[2].settings["number_of_points"] == 1000
+    assert batch_elements[0].settings["source_lambda"] == 2.5
+    assert batch_elements[1].settings["oe_name"] == "Vertical Mirror"
+
+    with pytest.raises(ValueError): set_setting(batch_elements, "KB.unknown=1")
+    with pytest.raises(ValueError): set_setting(batch_elements, "Unknown Mirror.f2=1")
+
+def test_command_line_help(capsys):
+    with pytest.raises(SystemExit) as exit_info: main(["--help"])
+
+    assert exit_info.value.code == 0
+    assert "--n-pools" in capsys.readouterr().out
+
+def test_build_beamline_chains_the_element_keys(beamline_file):
+    pytest.importorskip("WofryWiser")
+
+    from orangecontrib.OasysWiser.util.wise_batch import build_beamline
+
+    batch_elements, workspace_units_to_m = load_json_beamline(beamline_file)
+    wiser_data = build_beamline(batch_elements, workspace_units_to_m)
+
+    assert wiser_data.get_elements_number() == 3
+
+    upstream_key = None
+    for batch_element, element_key in zip(batch_elements, wiser_data.element_keys):
+        assert element_key == fingerprint(upstream_key, batch_element.widget, sorted(batch_element.settings.items()), workspace_units_to_m)
+        upstream_key = element_key
+
+    set_setting(batch_elements, "KB.f2=1.21")
+    changed_keys = build_beamline(batch_elements, workspace_units_to_m).element_keys
+
+    assert changed_keys[0] == wiser_data.element_keys[0]
+    assert changed_keys[1] != wiser_data.element_keys[1] and changed_keys[2] != wiser_data.element_keys[2]
+
+def test_command_line_propagation(beamline_file, tmp_path):
+    pytest.importorskip("WofryWiser")
+    h5py = pytest.importorskip("h5py")
+
+    output = str(tmp_path / "result.h5")
+
+    assert main([beamline_file, "-o", output, "--set", "Detector.number_of_points=400"]) == 0
+    assert os.path.exists(output)
+
+    with h5py.File(output, "r") as file:
+        assert [file["elements"][group].attrs["name"] for group in sorted(file["elements"].keys())] == ["Gaussian Source", "Elliptic Mirror", "Detector"]
+        assert file["elements/002/Field"].shape[0] == file["elements/002"].attrs["n_samples"]
@@ -0,0 +1,203 @@
+import os
+import sys
+import pickle
+import subprocess
+
+import numpy
+
+from orangecontrib.OasysWiser.util.wise_cache import fingerprint, WiserLRUCache, WiserResultCache, WiserDiskCache, MB_TO_BYTES
+
+class Node(object):
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+        self.children = []
+        self.parent = None
+
+    def add(self, child):
+        self.children.append(child)
+        child.parent = self
+
+        return child
+
+def get_cyclic_tree(value=1.0):
+    root = Node("root", numpy.arange(5.0))
+    root.add(Node("child", value)).add(Node("grandchild", {"a" : (1, 2), "b" : {3, 4}}))
+
+    return root
+
+FINGERPRINT_SCRIPT = """
+import numpy
+from orangecontrib.OasysWiser.util.wise_cache import fingerprint
+print(fingerprint({"b" : {"x", "y", "z"}, "a" : [1, 2.5, "s", None]}, numpy.linspace(0, 1, 11), ("key", 3)))
+"""
+
+def test_fingerprint_is_stable_across_runs():
+    expected = fingerprint({"b" : {"x", "y", "z"}, "a" : [1, 2.5, "s", None]}, numpy.linspace(0, 1, 11), ("key", 3))
+
+    for hash_seed in ["0", "1", "12345"]: # str hashes, and then the order of the sets, change with the seed
+        environment = dict(os.environ, PYTHONHASHSEED=hash_seed)
+        output = subprocess.run([sys.executable, "-c", FINGERPRINT_SCRIPT], env=environment, capture_output=True, text=True, check=True,
+                                cwd=os.path.join(os.path.dirname(__file__), ".."))
+
+        assert output.stdout.strip() == expected
+
+def test_volatile_attributes_are_ignored():
+    first = Node("element", 1.0)
+    first.ComputationTime = 1.2
+    first._TotalComputationTimeMinutes = 0.1
+
+    second = Node("element", 1.0)
+    second.ComputationTime = 3.4
+    second._TotalComputationTimeMinutes = 0.7
+
+    assert fingerprint(first) == fingerprint(second)
+
+    second.value = 2.0
+
+    assert fingerprint(first) != fingerprint(second)
+
+def test_cyclic_objects():
+    assert fingerprint(get_cyclic_tree()) == fingerprint(get_cyclic_tree())
+    assert fingerprint(get_cyclic_tree(1.0)) != fingerprint(get_cyclic_tree(2.0))
+
+    broken = get_cyclic_tree()
+    broken.children[0].parent = None # same content, no cycle
+
+    assert fingerprint(broken) != fingerprint(get_cyclic_tree())
+
+def test_element_key_changes_with_setting_and_upstream_key():
+    settings = {"oe_name" : "Elliptic Mirror", "f1" : 98.0, "f2" : 1.2, "alpha" : 2.5}
+
+    def get_element_key(upstream_key, settings):
+        # as chained by wise_batch.build_beamline
+        return fingerprint(upstream_key, "OWEllipticMirror", sorted(settings.items()), 1.0)
+
+    upstream_key = fingerprint(None, "OWGaussianSource1d", sorted({"source_lambda" : 10}.items()), 1.0)
+    element_key = get_element_key(upstream_key, settings)
+
+    assert element_key == get_element_key(upstream_key, dict(settings))
+    assert element_key != get_element_key(upstream_key, dict(settings, f2=1.21))
+    assert element_key != get_element_key(fingerprint(None, "OWGaussianSource1d", sorted({"source_lambda" : 11}.items()), 1.0), settings)
+    assert element_key != get_element_key(None, settings)
+
+def test_lru_eviction_under_memory_budget():
+    cache = WiserLRUCache(memory_budget=1) # MB
+    size = MB_TO_BYTES // 8 // 3 # ~1/3 MB of float64
+
+    cache.put("a", numpy.zeros(size))
+    cache.put("b", numpy.zeros(size))
+
+    assert not cache.get("a") is None # a is now the most recently used
+
+    cache.put("c", numpy.zeros(size))
+    cache.put("d", numpy.zeros(size))
+
+    assert not "b" in cache
+    assert "a" in cache and "c" in cache and "d" in cache
+    assert cache.get_memory_used() <= cache.get_memory_budget()
+
+    cache.put("too big", numpy.zeros(2*MB_TO_BYTES // 8))
+
+    assert not "too big" in cache
+    assert len(cache) == 3
+
+    cache.set_memory_budget(0.5)
+
+    assert list(cache._entries.keys()) == ["d"]
+    assert cache.get("b") is None and cache.misses == 1
+
+def test_result_cache_is_a_singleton():
+    assert WiserResultCache.Instance() is WiserResultCache.Instance()
+
+def get_disk_cache(tmp_path, size_cap=WiserDiskCache.DEFAULT_SIZE_CAP, key_file="wiser_cache.key"):
+    directory = tmp_path / "cache"
+    directory.mkdir(mode=0o700, exist_ok=True)
+
+    return WiserDiskCache(str(directory), size_cap=size_cap, key_file=str(tmp_path / key_file))
+
+def test_disk_cache_round_trip(tmp_path):
+    disk_cache = get_disk_cache(tmp_path)
+    disk_cache.put("key", {"field" : numpy.arange(10.0)})
+
+    assert numpy.array_equal(disk_cache.get("key")["field"], numpy.arange(10.0))
+    assert disk_cache.get("missing", "default") == "default"
+    assert os.stat(tmp_path / "wiser_cache.key").st_mode & 0o077 == 0
+
+def test_disk_cache_refuses_entries_not_signed_by_the_user(tmp_path):
+    disk_cache = get_disk_cache(tmp_path)
+    disk_cache.put("key", [1, 2, 3])
+
+    path = disk_cache._get_path("key")
+    with open(path, "rb") as file: signature = file.read()[:WiserDiskCache.SIGNATURE_SIZE]
+    with open(path, "wb") as file: file.write(signature + pickle.dumps([4, 5, 6])) # content replaced by somebody else
+
+    assert disk_cache.get("key") is None
+    assert not os.path.exists(path)
+
+    disk_cache.put("key", [1, 2, 3])
+
+    assert get_disk_cache(tmp_path, key_file="other_user.key").get("key") is None
+
+def test_disk_cache_refuses_directories_writable_by_others(tmp_path):
+    disk_cache = get_disk_cache(tmp_path)
+    os.chmod(disk_cache.get_directory(), 0o777)
+
+    assert not WiserDiskCache.is_private_directory(disk_cache.get_directory())
+
+    disk_cache.put("key", [1, 2, 3])
+
+    assert not os.path.exists(disk_cache._get_path("key"))
+
+    os.chmod(disk_cache.get_directory(), 0o700)
+    disk_cache.put("key", [1, 2, 3])
+    os.chmod(disk_cache.get_directory(), 0o777)
+
+    assert disk_cache.get("key") is None
+
+def test_disk_cache_evicts_the_least_recently_used(tmp_path):
+    disk_cache = get_disk_cache(tmp_path, size_cap=1) # MB
+    size = MB_TO_BYTES // 8 // 4 # 1/4 MB of float64 per entry, plus signature and pickle overhead: 3 entries fit
+
+    disk_cache.put("a", numpy.zeros(size))
+    disk_cache.put("b", numpy.zeros(size))
+    os.utime(disk_cache._get_path("a"), (1000, 1000))
+    os.utime(disk_cache._get_path("b"), (2000, 2000))
+
+    assert not disk_cache.get("a") is None # access time of a updated: b is the oldest
+
+    disk_cache.put("c", numpy.zeros(size))
+    disk_cache.put("d", numpy.zeros(size))
+
+    assert not "b" in disk_cache
+    assert "a" in disk_cache and "c" in disk_cache and "d" in disk_cache
+    assert disk_cache.get_size_used() <= disk_cache.get_size_cap()
+
+def test_disk_cache_writes_atomically(tmp_path, monkeypatch):
+    disk_cache = get_disk_cache(tmp_path)
+    disk_cache.put("key", "first")
+
+    replaced = []
+    os_replace = os.replace
+
+    def check_replace(source, destination):
+        # the entry is complete before it becomes visible, and visible entries are never partial
+        with open(source, "rb") as file: data = file.read()
+        assert pickle.loads(data[WiserDiskCache.SIGNATURE_SIZE:]) == "second"
+        assert disk_cache.get("key") == "first"
+
+        replaced.append((source, destination))
+        os_replace(source, destination)
+
+    monkeypatch.setattr(os, "replace", check_replace)
+
+    disk_cache.put("key", "second")
+
+    assert replaced == [(disk_cache._get_path("key") + "." + str(os.getpid()) + ".tmp", disk_cache._get_path("key"))]
+    assert disk_cache.get("key") == "second"
+
+    disk_cache.put("key", lambda: None) # not picklable: the entry is left as it was, with no temporary file
+
+    assert disk_cache.get("key") == "second"
+    assert sorted(os.listdir(disk_cache.get_directory())) == ["key" + WiserDiskCache.FILE_EXTENSION]
@@ -0,0 +1,136 @@
+import os
+import json
+
+import numpy
+import pytest
+
+pytest.importorskip("srxraylib")
+
+from orangecontrib.OasysWiser.util.wise_dabam import DabamStore, DabamProfile, INDEX_FILE_NAME
+
+def write_dabam_entry(directory, entry, surface_shape, length, height_rms, seed):
+    # heights [nm] of a random walk, abscissas [mm], as the DABAM files of type 2
+    random_generator = numpy.random.default_rng(seed)
+    heights = numpy.cumsum(random_generator.normal(size=401))
+    heights *= height_rms/heights.std(ddof=1)
+
+    numpy.savetxt(os.path.join(directory, "dabam-%03d.dat" % entry), numpy.column_stack([numpy.linspace(0.0, length*1e3, 401), heights]))
+
+    with open(os.path.join(directory, "dabam-%03d.txt" % entry), "w") as file:
+        json.dump({"FILE_FORMAT" : 2, "FILE_HEADER_LINES" : 0, "X1_FACTOR" : 1e-3, "Y1_FACTOR" : 1e-9, "SURFACE_SHAPE" : surface_shape}, file)
+
+@pytest.fixture
+def source_directory(tmp_path):
+    directory = tmp_path / "source"
+    directory.mkdir()
+
+    write_dabam_entry(str(directory), 1, "plane", 0.2, 1.0, seed=1)
+    write_dabam_entry(str(directory), 2, 3, 0.5, 50.0, seed=2) # elliptical, as an integer code
+
+    return str(directory)
+
+def test_import_directory(source_directory, tmp_path):
+    store = DabamStore(str(tmp_path / "store"))
+
+    assert not store.exists()
+    assert store.import_directory(source_directory) == 2
+    assert store.exists()
+
+    assert sorted(file_name for file_name in os.listdir(store.directory) if file_name.startswith("dabam-0")) == ["dabam-001.dat", "dabam-001.txt",
+                                                                                                                  "dabam-002.dat", "dabam-002.txt"]
+
+    records = store.get_records()
+
+    assert [record["entry"] for record in records] == [1, 2]
+    assert [record["surface"] for record in records] == ["Plane", "Elliptical"]
+    assert records[0]["length"] == pytest.approx(0.2)
+    assert records[0]["hgt_err"] < 10e-9 < records[1]["hgt_err"] # of the detrended heights
+
+    with pytest.raises(FileNotFoundError): store.import_directory(str(tmp_path / "missing"))
+
+    (tmp_path / "empty").mkdir()
+    with pytest.raises(ValueError): store.import_directory(str(tmp_path / "empty"))
+
+def test_search(source_directory, tmp_path):
+    store = DabamStore(str(tmp_path / "store"))
+
+    with pytest.raises(FileNotFoundError): store.search()
+
+    store.import_directory(source_directory)
+
+    def search(**ranges): return [record["entry"] for record in store.search(**ranges)]
+
+    assert search() == [1, 2]
+    assert search(surface="plane") == [1]
+    assert search(surface="Elliptical") == [2]
+    assert search(length_from=0.3) == [2]
+    assert search(length_to=0.3) == [1]
+    assert search(hgt_err_to=10e-9) == [1]
+    assert search(hgt_err_from=10e-9, hgt_err_to=1e-6) == [2]
+    assert search(surface="plane", length_from=0.3) == []
+
+def test_search_excludes_entries_without_statistics(source_directory, tmp_path):
+    store = DabamStore(str(tmp_path / "store"))
+    store.import_directory(source_directory)
+
+    assert search_correlation_length(store) == [] # NaN in the index: excluded by any range
+
+    assert store.precompute_statistics(entries=[2]) == 1
+    assert store.has_statistics(2) and not store.has_statistics(1)
+
+    correlation_length = store.get_records()[1]["correlation_length"]
+
+    assert correlation_length > 0.0
+    assert store.get_records()[0]["correlation_length"] is None
+    assert search_correlation_length(store) == [2]
+    assert [record["entry"] for record in store.search(psd_beta_from=-100.0)] == [2]
+    assert [record["entry"] for record in store.search()] == [1, 2] # no range: all the entries
+
+    assert store.load_profile(2).correlation_length == correlation_length
+    assert isinstance(store.load_profile(2), DabamProfile)
+
+def test_default_metadata_is_not_shared():
+    first, second = DabamProfile(1), DabamProfile(2)
+    first.metadata["SURFACE_SHAPE"] = "plane"
+    first.powerlaw["hgt_pendent"] = -2.0
+
+    assert second.metadata == {} and second.powerlaw == {}
+
+def search_correlation_length(store):
+    return [record["entry"] for record in store.search(correlation_length_from=0.0, correlation_length_to=1.0)]
+
+def test_index_is_reloaded_when_changed(source_directory, tmp_path):
+    store = DabamStore(str(tmp_path / "store"))
+    store.import_directory(source_directory, entries=[1])
+
+    assert [record["entry"] for record in store.search()] == [1]
+
+    other_store = DabamStore(store.directory) # e.g. another OASYS session
+    other_store.import_directory(source_directory, entries=[2])
+
+    index_mtime = os.stat(store.get_index_path()).st_mtime_ns + 1000000000
+    os.utime(store.get_index_path(), ns=(index_mtime, index_mtime)) # coarse file system clocks
+
+    assert [record["entry"] for record in store.search()] == [1, 2]
+
+def test_index_is_rewritten_atomically(source_directory, tmp_path, monkeypatch):
+    store = DabamStore(str(tmp_path / "store"))
+    store.import_directory(source_directory, entries=[1])
+
+    replaced = []
+    os_replace = os.replace
+
+    def check_replace(source, destination):
+        # the new index is complete before it becomes visible, and the visible index is never partial
+        with open(source, "r") as file: assert [record["entry"] for record in json.load(file)["entries"]] == [1, 2]
+        with open(destination, "r") as file: assert [record["entry"] for record in json.load(file)["entries"]] == [1]
+
+        replaced.append((source, destination))
+        os_replace(source, destination)
+
+    monkeypatch.setattr(os, "replace", check_replace)
+
+    store.import_directory(source_directory, entries=[2])
+
+    assert replaced == [(store.get_index_path() + "." + str(os.getpid()) + ".tmp", store.get_index_path())]
+    assert sorted(file_name for file_name in os.listdir(store.directory) if file_name.startswith(INDEX_FILE_NAME)) == [INDEX_FILE_NAME]
@@ -0,0 +1,67 @@
+import numpy
+import pytest
+
+from orangecontrib.OasysWiser.util.wise_decimation import decimate_min_max, get_visible_slice, DecimatedCurve
+
+@pytest.mark.parametrize("n_samples", [1000, 1003]) # with and without remainder samples after the last bin
+def test_min_max_of_each_bin_are_kept_in_order(n_samples):
+    x = numpy.arange(n_samples, dtype=float)
+    y = numpy.random.default_rng(n_samples).normal(size=n_samples)
+    n_bins = 10
+
+    decimated_x, decimated_y = decimate_min_max(x, y, n_bins)
+
+    assert len(decimated_x) <= 2*n_bins + 4
+    assert numpy.all(numpy.diff(decimated_x) > 0) # original order, no duplicates
+    assert numpy.array_equal(decimated_y, y[decimated_x.astype(int)])
+    assert decimated_x[0] == 0 and decimated_x[-1] == n_samples - 1
+
+    bin_size = n_samples // n_bins
+    bins = [(start, start + bin_size) for start in range(0, bin_size*n_bins, bin_size)] + [(bin_size*n_bins, n_samples)]
+
+    for start, stop in bins:
+        if start == stop: continue
+
+        assert start + numpy.argmin(y[start:stop]) in decimated_x
+        assert start + numpy.argmax(y[start:stop]) in decimated_x
+
+def test_short_curves_are_not_decimated():
+    x, y = numpy.arange(20.0), numpy.arange(20.0)**2
+
+    decimated_x, decimated_y = decimate_min_max(x, y, 10)
+
+    assert numpy.array_equal(decimated_x, x) and numpy.array_equal(decimated_y, y)
+
+@pytest.mark.parametrize("x", [numpy.linspace(0.0, 10.0, 101), numpy.linspace(10.0, 0.0, 101)])
+def test_visible_slice(x):
+    inside = numpy.flatnonzero((x >= 2.05) & (x <= 5.0))
+
+    assert get_visible_slice(x, 2.05, 5.0, margin=0) == (inside[0], inside[-1] + 1)
+    assert get_visible_slice(x, 2.05, 5.0) == (inside[0] - 1, inside[-1] + 2)
+    assert get_visible_slice(x, -5.0, 20.0) == (0, 101)
+
+def test_visible_slice_on_decreasing_x():
+    x = numpy.linspace(10.0, 0.0, 101)
+
+    start, stop = get_visible_slice(x, 2.05, 5.0, margin=0)
+
+    assert x[start] == pytest.approx(5.0) and x[stop - 1] == pytest.approx(2.1)
+
+def test_unchanged_view_is_not_redrawn():
+    x = numpy.linspace(0.0, 1.0, 10001)
+    curve = DecimatedCurve(x, numpy.sin(200*x))
+
+    assert curve.needs_decimation(100)
+    assert not curve.get_points(100) is None
+    assert curve.get_points(100) is None
+    assert not curve.get_points(200) is None
+
+    zoomed_x, zoomed_y = curve.get_points(100, 0.2, 0.3)
+
+    assert numpy.all(numpy.diff(zoomed_x) > 0)
+    assert zoomed_x[0] == 0.0 and zoomed_x[-1] == 1.0 # data bounds kept for the zoom reset
+
+    assert curve.get_points(100, 0.2, 0.3) is None
+    assert curve.get_points(100, 0.3, 0.2) is None # same range, inverted axis
+    assert not curve.get_points(100, 0.2, 0.31) is None
+    assert not curve.get_points(100) is None
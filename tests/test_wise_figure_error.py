@@ -0,0 +1,55 @@
+import numpy
+import pytest
+
+from orangecontrib.OasysWiser.util.wise_figure_error import FigureErrorProfile, save_figure_error, load_figure_error
+
+def test_binary_round_trip(tmp_path):
+    pytest.importorskip("h5py")
+
+    heights = numpy.random.default_rng(0).normal(scale=1e-9, size=1000)
+    file_name = str(tmp_path / "figure_error.h5")
+
+    save_figure_error(file_name, heights, 1e-4, amplitude_scaling=2.0, provenance={"creator" : "test", "seed" : 0})
+
+    figure_error = load_figure_error(file_name, step=1.0) # the step of the file prevails
+
+    assert figure_error.step == 1e-4
+    assert figure_error.amplitude_scaling == 2.0
+    assert figure_error.provenance == {"creator" : "test", "seed" : 0}
+    assert figure_error.get_length() == pytest.approx(0.1)
+    assert numpy.array_equal(figure_error.heights, heights)
+
+    # contiguous and uncompressed: memory-mapped, read-only
+    assert isinstance(figure_error.heights, numpy.memmap)
+    with pytest.raises(ValueError): figure_error.heights[0] = 1.0
+
+def test_binary_file_without_provenance(tmp_path):
+    pytest.importorskip("h5py")
+
+    file_name = str(tmp_path / "figure_error.h5")
+
+    save_figure_error(file_name, numpy.zeros(10), 1e-3)
+
+    assert load_figure_error(file_name).provenance == {}
+
+    first, second = FigureErrorProfile(numpy.zeros(10), 1e-3), FigureErrorProfile(numpy.zeros(10), 1e-3)
+    first.provenance["file"] = "first.dat"
+
+    assert second.provenance == {}
+
+def test_text_file_needs_the_step(tmp_path):
+    heights = numpy.linspace(-1.0, 1.0, 11) # nm
+    file_name = str(tmp_path / "figure_error.dat")
+    numpy.savetxt(file_name, heights)
+
+    with pytest.raises(ValueError): load_figure_error(file_name)
+
+    figure_error = load_figure_error(file_name, step=1e-3, height_units_to_m=1e-9)
+
+    assert figure_error.step == 1e-3
+    assert figure_error.amplitude_scaling == 1e-9
+    assert figure_error.provenance == {"file" : file_name}
+    assert numpy.allclose(figure_error.heights, heights)
+
+def test_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError): load_figure_error(str(tmp_path / "missing.h5"))
@@ -0,0 +1,152 @@
+import numpy
+import pytest
+
+from orangecontrib.OasysWiser.util.wise_focus import FocusSweepResult, half_energy_width, compute_focus_sweep
+
+def get_focussing_element(n_samples=500):
+    # elliptic mirror of a two-elements LibWiser beamline, with its field computed
+    from LibWiser import Foundation, Optics
+    from LibWiser.Foundation import PositioningDirectives
+
+    source = Foundation.OpticalElement(Optics.SourceGaussian(10e-9, 125e-6),
+                                       PositioningDirectives=PositioningDirectives(ReferTo=PositioningDirectives.ReferTo.AbsoluteReference,
+                                                                                   XYCentre=[0.0, 0.0],
+                                                                                   Angle=0.0),
+                                       Name="source",
+                                       IsSource=True)
+    mirror = Foundation.OpticalElement(Optics.MirrorElliptic(f1=98.0, f2=1.2, L=0.4, Alpha=numpy.deg2rad(2.5)),
+                                       PositioningDirectives=PositioningDirectives(ReferTo=PositioningDirectives.ReferTo.Source,
+                                                                                   PlaceWhat=PositioningDirectives.What.UpstreamFocus,
+                                                                                   PlaceWhere=PositioningDirectives.Where.Centre),
+                                       Name="mirror")
+    mirror.ComputationSettings.UseCustomSampling = True
+    mirror.ComputationSettings.NSamples = n_samples
+
+    beamline = Foundation.BeamlineElements()
+    beamline.Append(source)
+    beamline.Append(mirror)
+    beamline.RefreshPositions()
+    beamline.ComputeFields(Verbose=False)
+
+    return mirror
+
+def test_half_energy_width_as_libwiser():
+    Rayman = pytest.importorskip("LibWiser.Rayman")
+
+    random_generator = numpy.random.default_rng(0)
+
+    for _ in range(200):
+        n_samples = int(random_generator.integers(2, 400))
+
+        if random_generator.random() < 0.5:
+            intensity = random_generator.random(n_samples)**int(random_generator.integers(1, 6))
+        else:
+            intensity = numpy.exp(-((numpy.arange(n_samples) - random_generator.uniform(0, n_samples))/random_generator.uniform(1, n_samples/3 + 1))**2)
+
+        libwiser_hew = numpy.atleast_1d(Rayman.HalfEnergyWidth_1d(intensity, Step=0.1, UseCentreOfMass=False))[0] # (diameter, centre) in recent versions
+
+        assert half_energy_width(intensity, 0.1) == pytest.approx(libwiser_hew)
+
+def test_multi_process_sweep_keeps_the_order():
+    pytest.importorskip("LibWiser")
+
+    focussing_element = get_focussing_element()
+    defocus_list = numpy.linspace(-5e-3, 5e-3, 7)
+
+    sequential_result = compute_focus_sweep(focussing_element, defocus_list, 50e-6, n_pools=1)
+    pooled_result = compute_focus_sweep(focussing_element, defocus_list, 50e-6, n_pools=2)
+
+    assert numpy.array_equal(pooled_result.defocus_list, defocus_list)
+    assert numpy.array_equal(pooled_result.hews, sequential_result.hews)
+
+    for pooled_field, sequential_field in zip(pooled_result.electric_fields, sequential_result.electric_fields):
+        assert numpy.allclose(pooled_field, sequential_field)
+
+def test_best_focus_index_on_uniform_plateau():
+    hews = [5.0, 3.0, 2.0, 2.0, 2.0, 3.0]
+
+    assert FocusSweepResult(numpy.arange(6.0), [None]*6, [None]*6, hews).get_best_focus_index() == 3
+
+def test_best_focus_index_on_refined_plateau():
+    # planes packed near 2.0, as added by the golden section: the plateau spans [1, 4], centred at 2.5
+    defocus_list = [0.0, 1.0, 2.0, 2.1, 2.2, 2.3, 2.4, 4.0, 5.0]
+    hews = [3.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 2.0]
+
+    assert FocusSweepResult(defocus_list, [None]*9, [None]*9, hews).get_best_focus_index() == 6
+
+def patch_defocus_computation(monkeypatch, hew_function):
+    from orangecontrib.OasysWiser.util import wise_focus
+
+    monkeypatch.setattr(wise_focus, "detach_optical_element", lambda focussing_element: focussing_element)
+    monkeypatch.setattr(wise_focus, "_build_sweep_beamline", lambda focussing_element, detector_size, n_pools: (None, None))
+    monkeypatch.setattr(wise_focus, "_compute_defocus", lambda beamline, detector, defocus: (numpy.ones(3, dtype=complex), numpy.arange(3.0), hew_function(defocus)))
+
+@pytest.mark.parametrize("best_defocus", [-0.0123, 0.0, 0.0371])
+def test_search_converges_on_unimodal_hew(monkeypatch, best_defocus):
+    from orangecontrib.OasysWiser.util.wise_focus import search_best_focus
+
+    patch_defocus_computation(monkeypatch, lambda defocus: 1e-6 + 1e-4*abs(defocus - best_defocus))
+
+    tolerance = 1e-4
+    result = search_best_focus(None, -0.05, 0.05, 50e-6, n_coarse_points=11, tolerance=tolerance)
+
+    assert numpy.all(numpy.diff(result.defocus_list) > 0)
+    assert abs(result.defocus_list[result.get_best_focus_index()] - best_defocus) <= tolerance
+
+def test_search_converges_on_hew_plateau(monkeypatch):
+    from orangecontrib.OasysWiser.util.wise_focus import search_best_focus
+
+    plateau_centre, plateau_half_width = 0.004, 0.003
+
+    patch_defocus_computation(monkeypatch, lambda defocus: 1e-6 + 1e-4*max(abs(defocus - plateau_centre) - plateau_half_width, 0.0))
+
+    tolerance = 1e-4
+    result = search_best_focus(None, -0.05, 0.05, 50e-6, n_coarse_points=11, tolerance=tolerance)
+
+    best_defocus = result.defocus_list[result.get_best_focus_index()]
+
+    assert abs(best_defocus - plateau_centre) <= plateau_half_width
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_save_and_load_focus_sweep(tmp_path, compressed):
+    pytest.importorskip("h5py")
+
+    from orangecontrib.OasysWiser.util.wise_focus import save_focus_sweep, load_focus_sweep
+
+    random_generator = numpy.random.default_rng(0)
+    n_samples_list = [50, 80, 65]
+
+    focus_sweep_result = FocusSweepResult(numpy.linspace(-1e-3, 1e-3, 3),
+                                          [random_generator.normal(size=n) + 1j*random_generator.normal(size=n) for n in n_samples_list],
+                                          [numpy.linspace(-25e-6, 25e-6, n) for n in n_samples_list],
+                                          [3e-6, 1e-6, 2e-6])
+
+    file_name = str(tmp_path / "best_focus.h5")
+    save_focus_sweep(file_name, focus_sweep_result, compressed=compressed, attributes={"oe_name" : "Detector"})
+
+    loaded_result, attributes = load_focus_sweep(file_name)
+
+    assert attributes["oe_name"] == "Detector"
+    assert numpy.array_equal(loaded_result.defocus_list, focus_sweep_result.defocus_list)
+    assert numpy.array_equal(loaded_result.hews, focus_sweep_result.hews)
+    assert loaded_result.get_best_focus_index() == 1
+
+    for index in range(3):
+        assert numpy.array_equal(loaded_result.electric_fields[index], focus_sweep_result.electric_fields[index])
+        assert numpy.array_equal(loaded_result.positions[index], focus_sweep_result.positions[index])
+
+        # uncompressed datasets are memory-mapped, compressed ones are read
+        assert isinstance(loaded_result.electric_fields[index].base, numpy.memmap) != compressed
+        assert isinstance(loaded_result.positions[index].base, numpy.memmap) != compressed
+
+def test_save_focus_sweep_without_attributes(tmp_path):
+    pytest.importorskip("h5py")
+
+    from orangecontrib.OasysWiser.util.wise_focus import save_focus_sweep, load_focus_sweep
+
+    focus_sweep_result = FocusSweepResult([0.0], [numpy.ones(4, dtype=complex)], [numpy.arange(4.0)], [1e-6])
+
+    save_focus_sweep(str(tmp_path / "first.h5"), focus_sweep_result)
+    _, attributes = load_focus_sweep(str(tmp_path / "first.h5"))
+
+    assert set(attributes.keys()) == {"creator"}
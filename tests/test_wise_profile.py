@@ -0,0 +1,27 @@
+import numpy
+import pytest
+
+from orangecontrib.OasysWiser.util.wise_profile import autocovariance, get_correlation_length
+
+def get_random_walk(seed, n_samples=1001, length=1.0):
+    return numpy.linspace(0.0, length, n_samples), numpy.cumsum(numpy.random.default_rng(seed).normal(size=n_samples))
+
+@pytest.mark.parametrize("seed", range(5))
+def test_correlation_length_as_dabam(seed):
+    dabam = pytest.importorskip("srxraylib.metrology.dabam")
+
+    x, y = get_random_walk(seed)
+
+    dabam_lags, dabam_acf, dabam_correlation_length = dabam.autocorrelationfunction(x, y)
+    lags, acf, correlation_length = autocovariance(x, y)
+
+    assert correlation_length == pytest.approx(dabam_correlation_length)
+    assert numpy.allclose(acf[:len(dabam_acf)], dabam_acf)
+
+def test_correlation_length_at_1_over_e():
+    x, y = get_random_walk(0)
+    lags, acf, correlation_length = autocovariance(x, y)
+
+    assert correlation_length == get_correlation_length(lags, acf, level=1/numpy.e)
+    assert get_correlation_length(lags, acf, level=0.5) < correlation_length
+    assert numpy.isnan(get_correlation_length(lags, numpy.ones(len(lags)))) # never decorrelated
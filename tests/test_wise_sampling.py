@@ -0,0 +1,58 @@
+import numpy
+import pytest
+
+pytest.importorskip("LibWiser")
+
+from LibWiser import Foundation, Optics
+from LibWiser.Foundation import PositioningDirectives
+
+from orangecontrib.OasysWiser.util.wise_sampling import get_budget_samples, get_sampling_geometry, is_sampling_inherited
+
+def get_beamline():
+    source = Foundation.OpticalElement(Optics.SourceGaussian(10e-9, 125e-6),
+                                       PositioningDirectives=PositioningDirectives(ReferTo=PositioningDirectives.ReferTo.AbsoluteReference,
+                                                                                   XYCentre=[0.0, 0.0],
+                                                                                   Angle=0.0),
+                                       Name="source",
+                                       IsSource=True)
+    mirror = Foundation.OpticalElement(Optics.MirrorElliptic(f1=98.0, f2=1.2, L=0.4, Alpha=numpy.deg2rad(2.5)),
+                                       PositioningDirectives=PositioningDirectives(ReferTo=PositioningDirectives.ReferTo.Source,
+                                                                                   PlaceWhat=PositioningDirectives.What.UpstreamFocus,
+                                                                                   PlaceWhere=PositioningDirectives.Where.Centre),
+                                       Name="mirror")
+    detector = Foundation.OpticalElement(Optics.Detector(L=50e-6, AngleGrazing=numpy.deg2rad(90)),
+                                         PositioningDirectives=PositioningDirectives(ReferTo=PositioningDirectives.ReferTo.UpstreamElement,
+                                                                                     PlaceWhat=PositioningDirectives.What.Centre,
+                                                                                     PlaceWhere=PositioningDirectives.Where.DownstreamFocus,
+                                                                                     Distance=0.0),
+                                         Name="detector")
+
+    beamline = Foundation.BeamlineElements()
+    beamline.Append(source)
+    beamline.Append(mirror)
+    beamline.Append(detector)
+    beamline.RefreshPositions()
+
+    return beamline, mirror, detector
+
+def test_budget_is_the_number_of_samples_of_the_field():
+    beamline, mirror, detector = get_beamline()
+
+    phase_tolerance = 1.0
+    mirror_budget = get_budget_samples(mirror, beamline.Lambda, phase_tolerance)
+
+    assert not is_sampling_inherited(mirror) # analytic source upstream
+    assert mirror_budget == get_sampling_geometry(mirror, beamline.Lambda).get_samples_for_phase_tolerance(phase_tolerance)
+
+    assert is_sampling_inherited(detector)
+    assert get_budget_samples(detector, beamline.Lambda, phase_tolerance) is None
+
+    mirror.ComputationSettings.UseCustomSampling = True
+    mirror.ComputationSettings.NSamples = mirror_budget
+    detector.ComputationSettings.UseCustomSampling = True
+    detector.ComputationSettings.NSamples = 2*mirror_budget # ignored by LibWiser
+
+    beamline.ComputeFields(Verbose=False)
+
+    assert len(mirror.Results.Field) == mirror_budget
+    assert len(detector.Results.Field) == mirror_budget